@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+""" Compare reading the consensus with vanguards.consensus against parsing
+    it with stem, for both the router entries and the bandwidth weights.
+
+    In a real vanguards process, the stem path also fetches the entries over
+    the control port with GETINFO ns/all, which this does not measure.
+
+    Run from the source tree with:
+      PYTHONPATH=src python benchmarks/bench_consensus.py [consensus_file]
+"""
+import sys
+import time
+
+import stem.descriptor
+
+from vanguards import consensus
+from vanguards import control
+
+def stem_read(consensus_file):
+  routers = list(stem.descriptor.parse_file(consensus_file,
+                 document_handler =
+                    stem.descriptor.DocumentHandler.ENTRIES))
+  # Vanguards reads these, which makes stem parse them
+  for r in routers:
+    (r.fingerprint, r.nickname, r.flags, r.bandwidth, r.measured, r.address)
+  return (routers, control.get_consensus_weights(consensus_file))
+
+def bench(name, func, consensus_file, iterations=3):
+  best = None
+  for i in range(iterations):
+    start = time.time()
+    (routers, weights) = func(consensus_file)
+    secs = time.time() - start
+    if best is None or secs < best:
+      best = secs
+  print("%-10s %6d routers in %7.3fs" % (name, len(routers), best))
+  return best
+
+def main():
+  consensus_file = "tests/cached-microdesc-consensus"
+  if len(sys.argv) > 1:
+    consensus_file = sys.argv[1]
+  stem_secs = bench("stem", stem_read, consensus_file)
+  fast_secs = bench("streaming", consensus.read_consensus, consensus_file)
+  print("%.1fx faster" % (stem_secs/fast_secs))
+
+if __name__ == '__main__':
+  main()
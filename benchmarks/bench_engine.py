@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+""" Compare per-event latency of stem's threaded event dispatch against
+    vanguards.aioengine, with a mock tor sending CIRC and CIRC_BW events.
+
+    Latency is from stem reading an event off the control socket to our
+    handler running on it. Stem's own arrival times are whole seconds, so
+    we stamp messages as its reader thread reads them.
+
+    Run from the source tree with:
+      PYTHONPATH=src python benchmarks/bench_engine.py [circs/sec] [secs]
+"""
+import os
+import sys
+import threading
+import time
+
+import stem.control
+import stem.socket
+
+from vanguards import aioengine
+from vanguards import logger
+from vanguards import mocktor
+
+_recv_message = stem.socket.recv_message
+
+def timed_recv_message(control_file, arrived_at=None):
+  msg = _recv_message(control_file)
+  msg.arrived_at = time.time()
+  return msg
+
+def percentile(vals, pct):
+  vals = sorted(vals)
+  return vals[min(len(vals)-1, int(len(vals)*pct/100.0))]
+
+def run(port, engine_name, secs):
+  controller = stem.control.Controller.from_port("127.0.0.1", port)
+  controller.authenticate(password="bench")
+  lags = []
+
+  def handler(event):
+    lags.append(time.time() - event.arrived_at)
+
+  if engine_name == "asyncio":
+    engine = aioengine.AsyncEngine(controller)
+    for ev in ("CIRC", "CIRC_BW"):
+      engine.async_controller.add_event_listener(handler, ev)
+    started = []
+    def stop(now):
+      if not started:
+        started.append(now)
+      elif now - started[0] >= secs:
+        controller.close()
+    engine.call_every(0.1, stop)
+    engine.run()
+  else:
+    for ev in ("CIRC", "CIRC_BW"):
+      controller.add_event_listener(handler, ev)
+    time.sleep(secs)
+    controller.close()
+
+  return lags
+
+def main():
+  logger.set_loglevel("WARN")
+  stem.socket.recv_message = timed_recv_message
+  rate = 500
+  secs = 10
+  if len(sys.argv) > 1:
+    rate = float(sys.argv[1])
+  if len(sys.argv) > 2:
+    secs = int(sys.argv[2])
+
+  tor = mocktor.MockTor(os.path.join("tests", "cached-microdesc-consensus"),
+                        password="bench", rate=rate, lifetime_secs=1)
+  server = mocktor.make_server(tor, 0)
+  t = threading.Thread(target=server.serve_forever)
+  t.daemon = True
+  t.start()
+
+  try:
+    for engine_name in ("threaded", "asyncio"):
+      lags = run(server.server_address[1], engine_name, secs)
+      print("%-8s %7d events  p50: %6.3fms  p99: %6.3fms  max: %7.3fms" %
+            (engine_name, len(lags), 1000*percentile(lags, 50),
+             1000*percentile(lags, 99), 1000*max(lags)))
+  finally:
+    server.shutdown()
+    server.server_close()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+""" Compare stem's event parsing against vanguards.fastevents.
+
+    Run from the source tree with:
+      PYTHONPATH=src python benchmarks/bench_events.py [iterations]
+"""
+import sys
+import time
+
+import stem.response
+
+from stem.response import ControlMessage
+
+from vanguards import fastevents
+
+CIRC_BW = "650 CIRC_BW ID=7 READ=1018 WRITTEN=509 TIME=2018-05-04T06:08:55.751726 DELIVERED_READ=498 OVERHEAD_READ=0 DELIVERED_WRITTEN=10 OVERHEAD_WRITTEN=488\r\n"
+CIRC = "650 CIRC 2 BUILT $5416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed,$1F9544C0A80F1C5D8A5117FBFFB50694469CC7F4~as44194l10501,$DBD67767640197FF96EC6A87684464FC48F611B6~nocabal,$387B065A38E4DAA16D9D41C2964ECBC4B31D30FF~redjohn1 BUILD_FLAGS=IS_INTERNAL,NEED_CAPACITY,NEED_UPTIME PURPOSE=HS_SERVICE_REND HS_STATE=HSSR_CONNECTING REND_QUERY=icqercdaxolm2ykx TIME_CREATED=2018-05-04T06:09:32.751920\r\n"
+
+def bench(name, line, iterations):
+  # Pre-build the messages, since that's the socket reader's job
+  msgs = [ControlMessage.from_str(line) for i in range(iterations)]
+  start = time.time()
+  for m in msgs:
+    stem.response.convert("EVENT", m)
+  stem_secs = time.time() - start
+
+  msgs = [ControlMessage.from_str(line) for i in range(iterations)]
+  start = time.time()
+  for m in msgs:
+    fastevents.parse_event(m)
+  fast_secs = time.time() - start
+
+  print("%-8s stem: %8.0f events/sec  fastevents: %8.0f events/sec  (%.1fx)" %
+        (name, iterations/stem_secs, iterations/fast_secs,
+         stem_secs/fast_secs))
+
+def main():
+  iterations = 20000
+  if len(sys.argv) > 1:
+    iterations = int(sys.argv[1])
+  bench("CIRC_BW", CIRC_BW, iterations)
+  bench("CIRC", CIRC, iterations)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+""" Compare ExcludeNodes network matching against a linear overlap scan,
+    for an ExcludeNodes line of many networks.
+
+    Run from the source tree with:
+      PYTHONPATH=src python benchmarks/bench_exclude.py [networks]
+"""
+import random
+import sys
+import time
+
+import stem.descriptor
+
+from ipaddress import ip_network as net
+
+from vanguards import logger
+from vanguards.vanguards import ExcludeNodes
+
+class ConfController:
+  def __init__(self, exclude_nodes):
+    self.exclude_nodes = exclude_nodes
+
+  def get_conf(self, key):
+    if key == "ExcludeNodes":
+      return self.exclude_nodes
+    return None
+
+  def get_info(self, key, default=None):
+    return default
+
+def linear_is_excluded(networks, r):
+  # How ExcludeNodes used to check addresses
+  for network in networks:
+    if network.version == 4 and net(r.address+"/32").overlaps(network):
+      return True
+  return False
+
+def main():
+  logger.set_loglevel("WARN")
+  count = 1000
+  if len(sys.argv) > 1:
+    count = int(sys.argv[1])
+  rng = random.Random(1)
+  line = ",".join("%d.%d.%d.0/%d" % (rng.randint(1, 223), rng.randint(0, 255),
+                                     rng.randint(0, 255), rng.randint(16, 24))
+                  for i in range(count))
+  routers = list(stem.descriptor.parse_file("tests/cached-microdesc-consensus",
+                 document_handler =
+                    stem.descriptor.DocumentHandler.ENTRIES))
+
+  start = time.time()
+  exclude = ExcludeNodes(ConfController(line))
+  build_secs = time.time() - start
+
+  start = time.time()
+  linear = [linear_is_excluded(exclude.networks, r) for r in routers]
+  linear_secs = time.time() - start
+
+  start = time.time()
+  indexed = exclude.exclusion_mask(routers)
+  index_secs = time.time() - start
+
+  assert linear == indexed
+  print("%d networks, %d routers (%d excluded)" % (count, len(routers),
+                                                   sum(indexed)))
+  print("linear: %8.3fs  index: %8.3fs (+%.3fs to parse and build)  (%.0fx)" %
+        (linear_secs, index_secs, build_secs, linear_secs/index_secs))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+""" Compare the memory that the router table takes when it holds stem's
+    router status entries against our compact ConsensusRouters.
+
+    Both tables are measured after the fields that vanguards reads have been
+    accessed, since stem parses its entries lazily.
+
+    Run from the source tree with:
+      PYTHONPATH=src python benchmarks/bench_router_memory.py [consensus_file]
+"""
+import gc
+import sys
+import tracemalloc
+
+import stem.descriptor
+
+from vanguards import consensus
+
+def stem_routers(consensus_file):
+  routers = list(stem.descriptor.parse_file(consensus_file,
+                 document_handler =
+                    stem.descriptor.DocumentHandler.ENTRIES))
+  for r in routers:
+    (r.fingerprint, r.nickname, r.flags, r.bandwidth, r.measured, r.address,
+     r.or_port, r.or_addresses)
+  return routers
+
+def compact_from_stem(consensus_file):
+  return consensus.compact_routers(stem_routers(consensus_file))
+
+def streaming(consensus_file):
+  return consensus.read_consensus(consensus_file)[0]
+
+def measure(name, func, consensus_file):
+  gc.collect()
+  tracemalloc.start()
+  routers = func(consensus_file)
+  gc.collect()
+  size = tracemalloc.get_traced_memory()[0]
+  tracemalloc.stop()
+  print("%-18s %6d routers in %7.2f MiB (%5d bytes each)" %
+        (name, len(routers), size/1048576.0, size/len(routers)))
+  del routers
+  return size
+
+def main():
+  consensus_file = "tests/cached-microdesc-consensus"
+  if len(sys.argv) > 1:
+    consensus_file = sys.argv[1]
+  stem_size = measure("stem entries", stem_routers, consensus_file)
+  measure("compacted stem", compact_from_stem, consensus_file)
+  compact_size = measure("streaming", streaming, consensus_file)
+  print("%.1fx smaller" % (float(stem_size)/compact_size))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+""" Compare saving and loading our state file as a pickle against the
+    compact statefile format, for a state with rendguard counts for every
+    relay in the consensus.
+
+    Saves include the fsync and rename that the compact format does, so
+    the pickle numbers are for a plain write, like we used to do.
+
+    Run from the source tree with:
+      PYTHONPATH=src python benchmarks/bench_state.py [consensus_file]
+"""
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import time
+
+from vanguards import consensus
+from vanguards import logger
+from vanguards.vanguards import ExcludeNodes
+from vanguards.vanguards import VanguardState
+
+class ConfController:
+  def get_conf(self, key):
+    return None
+
+  def get_info(self, key, default=None):
+    return default
+
+def pickle_save(state, state_file):
+  with open(state_file, "wb") as f:
+    f.write(pickle.dumps(state))
+
+def pickle_load(state_file):
+  return pickle.load(open(state_file, "rb"))
+
+def compact_save(state, state_file):
+  # Unchanged state doesn't get written at all. Time a full rewrite.
+  state.rendguard.dirty_all = True
+  state.write_state_file()
+
+def compact_load(state_file):
+  return VanguardState.read_from_file(state_file)
+
+def pickle_decode(data, state_file):
+  return pickle.loads(data)
+
+def compact_decode(data, state_file):
+  return VanguardState.from_bytes(data, state_file)
+
+def best_of(func, args, iterations=200):
+  best = None
+  for i in range(iterations):
+    start = time.time()
+    func(*args)
+    secs = time.time() - start
+    if best is None or secs < best:
+      best = secs
+  return best
+
+def main():
+  logger.set_loglevel("WARN")
+  consensus_file = "tests/cached-microdesc-consensus"
+  if len(sys.argv) > 1:
+    consensus_file = sys.argv[1]
+
+  tmpdir = tempfile.mkdtemp()
+  try:
+    state_file = os.path.join(tmpdir, "vanguards.state")
+    state = VanguardState(state_file)
+    (routers, weights) = consensus.read_consensus(consensus_file)
+    state.consensus_update(routers, weights, ExcludeNodes(ConfController()))
+    counts = state.rendguard.use_counts
+    for i in range(len(counts.used)):
+      counts.used[i] = float(i % 100)
+    print("%d rendguard counts" % len(state.rendguard.use_counts))
+
+    for (name, save, load, decode) in \
+        (("pickle", pickle_save, pickle_load, pickle_decode),
+         ("compact", compact_save, compact_load, compact_decode)):
+      save_secs = best_of(save, (state, state_file))
+      load_secs = best_of(load, (state_file,))
+      # Without the file I/O, which is noisy
+      data = open(state_file, "rb").read()
+      decode_secs = best_of(decode, (data, state_file))
+      print("%-8s %7d bytes, save %7.2fms, load %7.2fms, decode %7.2fms" %
+            (name, len(data), 1000*save_secs, 1000*load_secs,
+             1000*decode_secs))
+  finally:
+    shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+""" Replay an event trace through the vanguards components.
+
+    Record a trace by setting record_events in vanguards.conf, then run
+    from the source tree with:
+      PYTHONPATH=src python benchmarks/replay_trace.py trace.gz [--speed 1]
+"""
+import argparse
+
+from vanguards import config
+from vanguards import eventtrace
+from vanguards import logger
+from vanguards import main as vanguards_main
+from vanguards import vanguards
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("trace_file", help="Trace file written by record_events")
+  parser.add_argument("--speed", type=float, default=0,
+                      help="Replay speed relative to the original pace "+
+                           "(default: 0, as fast as possible)")
+  parser.add_argument("--state", default=None,
+                      help="Vanguards state file to use for rendguard counts")
+  parser.add_argument("--fastevents", action="store_true",
+                      help="Parse CIRC and CIRC_BW with fastevents")
+  parser.add_argument("--loglevel", default="NOTICE",
+                      help="Log verbosity of the replayed components")
+  options = parser.parse_args()
+  logger.set_loglevel(options.loglevel)
+
+  # Run everything that listens to circuit events
+  for opt in ["ENABLE_RENDGUARD", "ENABLE_BANDGUARDS", "ENABLE_LOGGUARD",
+              "ENABLE_CBTVERIFY", "ENABLE_PATHVERIFY"]:
+    setattr(config, opt, True)
+  config.ENABLE_FASTEVENTS = options.fastevents
+
+  if options.state:
+    state = vanguards.VanguardState.read_from_file(options.state)
+  else:
+    state = vanguards.VanguardState("replay.state")
+  state.enable_vanguards = True
+
+  stats = eventtrace.replay(options.trace_file,
+                            vanguards_main.setup_listeners, state,
+                            options.speed)
+  print(stats.report())
+
+if __name__ == '__main__':
+  main()
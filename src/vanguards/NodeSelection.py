@@ -1,10 +1,15 @@
 #!/usr/bin/env python
 
+import bisect
 import copy
 import random
 
+from .consensus import FLAG_BITS, flag_mask
 from .logger import plog
 
+_GUARD = FLAG_BITS["Guard"]
+_EXIT = FLAG_BITS["Exit"]
+
 class RestrictionError(Exception):
   "Error raised for issues with applying restrictions"
   pass
@@ -26,13 +31,13 @@ class FlagsRestriction(NodeRestriction):
      flags as strings."""
     self.mandatory = mandatory
     self.forbidden = forbidden
+    self.mandatory_mask = flag_mask(mandatory)
+    self.forbidden_mask = flag_mask(forbidden)
 
   def r_is_ok(self, router):
-    for m in self.mandatory:
-      if not m in router.flags: return False
-    for f in self.forbidden:
-      if f in router.flags: return False
-    return True
+    mask = router.flag_mask
+    return mask & self.mandatory_mask == self.mandatory_mask and \
+           not mask & self.forbidden_mask
 
 class MetaNodeRestriction(NodeRestriction):
   """Interface for a NodeRestriction that is an expression consisting of
@@ -83,22 +88,79 @@ class NodeGenerator:
     "Return a python generator that yields routers according to the policy"
     raise NotImplemented()
 
+def router_sort_key(r):
+  """Sorts routers by descending bandwidth. Ties keep consensus order,
+  which is by fingerprint."""
+  return (-r.measured, r.fingerprint)
+
+try:
+  from itertools import accumulate as _running_totals
+except ImportError: # Python 2
+  def _running_totals(weights):
+    choose_total = 0
+    for w in weights:
+      choose_total += w
+      yield choose_total
+
+# A Fenwick tree over a list of weights lets us draw by weight, and take a
+# weight out of the draw, in O(log n) each. tree[i] holds the sum of the
+# (i & -i) weights up to and including weights[i-1].
+def _fenwick_tree(weights):
+  tree = [0] + list(weights)
+  for i in range(1, len(tree)):
+    parent = i + (i & -i)
+    if parent < len(tree):
+      tree[parent] += tree[i]
+  return tree
+
+def _fenwick_total(tree):
+  total = 0
+  i = len(tree) - 1
+  while i > 0:
+    total += tree[i]
+    i -= i & -i
+  return total
+
+def _fenwick_subtract(tree, idx, weight):
+  i = idx + 1
+  while i < len(tree):
+    tree[i] -= weight
+    i += i & -i
+
+def _fenwick_find(tree, value):
+  "Returns the first index whose running total reaches 'value'"
+  idx = 0
+  step = 1
+  while step*2 < len(tree):
+    step *= 2
+  while step:
+    if idx + step < len(tree) and tree[idx + step] < value:
+      idx += step
+      value -= tree[idx]
+    step //= 2
+  return idx
+
 class BwWeightedGenerator(NodeGenerator):
   POSITION_GUARD = 'g'
   POSITION_MIDDLE = 'm'
   POSITION_EXIT = 'e'
 
-  def flag_to_weight(self, node):
-    if 'Guard' in node.flags and "Exit" in node.flags:
-      return self.bw_weights[u'W'+self.position+'d']/self.WEIGHT_SCALE
+  def weight_table(self, position):
+    """Returns the flag weights for 'position', indexed by
+    weight_class(). Tor leaves out the weights for flags that can't be
+    used in a position (like Wge), so those are 0."""
+    return [self.bw_weights.get(u'Wmm', 0)/self.WEIGHT_SCALE,
+            self.bw_weights.get(u'W'+position+'g', 0)/self.WEIGHT_SCALE,
+            self.bw_weights.get(u'W'+position+'e', 0)/self.WEIGHT_SCALE,
+            self.bw_weights.get(u'W'+position+'d', 0)/self.WEIGHT_SCALE]
 
-    if 'Exit' in node.flags:
-      return self.bw_weights[u'W'+self.position+'e']/self.WEIGHT_SCALE
+  @staticmethod
+  def weight_class(node):
+    mask = node.flag_mask
+    return (1 if mask & _GUARD else 0) | (2 if mask & _EXIT else 0)
 
-    if "Guard" in node.flags:
-      return self.bw_weights[u'W'+self.position+'g']/self.WEIGHT_SCALE
-
-    return self.bw_weights[u'Wmm']/self.WEIGHT_SCALE
+  def flag_to_weight(self, node):
+    return self.position_weights[self.weight_class(node)]
 
 
   # This function handles https://github.com/mikeperry-tor/vanguards/issues/24
@@ -115,49 +177,150 @@ class BwWeightedGenerator(NodeGenerator):
   # exit_total for use with these Exit nodes (since it gives their
   # selection probability for cannibalized circs).
   def repair_exits(self):
-    oldpos = self.position
-    self.position = BwWeightedGenerator.POSITION_EXIT
+    self.base_weights = list(self.node_weights)
     self.exit_total = 0
 
     i = 0
     rlen = len(self.rstr_routers)
     while i < rlen:
       r = self.rstr_routers[i]
-      if "Exit" in r.flags:
-        self.node_weights[i] = r.measured*self.flag_to_weight(r)
+      if r.flag_mask & _EXIT:
+        self.node_weights[i] = self._exit_weight(r)
         self.exit_total += self.node_weights[i]
 
       i+=1
 
-    self.position = oldpos
+    self.rebuild_cumulative()
+
+  def _exit_weight(self, r):
+    return r.measured*self.exit_weights[self.weight_class(r)]
+
+  def rebuild_cumulative(self):
+    """Builds the running totals of node_weights that generate() searches.
+    They are summed in the same order as a linear scan would, so the
+    same random draw picks the same node."""
+    self.cumulative_weights = list(_running_totals(self.node_weights))
 
   def rebuild(self, sorted_r=None):
     NodeGenerator.rebuild(self, sorted_r)
     NodeGenerator.rewind(self)
     # TODO: Use consensus param
     self.WEIGHT_SCALE = 10000.0
+    self.position_weights = self.weight_table(self.position)
+    self.exit_weights = self.weight_table(BwWeightedGenerator.POSITION_EXIT)
 
-    self.node_weights = []
-    for r in self.rstr_routers:
-      self.node_weights.append(r.measured*self.flag_to_weight(r))
+    table = self.position_weights
+    weight_class = self.weight_class
+    self.node_weights = [r.measured*table[weight_class(r)]
+                         for r in self.rstr_routers]
+    self.sort_keys = list(map(router_sort_key, self.rstr_routers))
+    # The pre-repair_exits() weights, once that has been called
+    self.base_weights = None
 
     self.weight_total = sum(self.node_weights)
+    self.rebuild_cumulative()
+
+  def update_routers(self, removed, added):
+    """Applies a consensus diff in place of a rebuild(). 'removed' routers
+    are dropped, and 'added' ones that pass our restrictions are inserted at
+    their sorted position. Weights and totals come out the same as if we
+    had rebuilt from the new sorted list. Both lists must be sorted by
+    router_sort_key()."""
+    for r in removed:
+      key = router_sort_key(r)
+      i = bisect.bisect_left(self.sort_keys, key)
+      if i < len(self.sort_keys) and self.sort_keys[i] == key:
+        del self.sort_keys[i]
+        del self.rstr_routers[i]
+        del self.node_weights[i]
+        if self.base_weights is not None:
+          del self.base_weights[i]
+
+    for r in added:
+      if not self.rstr_list.r_is_ok(r):
+        continue
+      key = router_sort_key(r)
+      i = bisect.bisect_left(self.sort_keys, key)
+      weight = r.measured*self.flag_to_weight(r)
+      self.sort_keys.insert(i, key)
+      self.rstr_routers.insert(i, r)
+      if self.base_weights is None:
+        self.node_weights.insert(i, weight)
+      else:
+        self.base_weights.insert(i, weight)
+        if r.flag_mask & _EXIT:
+          self.node_weights.insert(i, self._exit_weight(r))
+        else:
+          self.node_weights.insert(i, weight)
+
+    if not self.rstr_routers:
+      plog("NOTICE", "No routers left after restrictions applied: "+str(self.rstr_list))
+      raise NoNodesRemain(str(self.rstr_list))
+
+    if self.base_weights is None:
+      self.weight_total = sum(self.node_weights)
+    else:
+      self.weight_total = sum(self.base_weights)
+      self.exit_total = sum(w for (w, r) in zip(self.node_weights,
+                                                self.rstr_routers)
+                              if r.flag_mask & _EXIT)
+    self.rebuild_cumulative()
 
   def __init__(self, sorted_r, rstr_list, bw_weights, position):
     self.position = position
     self.bw_weights = bw_weights
     self.node_weights = []
+    self.cumulative_weights = []
     NodeGenerator.__init__(self, sorted_r, rstr_list)
 
   def generate(self):
     while True:
       choice_val = random.uniform(0, self.weight_total)
-      choose_total = 0
-      choice_idx = 0
-      while choose_total < choice_val:
-        choose_total += self.node_weights[choice_idx]
-        choice_idx += 1
-      yield self.rstr_routers[choice_idx-1]
+      # The first node whose running total reaches choice_val
+      choice_idx = bisect.bisect_left(self.cumulative_weights, choice_val)
+      yield self.rstr_routers[min(choice_idx, len(self.rstr_routers)-1)]
+
+  def choose_distinct(self, count, excluded=None):
+    """Returns 'count' distinct routers, drawn by weight. excluded(routers)
+    returns a list of bools saying which of 'routers' must not be chosen.
+    It is only called on the routers that get drawn, a batch at a time, so
+    it may be expensive. Each draw has the same probabilities as taking the
+    next router from generate() that is neither excluded nor already
+    chosen, but without rebuilding the running totals for each draw."""
+    weights = list(self.node_weights)
+    tree = _fenwick_tree(weights)
+    live = sum(1 for w in weights if w > 0)
+
+    chosen = []
+    while len(chosen) < count:
+      if live <= 0:
+        plog("NOTICE", "No routers left after exclusions: "+str(self.rstr_list))
+        raise NoNodesRemain(str(self.rstr_list))
+
+      # Draw as many as we still need, then check them together. Drawing
+      # all of them before checking any doesn't change the odds, since
+      # excluded routers would be out of the running anyway.
+      candidates = []
+      while len(chosen) + len(candidates) < count and live > 0:
+        choice_val = random.uniform(0, _fenwick_total(tree))
+        choice_idx = min(_fenwick_find(tree, choice_val), len(weights)-1)
+        # A draw of exactly 0 can land on a zero-weight router
+        if weights[choice_idx] <= 0:
+          continue
+
+        _fenwick_subtract(tree, choice_idx, weights[choice_idx])
+        weights[choice_idx] = 0
+        live -= 1
+        candidates.append(self.rstr_routers[choice_idx])
+
+      if excluded:
+        mask = excluded(candidates)
+      else:
+        mask = [False]*len(candidates)
+      for (router, is_excluded) in zip(candidates, mask):
+        if not is_excluded:
+          chosen.append(router)
+    return chosen
 
 # FIXME: FlagsRestriction: Uptime, capacity (NodeRestriction: always want)
 # FIXME: Subnet16Restriction: Set restriction: at least one be different
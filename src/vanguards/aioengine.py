@@ -0,0 +1,149 @@
+""" Asyncio engine.
+
+    By default, stem's event thread runs all of our handlers, while the main
+    thread wakes up once a second to check if the control connection is
+    still alive.
+
+    This engine instead runs our handlers on an asyncio loop in the main
+    thread. The loop sleeps until an event arrives, a timer fires, or the
+    control connection closes. CLOSECIRCUIT commands are sent from a
+    separate thread, so that event processing does not wait on tor's reply.
+
+    Stem still owns the control socket, and does our authentication and
+    synchronous commands (GETINFO, SETCONF, etc). Its reader thread hands
+    events straight to the loop, rather than to stem's event thread, so
+    that they take no more thread hops than they do without this engine.
+"""
+import time
+
+try:
+  import asyncio
+  import concurrent.futures
+  import queue
+except ImportError:
+  asyncio = None
+
+import stem
+import stem.control
+
+from .logger import plog
+
+def _close_done(circ_id, future):
+  if future.cancelled():
+    return
+
+  e = future.exception()
+  if isinstance(e, stem.InvalidRequest):
+    plog("INFO", "Failed to close circuit "+str(circ_id)+": "+str(e.message))
+  elif e is not None:
+    plog("WARN", "Error closing circuit "+str(circ_id)+": "+str(e))
+
+class AsyncController:
+  """Passes everything through to the stem Controller, except that
+  close_circuit() returns without waiting for tor's reply."""
+  def __init__(self, controller, loop, executor):
+    self._controller = controller
+    self._loop = loop
+    self._executor = executor
+    self._logguard = None
+
+  def __getattr__(self, name):
+    return getattr(self._controller, name)
+
+  def close_circuit(self, circ_id):
+    future = self._loop.run_in_executor(self._executor,
+                                        self._controller.close_circuit,
+                                        circ_id)
+    future.add_done_callback(lambda f: _close_done(circ_id, f))
+
+class _LoopQueue:
+  """Stands in for the queue that stem's reader thread puts events on.
+  Events go straight onto our loop, and stem's event thread never gets
+  any."""
+  def __init__(self, engine):
+    self.engine = engine
+
+  def put(self, event_message):
+    self.engine._event_arrived(event_message)
+
+  def get_nowait(self):
+    raise queue.Empty()
+
+  def task_done(self):
+    pass
+
+class AsyncEngine:
+  def __init__(self, controller):
+    self.controller = controller
+    self.loop = asyncio.new_event_loop()
+    # One thread, so that commands reach tor in the order we sent them
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    self.async_controller = AsyncController(controller, self.loop,
+                                            self.executor)
+    self.closed = self.loop.create_future()
+    self.stem_handler = controller._handle_event
+    self.timers = [] # list of (secs, func)
+
+  def call_every(self, secs, func):
+    "Calls func(time.time()) every 'secs' seconds once the engine runs"
+    self.timers.append((secs, func))
+
+  def _run_timer(self, secs, func):
+    try:
+      func(time.time())
+    except Exception as e:
+      plog("WARN", "Timer "+str(func)+" raised an exception: "+str(e))
+    self.loop.call_later(secs, self._run_timer, secs, func)
+
+  # Called from stem's reader thread, or its event thread for any events
+  # it already had when we started
+  def _event_arrived(self, event_message):
+    try:
+      self.loop.call_soon_threadsafe(self.stem_handler, event_message)
+    except RuntimeError:
+      pass # Loop is closed. We're shutting down.
+
+  # Called from whichever thread noticed the connection closing
+  def _status_changed(self, controller, state, timestamp):
+    if state == stem.control.State.CLOSED:
+      try:
+        self.loop.call_soon_threadsafe(self._set_closed)
+      except RuntimeError:
+        pass
+
+  def _set_closed(self):
+    if not self.closed.done():
+      self.closed.set_result(True)
+
+  def run(self):
+    """Runs our handlers and timers until the control connection closes.
+    Listeners must be registered with 'async_controller' before this."""
+    self.controller._handle_event = self._event_arrived
+    stem_queue = getattr(self.controller, "_event_queue", None)
+    if stem_queue is not None:
+      self.controller._event_queue = _LoopQueue(self)
+      # Anything stem already queued would be stuck behind the swap
+      while True:
+        try:
+          self._event_arrived(stem_queue.get_nowait())
+        except queue.Empty:
+          break
+    self.controller.add_status_listener(self._status_changed, spawn=False)
+
+    for (secs, func) in self.timers:
+      self.loop.call_later(secs, self._run_timer, secs, func)
+
+    if not self.controller.is_alive():
+      self._set_closed()
+
+    try:
+      self.loop.run_until_complete(self.closed)
+    finally:
+      self.controller.remove_status_listener(self._status_changed)
+      self.controller._handle_event = self.stem_handler
+      if stem_queue is not None:
+        self.controller._event_queue = stem_queue
+      self.executor.shutdown(wait=False)
+      self.loop.close()
+
+    return "closed"
@@ -1,9 +1,14 @@
 """ Simple checks against bandwidth side channels """
+import heapq
 import time
 import stem
 
 from . import control
 
+from . import circuits
+
+from .circuits import CircuitInfo
+
 from .logger import plog
 
 ############ BandGuard Options #################
@@ -51,28 +56,20 @@ _BYTES_PER_MB = 1024*_BYTES_PER_KB
 # give it until the next couple in case there is a scheduled events hiccup
 _MAX_CIRC_DESTROY_LAG_SECS = 2
 
-class BwCircuitStat:
+# How long to wait for a circuit we closed for its age to go away, before
+# we try again
+_CLOSE_RETRY_SECS = 5
+
+class BwCircuitStat(CircuitInfo):
   def __init__(self, circ_id, is_hs):
-    self.circ_id = circ_id
-    self.is_hs = is_hs
-    self.is_service = 1
-    self.is_hsdir = 0
-    self.is_serv_intro = 0
+    CircuitInfo.__init__(self, circ_id, is_hs)
     self.dropped_cells_allowed = 0
-    self.purpose = None
-    self.hs_state = None
-    self.old_purpose = None
-    self.old_hs_state = None
-    self.in_use = 0
-    self.built = 0
-    self.created_at = time.time()
     self.read_bytes = 0
     self.sent_bytes = 0
     self.delivered_read_bytes = 0
     self.delivered_sent_bytes = 0
     self.overhead_read_bytes = 0
     self.overhead_sent_bytes = 0
-    self.guard_fp = None
     self.possibly_destroyed_at = None
 
   def total_bytes(self):
@@ -92,9 +89,18 @@ class BwGuardStat:
     self.close_reasons = {} # key=reason val=count
 
 class BandwidthStats:
-  def __init__(self, controller):
+  def __init__(self, controller, registry=None):
     self.controller = controller
-    self.circs = {} # key=circid val=BwCircStat
+    # Our per-circuit byte counts live on the registry's circuits
+    if registry is None:
+      registry = circuits.CircuitRegistry()
+    self.registry = registry
+    registry.circ_class = BwCircuitStat
+    self.circs = registry.circs # key=circid val=BwCircStat
+    # Heap of (created_at, circid), for expiring old circuits. Entries of
+    # closed circuits are left in until they reach the top, or until they
+    # outnumber the open circuits.
+    self.circ_ages = []
     self.live_guard_conns = {} # key=connid val=BwGuardStat
     self.guards = {} # key=guardfp val=BwGuardStat
     self.circs_destroyed_total = 0
@@ -104,9 +110,15 @@ class BandwidthStats:
     self.max_fake_id = -1
     self.disconnected_circs = False
     self.disconnected_conns = False
+    self.check_ages_on_bw = True
     self._orconn_init(controller)
     self._network_liveness_init(controller)
 
+    registry.add_listener(circuits.CIRC_ADDED, self.circ_added_event)
+    registry.add_listener(circuits.CIRC_BUILT, self.circ_built_event)
+    registry.add_listener(circuits.CIRC_EXTENDED, self.circ_extended_event)
+    registry.add_listener(circuits.CIRC_CLOSED, self.circ_closed_event)
+
   def _network_liveness_init(self, controller):
     if controller.get_info("network-liveness") != "up":
       self.network_down_since = int(time.time())
@@ -160,15 +172,14 @@ class BandwidthStats:
         self._fixup_orconn_event(event)
 
       if event.id in self.live_guard_conns:
-        # Scan the circuit list for any circuits that might
-        # be using this guard and that are in use. This is to
-        # watch for their close later.
-        for c in self.circs.values():
-          if c.in_use and c.guard_fp == guard_fp:
-            c.possibly_destroyed_at = event.arrived_at
-            self.live_guard_conns[event.id].killed_conn_at = event.arrived_at
-            plog("INFO", "Marking possibly destroyed circ %s at %d",
-                 c.circ_id, event.arrived_at)
+        # Mark any circuits that might be using this guard and
+        # that are in use. This is to watch for their close later.
+        for circ_id in self.registry.in_use_circs.get(guard_fp, ()):
+          c = self.circs[circ_id]
+          c.possibly_destroyed_at = event.arrived_at
+          self.live_guard_conns[event.id].killed_conn_at = event.arrived_at
+          plog("INFO", "Marking possibly destroyed circ %s at %d",
+               c.circ_id, event.arrived_at)
 
         del self.live_guard_conns[event.id]
         if len(self.live_guard_conns) == 0 and \
@@ -196,133 +207,62 @@ class BandwidthStats:
          "circuit "+event.id+" on it.")
 
   def any_circuits_pending(self, except_id=None):
-    for c in self.circs.values():
-      if not c.built and c.circ_id != except_id:
-        return True
-    return False # All circuits in use
+    return self.registry.any_circuits_pending(except_id)
 
-  def circ_event(self, event):
+  def _circs_resumed(self, event):
+    if self.disconnected_circs:
+      disconnected_secs = event.arrived_at - self.no_circs_since
+      plog("NOTICE", "Circuit use resumed after %d seconds.",
+           disconnected_secs)
+    self.no_circs_since = None
+    self.disconnected_circs = False
+
+  def circ_added_event(self, event):
+    self._schedule_age_check(self.circs[event.id])
+    plog("DEBUG", "Added circ for "+event.raw_content())
+
+  def circ_closed_event(self, event):
     # Failed circuits mean the network could be down:
     if event.status == stem.CircStatus.FAILED and \
       not self.no_circs_since and self.any_circuits_pending(event.id):
       self.no_circs_since = event.arrived_at
 
-    # Sometimes circuits get multiple FAILED+CLOSED events,
-    # so we must check that first...
-    if (event.status == stem.CircStatus.FAILED or \
-       event.status == stem.CircStatus.CLOSED):
-      if event.id in self.circs:
-        # If the circuit was in use, and possibly closed due to a guard
-        # connection closure recently, and this event says it died due to
-        # a channel closure, then record that.
-        if self.circs[event.id].in_use and \
-           self.circs[event.id].possibly_destroyed_at:
-          if event.arrived_at - self.circs[event.id].possibly_destroyed_at \
-                <= _MAX_CIRC_DESTROY_LAG_SECS and \
-             event.remote_reason == "CHANNEL_CLOSED":
-            self.circuit_destroyed(event)
-          else:
-            plog("INFO",
-                 "Circuit %s possibly destroyed, but outside of the time window (%d - %d)",
-                 event.id, event.arrived_at, self.circs[event.id].possibly_destroyed_at)
-        plog("DEBUG", "Closed hs circ for "+event.raw_content())
-        del self.circs[event.id]
-      return
-
-    if event.id not in self.circs:
-      self.circs[event.id] = BwCircuitStat(event.id,
-                        event.hs_state or event.purpose[0:2] == "HS")
-
-      # Handle direct build purpose settings
-      if event.purpose[0:9] == "HS_CLIENT":
-        self.circs[event.id].is_service = 0
-      elif event.purpose[0:10] == "HS_SERVICE":
-        self.circs[event.id].is_service = 1
-      if event.purpose == "HS_CLIENT_HSDIR" or \
-         event.purpose == "HS_SERVICE_HSDIR":
-        self.circs[event.id].is_hsdir = 1
-      elif event.purpose == "HS_SERVICE_INTRO":
-        self.circs[event.id].is_serv_intro = 1
-      plog("DEBUG", "Added circ for "+event.raw_content())
-
-    # Debugging
-    self.circs[event.id].purpose = event.purpose
-    self.circs[event.id].hs_state = event.hs_state
-
-    # Consider all BUILT circs that have a specific HS purpose
-    # to be "in_use".
-    if event.status == stem.CircStatus.BUILT or \
-       event.status == "GUARD_WAIT":
-      self.circs[event.id].built = 1
-
-      if self.disconnected_circs:
-        disconnected_secs = event.arrived_at - self.no_circs_since
-        plog("NOTICE", "Circuit use resumed after %d seconds.",
-             disconnected_secs)
-      self.no_circs_since = None
-      self.disconnected_circs = False
-
-      if event.purpose[0:9] == "HS_CLIENT" or \
-         event.purpose[0:10] == "HS_SERVICE":
-        self.circs[event.id].in_use = 1
-        self.circs[event.id].guard_fp = event.path[0][0]
-        plog("DEBUG", "Circ "+event.id+" now in-use. %d delivered bytes.",
-             self.circs[event.id].delivered_read_bytes)
-    # Extending a circuit means the network is OK
-    elif event.status == "EXTENDED":
-      if self.disconnected_circs:
-        disconnected_secs = event.arrived_at - self.no_circs_since
-        plog("NOTICE", "Circuit use resumed after %d seconds.",
-             disconnected_secs)
-      self.no_circs_since = None
-      self.disconnected_circs = False
-
-  # We need CIRC_MINOR to determine client from service as well
-  # as recognize cannibalized HSDIR circs
-  def circ_minor_event(self, event):
-    if event.id not in self.circs:
-      return
-
-    self.circs[event.id].purpose = event.purpose
-    self.circs[event.id].hs_state = event.hs_state
-    self.circs[event.id].old_purpose = event.old_purpose
-    self.circs[event.id].old_hs_state = event.old_hs_state
-
-    if event.purpose[0:9] == "HS_CLIENT":
-      self.circs[event.id].is_service = 0
-    elif event.purpose[0:10] == "HS_SERVICE":
-      self.circs[event.id].is_service = 1
-    if event.purpose == "HS_CLIENT_HSDIR" or \
-       event.purpose == "HS_SERVICE_HSDIR":
-      self.circs[event.id].is_hsdir = 1
-    elif event.purpose == "HS_SERVICE_INTRO":
-      self.circs[event.id].is_serv_intro = 1
-
-    # PURPOSE_CHANGED from HS_VANGUARDS -> in_use
-    if event.event == stem.CircEvent.PURPOSE_CHANGED:
-      if event.old_purpose == "HS_VANGUARDS":
-        self.circs[event.id].in_use = 1
-        self.circs[event.id].guard_fp = event.path[0][0]
-        plog("DEBUG", "Circ "+event.id+" now in-use. %d delivered bytes.",
-             self.circs[event.id].delivered_read_bytes)
-
-    plog("DEBUG", event.raw_content())
+    # Sometimes circuits get multiple FAILED+CLOSED events, and the
+    # registry only still has the circuit for the first one.
+    circ = self.circs.get(event.id)
+    if circ:
+      # If the circuit was in use, and possibly closed due to a guard
+      # connection closure recently, and this event says it died due to
+      # a channel closure, then record that.
+      if circ.in_use and circ.possibly_destroyed_at:
+        if event.arrived_at - circ.possibly_destroyed_at \
+              <= _MAX_CIRC_DESTROY_LAG_SECS and \
+           event.remote_reason == "CHANNEL_CLOSED":
+          self.circuit_destroyed(event)
+        else:
+          plog("INFO",
+               "Circuit %s possibly destroyed, but outside of the time window (%d - %d)",
+               event.id, event.arrived_at, circ.possibly_destroyed_at)
+      plog("DEBUG", "Closed hs circ for "+event.raw_content())
+
+  def circ_built_event(self, event):
+    self._circs_resumed(event)
+
+  # Extending a circuit means the network is OK
+  def circ_extended_event(self, event):
+    self._circs_resumed(event)
 
   def circbw_event(self, event):
     # Circuit bandwidth means circuits are working
-    if self.disconnected_circs:
-      disconnected_secs = event.arrived_at - self.no_circs_since
-      plog("NOTICE", "Circuit use resumed after %d seconds.",
-           disconnected_secs)
-    self.no_circs_since = None
-    self.disconnected_circs = False
+    self._circs_resumed(event)
 
     if event.id in self.circs:
       plog("DEBUG", event.raw_content())
-      delivered_read = int(event.keyword_args["DELIVERED_READ"])
-      delivered_written = int(event.keyword_args["DELIVERED_WRITTEN"])
-      overhead_read = int(event.keyword_args["OVERHEAD_READ"])
-      overhead_written = int(event.keyword_args["OVERHEAD_WRITTEN"])
+      # These are ints from both stem (1.7.0+) and fastevents
+      delivered_read = event.delivered_read
+      delivered_written = event.delivered_written
+      overhead_read = event.overhead_read
+      overhead_written = event.overhead_written
 
       if delivered_read + overhead_read > event.read*_CELL_DATA_RATE:
         plog("ERROR",
@@ -378,28 +318,53 @@ class BandwidthStats:
     elif event.status == "DOWN":
       self.network_down_since = event.arrived_at
 
+  def _schedule_age_check(self, circ):
+    if len(self.circ_ages) > 2*len(self.circs) + 100:
+      self.circ_ages = [(c.created_at, c.circ_id) for c in self.circs.values()
+                        if c is not circ]
+      heapq.heapify(self.circ_ages)
+    heapq.heappush(self.circ_ages, (circ.created_at, circ.circ_id))
+
+  # Unused except to expire circuits -- 1x/sec. Only the circuits that are
+  # due get looked at.
   def check_circ_ages(self, now):
     if CIRC_MAX_AGE_HOURS <= 0:
       return
 
-    # Unused except to expire circuits -- 1x/sec
-    # FIXME: This is needless copying on python 2..
-    kill_circs = list(filter(
-                        lambda c: now - c.created_at > \
-                                  CIRC_MAX_AGE_HOURS*_SECS_PER_HOUR,
-                        self.circs.values()))
-    for circ in kill_circs:
-      control.try_close_circuit(self.controller, circ.circ_id)
-      self.limit_exceeded("NOTICE", "CIRC_MAX_AGE_HOURS",
-                          circ.circ_id,
-                          (now - circ.created_at)/_SECS_PER_HOUR,
-                          CIRC_MAX_AGE_HOURS)
+    max_age = CIRC_MAX_AGE_HOURS*_SECS_PER_HOUR
+    created_before = now - max_age
+    retries = []
+    while self.circ_ages and self.circ_ages[0][0] < created_before:
+      (created_at, circ_id) = heapq.heappop(self.circ_ages)
+      circ = self.circs.get(circ_id)
+      if circ is None or circ.created_at >= created_before:
+        continue # Closed, or its id got reused by a newer circuit
+
+      # Check it again in a bit, in case closing it fails. Once its CLOSED
+      # event comes, the entry gets skipped.
+      retries.append((now + _CLOSE_RETRY_SECS - max_age, circ_id))
+      if created_at != circ.created_at:
+        plog("INFO", "Circ "+str(circ_id)+" is still open. Closing it again.")
+      else:
+        self.limit_exceeded("NOTICE", "CIRC_MAX_AGE_HOURS",
+                            circ.circ_id,
+                            (now - circ.created_at)/_SECS_PER_HOUR,
+                            CIRC_MAX_AGE_HOURS)
+      try:
+        control.try_close_circuit(self.controller, circ.circ_id)
+      except stem.ControllerError as e:
+        plog("NOTICE", "Can't close old circ "+str(circ_id)+" ("+str(e)+
+             "). Trying again in "+str(_CLOSE_RETRY_SECS)+" seconds.")
+
+    for entry in retries:
+      heapq.heappush(self.circ_ages, entry)
 
   # Used for 1x/sec heartbeat only
   def bw_event(self, event):
     now = time.time()
     self.check_connectivity(event.arrived_at)
-    self.check_circ_ages(now)
+    if self.check_ages_on_bw:
+      self.check_circ_ages(now)
 
   def check_circuit_limits(self, circ):
     if circ.dropped_read_cells() > circ.dropped_cells_allowed:
@@ -1,17 +1,22 @@
 """ This code monitors the circuit build timeout. It is non-essential """
 from .logger import plog
 
-class CircuitStat:
-  def __init__(self, circ_id, is_hs):
-    self.circ_id = circ_id
-    self.is_hs = is_hs
+from . import circuits
+
+from .circuits import is_hs_event
 
 class TimeoutStats:
-  def __init__(self):
-    self.circuits = {}
+  def __init__(self, registry=None):
+    if registry is None:
+      registry = circuits.CircuitRegistry()
+    self.registry = registry
     self.zero_fields()
     self.record_timeouts = True
 
+    registry.add_listener(circuits.CIRC_ADDED, self.circ_added_event)
+    registry.add_listener(circuits.CIRC_BUILT, self.circ_built_event)
+    registry.add_listener(circuits.CIRC_CLOSED, self.circ_closed_event)
+
   def zero_fields(self):
     self.all_launched = 0
     self.all_built = 0
@@ -20,41 +25,68 @@ class TimeoutStats:
     self.hs_built = 0
     self.hs_timeout = 0
 
-  def circ_event(self, event):
-    is_hs = event.hs_state or event.purpose[0:2] == "HS"
-
-    if is_hs and event.id in self.circuits and \
-      self.circuits[event.id].is_hs != is_hs:
+  # Stages of circuits:
+  # LAUNCHED -> BUILT
+  #             BUILT -> EXTENDED -> FINISHED
+  #             BUILT -> EXTENDED -> FAILED
+  #             BUILT -> EXTENDED -> TIMEOUT
+  # LAUNCHED -> TIMEOUT
+  #             TIMEOUT -> MEASURED
+  #                        MEASURED -> FINSHED
+  #                        MEASURED -> EXPIRED
+  # LAUNCHED -> FAILED
+  # LAUNCHED -> CLOSED
+  #             FAILED -> CLOSED
+  #             TIMEOUT -> CLOSED
+  #
+  # Only circuits that we saw launch while we were recording get
+  # build_timed set. It gets cleared once they are built, timed out,
+  # or closed.
+  def _timed_circ(self, event):
+    circ = self.registry.circs.get(event.id)
+
+    if circ and not circ.is_hs and is_hs_event(event):
       plog("ERROR", "Circuit "+event.id+" just changed from non-HS to HS: "\
                    +event.raw_content())
 
     # Do not record circuits built while we have no timeout
     # (ie: after reset but before computed)
-    if not self.record_timeouts:
+    if not self.record_timeouts or not circ or not circ.build_timed:
+      return None
+    return circ
+
+  def circ_added_event(self, event):
+    if not self.record_timeouts or event.status != "LAUNCHED":
+      return
+
+    circ = self.registry.circs[event.id]
+    circ.build_timed = 1
+    self.all_launched += 1
+    if circ.is_hs: self.hs_launched += 1
+
+  def circ_built_event(self, event):
+    circ = self._timed_circ(event)
+    if not circ or event.status != "BUILT":
       return
 
-    # Stages of circuits:
-    # LAUNCHED -> BUILT
-    #             BUILT -> EXTENDED -> FINISHED
-    #             BUILT -> EXTENDED -> FAILED
-    #             BUILT -> EXTENDED -> TIMEOUT
-    # LAUNCHED -> TIMEOUT
-    #             TIMEOUT -> MEASURED
-    #                        MEASURED -> FINSHED
-    #                        MEASURED -> EXPIRED
-    # LAUNCHED -> FAILED
-    # LAUNCHED -> CLOSED
-    #             FAILED -> CLOSED
-    #             TIMEOUT -> CLOSED
-    if event.status == "LAUNCHED":
-      self.add_circuit(event.id, is_hs)
-    elif event.status == "BUILT":
-      self.built_circuit(event.id)
-    elif event.reason == "TIMEOUT":
-      self.timeout_circuit(event.id)
-    elif event.purpose != "MEASURE_TIMEOUT" and \
-         (event.status == "CLOSED" or event.status == "FAILED"):
-      self.closed_circuit(event.id)
+    self.all_built += 1
+    if circ.is_hs: self.hs_built += 1
+    circ.build_timed = 0
+
+  def circ_closed_event(self, event):
+    circ = self._timed_circ(event)
+    if not circ:
+      return
+
+    if event.reason == "TIMEOUT":
+      self.all_timeout += 1
+      if circ.is_hs: self.hs_timeout += 1
+    elif event.purpose != "MEASURE_TIMEOUT":
+      # If we are closed but still timed, then we closed before being
+      # built or timing out. Don't count as a launched circ
+      self.all_launched -= 1
+      if circ.is_hs: self.hs_launched -= 1
+    circ.build_timed = 0
 
   def cbt_event(self, event):
     # TODO: Check if this is too high...
@@ -68,37 +100,6 @@ class TimeoutStats:
       self.record_timeouts = False
       self.zero_fields()
 
-
-  def add_circuit(self, circ_id, is_hs):
-    if circ_id in self.circuits:
-      plog("ERROR", "Circuit "+circ_id+" already exists in map!")
-    self.circuits[circ_id] = CircuitStat(circ_id, is_hs)
-    self.all_launched += 1
-    if is_hs: self.hs_launched += 1
-
-  def built_circuit(self, circ_id):
-    if circ_id in self.circuits:
-      self.all_built += 1
-      if self.circuits[circ_id].is_hs:
-        self.hs_built += 1
-      del self.circuits[circ_id]
-
-  def closed_circuit(self, circ_id):
-    # If we are closed but still in circuits, then we closed
-    # before being built or timing out. Don't count as a launched circ
-    if circ_id in self.circuits:
-      self.all_launched -= 1
-      if self.circuits[circ_id].is_hs:
-        self.hs_launched -= 1
-      del self.circuits[circ_id]
-
-  def timeout_circuit(self, circ_id):
-    if circ_id in self.circuits:
-      self.all_timeout += 1
-      if self.circuits[circ_id].is_hs:
-        self.hs_timeout += 1
-      del self.circuits[circ_id]
-
   def timeout_rate_all(self):
     if self.all_launched:
       return float(self.all_timeout)/(self.all_launched)
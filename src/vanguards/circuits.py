@@ -0,0 +1,191 @@
+""" Shared circuit registry, so circuit events are only classified once """
+import time
+import stem
+
+from .logger import plog
+
+############ Circuit transitions ###############
+#
+# Components subscribe to one or more of these transitions instead of
+# registering their own CIRC or CIRC_MINOR listener with stem.
+
+# The first CIRC event we see for a circuit
+CIRC_ADDED = "ADDED"
+
+# BUILT or GUARD_WAIT
+CIRC_BUILT = "BUILT"
+
+CIRC_EXTENDED = "EXTENDED"
+
+# CLOSED or FAILED. Note that tor may send both for the same circuit.
+# The circuit is still in the registry while this transition is delivered.
+CIRC_CLOSED = "CLOSED"
+
+# Every CIRC_MINOR event
+CIRC_MINOR = "MINOR"
+
+_CIRC_TRANSITIONS = [CIRC_ADDED, CIRC_BUILT, CIRC_EXTENDED, CIRC_CLOSED]
+_CIRC_MINOR_TRANSITIONS = [CIRC_MINOR]
+
+def is_hs_event(event):
+  return bool(event.hs_state or event.purpose[0:2] == "HS")
+
+class CircuitInfo:
+  def __init__(self, circ_id, is_hs):
+    self.circ_id = circ_id
+    self.is_hs = is_hs
+    self.is_service = 1
+    self.is_hsdir = 0
+    self.is_serv_intro = 0
+    self.purpose = None
+    self.hs_state = None
+    self.old_purpose = None
+    self.old_hs_state = None
+    self.in_use = 0
+    self.built = 0
+    self.created_at = time.time()
+    self.guard_fp = None
+    # Set by cbtverify while it waits for this circ to build or time out
+    self.build_timed = 0
+
+  def classify(self, purpose):
+    "Update the purpose-derived flags of this circuit"
+    if purpose[0:9] == "HS_CLIENT":
+      self.is_service = 0
+    elif purpose[0:10] == "HS_SERVICE":
+      self.is_service = 1
+    if purpose == "HS_CLIENT_HSDIR" or \
+       purpose == "HS_SERVICE_HSDIR":
+      self.is_hsdir = 1
+    elif purpose == "HS_SERVICE_INTRO":
+      self.is_serv_intro = 1
+
+class CircuitRegistry:
+  def __init__(self, wrap_listener=None):
+    self.circs = {} # key=circid val=CircuitInfo (or circ_class)
+    # Components that keep per-circuit stats can set a CircuitInfo
+    # subclass here, before any circuits get tracked.
+    self.circ_class = CircuitInfo
+    # The in-use circuits on each guard, so that we don't have to scan every
+    # circuit when a guard connection closes.
+    self.in_use_circs = {} # key=guardfp val=set of circids
+    self.pending_circs = 0 # Circuits in self.circs that aren't built yet
+    self.listeners = {} # key=transition val=list of funcs
+    # Optional func(listener, prefix) that returns a wrapped listener
+    self.wrap_listener = wrap_listener
+
+  def add_listener(self, transition, func):
+    if transition not in _CIRC_TRANSITIONS and \
+       transition not in _CIRC_MINOR_TRANSITIONS:
+      raise ValueError("Unknown circuit transition: "+str(transition))
+
+    if self.wrap_listener:
+      func = self.wrap_listener(func, "CIRC "+transition+": ")
+    if transition not in self.listeners:
+      self.listeners[transition] = []
+    self.listeners[transition].append(func)
+
+  def attach(self, controller):
+    """Registers our CIRC and CIRC_MINOR listeners with 'controller', if
+    any component subscribed to circuit transitions. We need CIRC_MINOR
+    for any of them, to track repurposed circuits."""
+    if not self.listeners:
+      return
+    controller.add_event_listener(self.circ_event,
+                                  stem.control.EventType.CIRC)
+    controller.add_event_listener(self.circ_minor_event,
+                                  stem.control.EventType.CIRC_MINOR)
+
+  def _emit(self, transition, event):
+    # Exceptions propagate to stem, just like from any other listener
+    for func in self.listeners.get(transition, ()):
+      func(event)
+
+  def any_circuits_pending(self, except_id=None):
+    pending = self.pending_circs
+    if except_id in self.circs and not self.circs[except_id].built:
+      pending -= 1
+    return pending > 0
+
+  def _mark_in_use(self, circ, guard_fp):
+    if circ.in_use:
+      return
+    circ.in_use = 1
+    circ.guard_fp = guard_fp
+    if guard_fp not in self.in_use_circs:
+      self.in_use_circs[guard_fp] = set()
+    self.in_use_circs[guard_fp].add(circ.circ_id)
+    plog("DEBUG", "Circ "+circ.circ_id+" now in-use.")
+
+  def _remove_circ(self, circ_id):
+    circ = self.circs.pop(circ_id)
+    if not circ.built:
+      self.pending_circs -= 1
+    circs = self.in_use_circs.get(circ.guard_fp)
+    if circ.in_use and circs is not None:
+      circs.discard(circ_id)
+      if not circs:
+        del self.in_use_circs[circ.guard_fp]
+
+  def circ_event(self, event):
+    # Sometimes circuits get multiple FAILED+CLOSED events,
+    # so closed circs are not tracked any further
+    if event.status == stem.CircStatus.FAILED or \
+       event.status == stem.CircStatus.CLOSED:
+      self._emit(CIRC_CLOSED, event)
+      if event.id in self.circs:
+        self._remove_circ(event.id)
+      return
+
+    circ = self.circs.get(event.id)
+    # A launch always starts a new circuit, even if we missed the close
+    # of an old one with the same id
+    if circ and event.status == stem.CircStatus.LAUNCHED:
+      self._remove_circ(event.id)
+      circ = None
+
+    added = circ is None
+    if added:
+      circ = self.circ_class(event.id, is_hs_event(event))
+      self.circs[event.id] = circ
+      self.pending_circs += 1
+
+    circ.purpose = event.purpose
+    circ.hs_state = event.hs_state
+    circ.classify(event.purpose)
+
+    if added:
+      self._emit(CIRC_ADDED, event)
+
+    # Consider all BUILT circs that have a specific HS purpose
+    # to be "in_use".
+    if event.status == stem.CircStatus.BUILT or \
+       event.status == "GUARD_WAIT":
+      if not circ.built:
+        self.pending_circs -= 1
+        circ.built = 1
+
+      if event.purpose[0:9] == "HS_CLIENT" or \
+         event.purpose[0:10] == "HS_SERVICE":
+        self._mark_in_use(circ, event.path[0][0])
+      self._emit(CIRC_BUILT, event)
+    elif event.status == stem.CircStatus.EXTENDED:
+      self._emit(CIRC_EXTENDED, event)
+
+  # We need CIRC_MINOR to determine client from service as well
+  # as recognize cannibalized HSDIR circs
+  def circ_minor_event(self, event):
+    circ = self.circs.get(event.id)
+    if circ:
+      circ.purpose = event.purpose
+      circ.hs_state = event.hs_state
+      circ.old_purpose = event.old_purpose
+      circ.old_hs_state = event.old_hs_state
+      circ.classify(event.purpose)
+
+      # PURPOSE_CHANGED from HS_VANGUARDS -> in_use
+      if event.event == stem.CircEvent.PURPOSE_CHANGED and \
+         event.old_purpose == "HS_VANGUARDS":
+        self._mark_in_use(circ, event.path[0][0])
+
+    self._emit(CIRC_MINOR, event)
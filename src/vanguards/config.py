@@ -51,6 +51,30 @@ ONE_SHOT_VANGUARDS = False
 
 CLOSE_CIRCUITS = True
 
+# Parse CIRC and CIRC_BW events with our own minimal parser instead of stem
+ENABLE_FASTEVENTS = False
+
+# Run components in worker processes, fed from one control connection
+ENABLE_WORKERS = False
+
+# Run our handlers and timers on an asyncio loop (Python 3 only)
+ENABLE_ASYNCIO = False
+
+# Process new consensuses on a background thread, so that circuit and
+# bandwidth events don't wait for them
+ENABLE_BACKGROUND_CONSENSUS = True
+
+# Append all events from tor to this compressed trace file, for replay
+RECORD_EVENTS = ""
+
+# Time each event handler, and report every INSTRUMENT_REPORT_SECS
+ENABLE_INSTRUMENTATION = False
+
+INSTRUMENT_REPORT_SECS = 60
+
+# Also append each report to this file, as a line of JSON
+INSTRUMENT_DUMP_FILE = ""
+
 CONTROL_IP = "127.0.0.1"
 CONTROL_PORT = ""
 CONTROL_SOCKET = ""
@@ -63,7 +87,7 @@ def setup_options():
   global ENABLE_BANDGUARDS, ENABLE_RENDGUARD, ENABLE_LOGGUARD, ENABLE_CBTVERIFY
   global ENABLE_PATHVERIFY
   global LOGLEVEL, LOGFILE
-  global ONE_SHOT_VANGUARDS, ENABLE_VANGUARDS
+  global ONE_SHOT_VANGUARDS, ENABLE_VANGUARDS, ENABLE_WORKERS
 
   parser = argparse.ArgumentParser()
 
@@ -138,17 +162,25 @@ def setup_options():
                       help="Enable path selection monitoring")
   parser.set_defaults(pathverify_enabled=ENABLE_PATHVERIFY)
 
+  parser.add_argument("--workers", dest="workers_enabled",
+                      action="store_true",
+                      help="Run components in parallel worker processes "+
+                      "(may help performance)")
+  parser.set_defaults(workers_enabled=ENABLE_WORKERS)
+
   options = parser.parse_args()
 
   (STATE_FILE, CONTROL_IP, CONTROL_PORT, CONTROL_SOCKET, CONTROL_PASS,
    ENABLE_BANDGUARDS, ENABLE_RENDGUARD, ENABLE_LOGGUARD, ENABLE_CBTVERIFY,
-   ENABLE_PATHVERIFY, ONE_SHOT_VANGUARDS, ENABLE_VANGUARDS) = \
+   ENABLE_PATHVERIFY, ONE_SHOT_VANGUARDS, ENABLE_VANGUARDS,
+   ENABLE_WORKERS) = \
       (options.state_file, options.control_ip, options.control_port,
        options.control_socket, options.control_pass,
        options.bandguards_enabled, options.rendguard_enabled,
        options.logguard_enabled,
        options.cbtverify_enabled, options.pathverify_enabled,
-       options.one_shot_vanguards, options.vanguards_enabled)
+       options.one_shot_vanguards, options.vanguards_enabled,
+       options.workers_enabled)
 
   if options.loglevel != None:
     LOGLEVEL = options.loglevel
@@ -208,6 +240,20 @@ def set_options_from_module(config, module, section):
       val = getattr(module, param)
       config.set(section, param, str(val))
 
+# Options we no longer use, by section, and what replaced them
+_DEPRECATED_OPTIONS = {
+  "Rendguard": {
+    "rend_use_scale_at_count": "Use counts now decay by half every "+
+                               "rend_use_half_life_hours instead."
+  }
+}
+
+def warn_deprecated_options(config):
+  for section in _DEPRECATED_OPTIONS:
+    for (option, msg) in _DEPRECATED_OPTIONS[section].items():
+      if config.has_option(section, option):
+        plog("WARN", "The "+option+" option is no longer used. "+msg)
+
 def generate_config():
   config = SafeConfigParser(allow_no_value=True)
   set_options_from_module(config, sys.modules[__name__], "Global")
@@ -228,6 +274,7 @@ def apply_config(config_file):
   get_options_for_module(config, bandguards, "Bandguards")
   get_options_for_module(config, rendguard, "Rendguard")
   get_options_for_module(config, rendguard, "Logguard")
+  warn_deprecated_options(config)
 
   # Special cased CLOSE_CIRCUITS option has to be transfered
   # to the control.py module
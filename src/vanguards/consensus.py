@@ -0,0 +1,173 @@
+""" Streaming reader for Tor's cached-microdesc-consensus file.
+
+    Vanguards only needs a few fields of each router status entry, and the
+    bandwidth-weights footer. Reading them ourselves from the consensus file
+    in one pass avoids both fetching every router over the control port with
+    GETINFO ns/all, and a second full stem parse of the file for the weights.
+"""
+import base64
+import binascii
+import mmap
+
+_HEADER = "network-status-version 3 microdesc"
+
+# Bit for each router flag. Flags that tor adds later get the next free bit
+# when we first see them.
+FLAG_BITS = {}
+for _flag in ["Authority", "BadExit", "Exit", "Fast", "Guard", "HSDir",
+              "MiddleOnly", "NoEdConsensus", "Running", "Stable",
+              "StaleDesc", "Sybil", "V2Dir", "Valid"]:
+  FLAG_BITS[_flag] = 1 << len(FLAG_BITS)
+
+_FLAG_NAMES = {} # key=mask val=tuple of flag names, shared by all routers
+
+def flag_mask(flags):
+  "Returns the bitmask for the flag names in 'flags'"
+  mask = 0
+  for f in flags:
+    if f not in FLAG_BITS:
+      FLAG_BITS[f] = 1 << len(FLAG_BITS)
+    mask |= FLAG_BITS[f]
+  return mask
+
+def flag_names(mask):
+  "Returns the flag names in 'mask', as a tuple in bit order"
+  if mask not in _FLAG_NAMES:
+    _FLAG_NAMES[mask] = tuple(f for f in sorted(FLAG_BITS,
+                                                key=FLAG_BITS.get)
+                              if FLAG_BITS[f] & mask)
+  return _FLAG_NAMES[mask]
+
+class ConsensusRouter:
+  """The parts of a router status entry that we use. The attributes that
+  stem's RouterStatusEntry also has are named the same. 'measured' is the
+  consensus bandwidth (0 if it has none), and flags are stored as a
+  bitmask."""
+  __slots__ = ("fingerprint", "nickname", "address", "or_port",
+               "or_addresses", "flag_mask", "measured")
+
+  def __init__(self, fingerprint, nickname, address, or_port):
+    self.fingerprint = fingerprint
+    self.nickname = nickname
+    self.address = address
+    self.or_port = or_port
+    self.or_addresses = () # Shared while empty, which it nearly always is
+    self.flag_mask = 0
+    self.measured = None
+
+  def _get_flags(self):
+    return flag_names(self.flag_mask)
+
+  def _set_flags(self, flags):
+    self.flag_mask = flag_mask(flags)
+
+  flags = property(_get_flags, _set_flags)
+
+def compact_router(r):
+  "Returns a ConsensusRouter for the stem RouterStatusEntry 'r'"
+  router = ConsensusRouter(r.fingerprint, r.nickname, r.address, r.or_port)
+  if r.or_addresses:
+    router.or_addresses = list(r.or_addresses)
+  router.flags = r.flags
+  router.measured = r.measured if r.measured != None else r.bandwidth
+  if router.measured == None:
+    router.measured = 0 # No w line
+  return router
+
+def compact_routers(routers):
+  """Returns 'routers' as ConsensusRouters, converting any stem entries.
+  We don't keep stem's entries around, since they hold every field of the
+  consensus."""
+  return [r if isinstance(r, ConsensusRouter) else compact_router(r)
+          for r in routers]
+
+def _parse_r_line(line):
+  # r nickname identity published-date published-time address orport dirport
+  parts = line.split(" ")
+  if len(parts) < 8:
+    raise ValueError("Malformed r line: "+line)
+  identity = parts[2]
+  identity += "="*(-len(identity) % 4)
+  fingerprint = binascii.hexlify(base64.b64decode(identity)).decode("ascii")
+  return ConsensusRouter(fingerprint.upper(), parts[1], parts[5],
+                         int(parts[6]))
+
+def _parse_a_line(router, line):
+  # a address:port, with IPv6 addresses in brackets
+  (address, port) = line[2:].rsplit(":", 1)
+  is_ipv6 = address.startswith("[")
+  if not router.or_addresses:
+    router.or_addresses = []
+  router.or_addresses.append((address.strip("[]"), int(port), is_ipv6))
+
+def _parse_w_line(router, line):
+  # Measured= wins over Bandwidth=, whichever order they come in
+  for entry in line[2:].split(" "):
+    if entry.startswith("Bandwidth=") and router.measured == None:
+      router.measured = int(entry[10:])
+    elif entry.startswith("Measured="):
+      router.measured = int(entry[9:])
+
+def _parse_weights(line):
+  weights = {}
+  for entry in line.split(" ")[1:]:
+    (key, val) = entry.split("=", 1)
+    weights[key] = int(val)
+  return weights
+
+def _lines(consensus_file):
+  with open(consensus_file, "rb") as f:
+    # mmap refuses empty files with a ValueError, which is what we raise
+    # for any other unusable consensus too.
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      line = data.readline()
+      while line:
+        yield line.rstrip(b"\r\n").decode("utf-8")
+        line = data.readline()
+    finally:
+      data.close()
+
+def read_consensus(consensus_file):
+  """Reads 'consensus_file' in one pass. Returns a list of ConsensusRouters
+  and the bandwidth-weights footer, as a dict like stem's.
+
+  Raises IOError or OSError if the file can't be read, and ValueError if it
+  isn't a complete microdesc consensus."""
+  routers = []
+  weights = None
+  router = None
+  first = True
+
+  for line in _lines(consensus_file):
+    if first:
+      if line != _HEADER:
+        raise ValueError(consensus_file+" is not a microdesc consensus")
+      first = False
+      continue
+
+    keyword = line.split(" ", 1)[0]
+    if keyword == "r":
+      router = _parse_r_line(line)
+      routers.append(router)
+    elif keyword == "directory-footer":
+      router = None
+    elif keyword == "bandwidth-weights":
+      weights = _parse_weights(line)
+    elif router is None:
+      continue
+    elif keyword == "s":
+      router.flag_mask = flag_mask(line.split(" ")[1:])
+    elif keyword == "w":
+      _parse_w_line(router, line)
+    elif keyword == "a":
+      _parse_a_line(router, line)
+
+  if weights is None:
+    raise ValueError(consensus_file+" has no bandwidth-weights")
+
+  # Routers without a w line don't get chosen
+  for router in routers:
+    if router.measured == None:
+      router.measured = 0
+  return (routers, weights)
@@ -0,0 +1,226 @@
+""" Event trace recording and replay.
+
+    The recorder appends every raw event tor sends us, with its arrival
+    time, to a gzip-compressed trace file. Traces can later be replayed
+    through our components, either as fast as possible or at their
+    original pace, to measure event throughput and per-handler CPU time.
+
+    Trace records are a header line of "<kind> <timestamp> <length>",
+    followed by <length> bytes of payload. Kind "V" is the tor version at
+    the time of recording, and "E" is a raw event. Each recording session
+    is its own gzip member, which gzip readers treat as one stream.
+"""
+import gzip
+import time
+import zlib
+
+import stem
+import stem.response
+import stem.version
+
+from stem.response import ControlMessage
+
+from . import config
+from . import fastevents
+
+from .instrument import handler_name
+from .logger import plog
+
+# Flush the gzip stream at least this often, so a crash doesn't take
+# much of the trace with it.
+_FLUSH_SECS = 10
+
+# These need tor's DataDirectory, and would have us rewrite the torrc.
+_SKIP_EVENTS = ["NEWCONSENSUS", "SIGNAL"]
+
+try:
+  _cpu_time = time.process_time
+except AttributeError:
+  _cpu_time = time.clock
+
+def _write_record(outfile, kind, timestamp, payload):
+  payload = payload.encode("utf-8")
+  outfile.write(("%s %.6f %d\n" % (kind, timestamp, len(payload))).encode("ascii"))
+  outfile.write(payload)
+
+class EventRecorder:
+  def __init__(self, trace_file, controller):
+    self.controller = controller
+    self.outfile = gzip.open(trace_file, "ab")
+    self.last_flush = time.time()
+    self.stem_handler = controller._handle_event
+    _write_record(self.outfile, "V", time.time(),
+                  str(controller.get_version()))
+
+  def start(self):
+    self.controller._handle_event = self.handle_event
+
+  def handle_event(self, event_message):
+    try:
+      _write_record(self.outfile, "E", event_message.arrived_at,
+                    event_message.raw_content())
+      if event_message.arrived_at - self.last_flush > _FLUSH_SECS:
+        self.outfile.flush(zlib.Z_SYNC_FLUSH)
+        self.last_flush = event_message.arrived_at
+    except (IOError, ValueError) as e:
+      plog("WARN", "Can't record event: "+str(e))
+
+    return self.stem_handler(event_message)
+
+  def close(self):
+    self.controller._handle_event = self.stem_handler
+    self.outfile.close()
+
+def read_trace(trace_file):
+  """Yields (kind, timestamp, payload) for each record in 'trace_file'.
+  A truncated final record (ie: from a crash) is ignored."""
+  infile = gzip.open(trace_file, "rb")
+  try:
+    while True:
+      try:
+        header = infile.readline()
+      except (EOFError, zlib.error):
+        return
+      if not header:
+        return
+
+      (kind, timestamp, length) = header.decode("ascii").split(" ")
+      try:
+        payload = infile.read(int(length))
+      except (EOFError, zlib.error):
+        return
+      if len(payload) != int(length):
+        return
+      yield (kind, float(timestamp), payload.decode("utf-8"))
+  finally:
+    infile.close()
+
+class ReplayController:
+  """Just enough of stem's Controller for our components to run against a
+  trace. Commands succeed without doing anything, and closed circuits are
+  remembered."""
+  def __init__(self, tor_version):
+    self.tor_version = tor_version
+    self.listeners = {} # key=event type val=list of funcs
+    self.closed_circs = []
+    self._logguard = None
+
+  def add_event_listener(self, func, *events):
+    for ev in events:
+      if ev not in self.listeners:
+        self.listeners[ev] = []
+      self.listeners[ev].append(func)
+
+  def close_circuit(self, circ_id):
+    self.closed_circs.append(circ_id)
+
+  def get_version(self):
+    return self.tor_version
+
+  def get_info(self, key, default=None):
+    if key == "orconn-status":
+      return ""
+    if key == "network-liveness":
+      return "up"
+    return default
+
+  def get_conf(self, key, default=None):
+    return default
+
+  def set_conf(self, key, val):
+    pass
+
+  def signal(self, sig):
+    pass
+
+  def is_alive(self):
+    return True
+
+class ReplayStats:
+  def __init__(self):
+    self.events = 0
+    self.skipped = 0
+    self.wall_secs = 0.0
+    self.parse_cpu_secs = 0.0
+    self.handler_cpu_secs = {} # key=handler name val=cpu secs
+    self.handler_calls = {} # key=handler name val=call count
+    self.closed_circs = []
+
+  def events_per_sec(self):
+    if not self.wall_secs:
+      return 0.0
+    return self.events/self.wall_secs
+
+  def report(self):
+    ret = "Replayed %d events (%d skipped) in %.3fs: %.0f events/sec\n" % \
+          (self.events, self.skipped, self.wall_secs, self.events_per_sec())
+    ret += "  %-45s %10s %10s\n" % ("handler", "calls", "cpu secs")
+    ret += "  %-45s %10s %10.3f\n" % ("(event parsing)", self.events,
+                                     self.parse_cpu_secs)
+    for name in sorted(self.handler_cpu_secs,
+                       key=lambda n: -self.handler_cpu_secs[n]):
+      ret += "  %-45s %10d %10.3f\n" % (name, self.handler_calls[name],
+                                        self.handler_cpu_secs[name])
+    ret += "Would have closed %d circuits: %s" % \
+           (len(self.closed_circs), " ".join(self.closed_circs))
+    return ret
+
+def replay(trace_file, setup_listeners, state, speed=0):
+  """Replays 'trace_file' through the components that setup_listeners()
+  registers, and returns a ReplayStats. If 'speed' is 0, events are
+  replayed as fast as possible. Otherwise, 1 is the original pace, 2 is
+  twice as fast, and so on."""
+  stats = ReplayStats()
+  records = read_trace(trace_file)
+  controller = None
+  first_at = None
+  start = time.time()
+
+  for (kind, timestamp, payload) in records:
+    if kind == "V":
+      if controller is None:
+        controller = ReplayController(stem.version.Version(payload))
+        setup_listeners(controller, state)
+      continue
+
+    if controller is None:
+      raise ValueError("Trace "+trace_file+" has no tor version record")
+
+    if speed:
+      if first_at is None:
+        first_at = timestamp
+      delay = (timestamp - first_at)/speed - (time.time() - start)
+      if delay > 0:
+        time.sleep(delay)
+
+    cpu_start = _cpu_time()
+    event_message = ControlMessage.from_str(payload, arrived_at=timestamp)
+    event = None
+    if config.ENABLE_FASTEVENTS:
+      event = fastevents.parse_event(event_message)
+    if event is None:
+      stem.response.convert("EVENT", event_message)
+      event = event_message
+    stats.parse_cpu_secs += _cpu_time() - cpu_start
+
+    if event.type in _SKIP_EVENTS:
+      stats.skipped += 1
+      continue
+    stats.events += 1
+
+    for func in controller.listeners.get(event.type, []):
+      name = handler_name(func)
+      cpu_start = _cpu_time()
+      try:
+        func(event)
+      except Exception as e:
+        plog("WARN", "Replayed handler "+name+" raised an exception ("+
+             str(e)+"): "+payload)
+      stats.handler_cpu_secs[name] = stats.handler_cpu_secs.get(name, 0.0) \
+                                      + _cpu_time() - cpu_start
+      stats.handler_calls[name] = stats.handler_calls.get(name, 0) + 1
+
+  stats.wall_secs = time.time() - start
+  if controller:
+    stats.closed_circs = controller.closed_circs
+  return stats
@@ -0,0 +1,179 @@
+""" Minimal parser for the high-volume CIRC and CIRC_BW events.
+
+    Stem parses every keyword of every event into a full Event object
+    before our listeners see it. For CIRC_BW and CIRC events, that parsing
+    dominates our CPU use on busy services. This module tokenizes just the
+    fields vanguards reads into compact records that carry the same
+    attribute names as the stem events, so the listeners can consume either.
+
+    Anything unusual (quoted values, multi-line replies, malformed input)
+    is left for stem to parse.
+"""
+from .logger import plog
+
+class CircBwRecord:
+  __slots__ = ('id', 'read', 'written', 'delivered_read', 'delivered_written',
+               'overhead_read', 'overhead_written', 'arrived_at', '_raw')
+  type = "CIRC_BW"
+
+  def __init__(self, raw, arrived_at):
+    self._raw = raw
+    self.arrived_at = arrived_at
+    self.id = None
+    self.read = None
+    self.written = None
+    self.delivered_read = None
+    self.delivered_written = None
+    self.overhead_read = None
+    self.overhead_written = None
+
+  def raw_content(self):
+    return "650 "+self._raw+"\r\n"
+
+class CircRecord:
+  __slots__ = ('id', 'status', 'path', 'purpose', 'hs_state', 'reason',
+               'remote_reason', 'arrived_at', '_raw')
+  type = "CIRC"
+
+  def __init__(self, raw, arrived_at):
+    self._raw = raw
+    self.arrived_at = arrived_at
+    self.id = None
+    self.status = None
+    self.path = ()
+    self.purpose = None
+    self.hs_state = None
+    self.reason = None
+    self.remote_reason = None
+
+  def raw_content(self):
+    return "650 "+self._raw+"\r\n"
+
+_CIRC_BW_INT_KEYWORDS = {
+  "READ" : "read",
+  "WRITTEN" : "written",
+  "DELIVERED_READ" : "delivered_read",
+  "DELIVERED_WRITTEN" : "delivered_written",
+  "OVERHEAD_READ" : "overhead_read",
+  "OVERHEAD_WRITTEN" : "overhead_written",
+}
+
+_CIRC_KEYWORDS = {
+  "PURPOSE" : "purpose",
+  "HS_STATE" : "hs_state",
+  "REASON" : "reason",
+  "REMOTE_REASON" : "remote_reason",
+}
+
+def _parse_path(path):
+  ret = []
+  for entry in path.split(","):
+    if "~" in entry:
+      (fp, nick) = entry.split("~")
+    elif "=" in entry:
+      (fp, nick) = entry.split("=")
+    elif entry[0] == "$":
+      (fp, nick) = (entry, None)
+    else:
+      (fp, nick) = (None, entry)
+
+    if fp is not None:
+      if len(fp) != 41 or fp[0] != "$":
+        return None
+      fp = fp[1:]
+    ret.append((fp, nick))
+  return tuple(ret)
+
+def _is_keyword(token):
+  # Keywords are [A-Za-z0-9_]+=, and positional args (ie: paths)
+  # never start with one of those.
+  eq = token.find("=")
+  return eq > 0 and token[0] != "$" and token[:eq].replace("_", "").isalnum()
+
+def parse_circ_bw(line, arrived_at):
+  "Parses 'CIRC_BW ID=.. READ=..' into a CircBwRecord, or None on failure"
+  ev = CircBwRecord(line, arrived_at)
+  for token in line.split(" ")[1:]:
+    (key, _, value) = token.partition("=")
+    if key == "ID":
+      ev.id = value
+    elif key in _CIRC_BW_INT_KEYWORDS:
+      if not value.isdigit():
+        return None
+      setattr(ev, _CIRC_BW_INT_KEYWORDS[key], int(value))
+
+  if not ev.id or ev.read is None or ev.written is None:
+    return None
+  return ev
+
+def parse_circ(line, arrived_at):
+  "Parses 'CIRC <id> <status> [path] ..' into a CircRecord, or None on failure"
+  tokens = line.split(" ")
+  if len(tokens) < 3:
+    return None
+
+  ev = CircRecord(line, arrived_at)
+  ev.id = tokens[1]
+  ev.status = tokens[2]
+
+  i = 3
+  if len(tokens) > 3 and not _is_keyword(tokens[3]):
+    ev.path = _parse_path(tokens[3])
+    if ev.path is None:
+      return None
+    i = 4
+
+  for token in tokens[i:]:
+    (key, _, value) = token.partition("=")
+    if key in _CIRC_KEYWORDS:
+      setattr(ev, _CIRC_KEYWORDS[key], value)
+    elif not _is_keyword(token):
+      return None # Unexpected positional arg. Let stem deal with it.
+
+  return ev
+
+_PARSERS = {
+  "CIRC_BW" : parse_circ_bw,
+  "CIRC" : parse_circ,
+}
+
+def parse_event(event_message):
+  """Returns a compact record for a CIRC or CIRC_BW ControlMessage, or None
+  if this is some other event or stem should parse it instead."""
+  content = event_message.content()
+  if len(content) != 1:
+    return None
+
+  (code, divider, line) = content[0]
+  if code != "650" or divider != " " or '"' in line:
+    return None
+
+  parser = _PARSERS.get(line[0:line.find(" ")])
+  if not parser:
+    return None
+
+  try:
+    return parser(line, event_message.arrived_at)
+  except (ValueError, IndexError):
+    return None
+
+def _handle_event(controller, stem_handler, event_message):
+  event = parse_event(event_message)
+  if event is None:
+    return stem_handler(event_message)
+
+  with controller._event_listeners_lock:
+    for listener in controller._event_listeners.get(event.type, []):
+      try:
+        listener(event)
+      except Exception as e:
+        plog("WARN", "Event listener raised an exception ("+str(e)+"): "+
+             event.raw_content())
+
+def enable(controller):
+  """Routes CIRC and CIRC_BW events from 'controller' through our fast
+  parser. Everything else still goes through stem."""
+  stem_handler = controller._handle_event
+  controller._handle_event = \
+    lambda event_message: _handle_event(controller, stem_handler,
+                                        event_message)
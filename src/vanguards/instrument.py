@@ -0,0 +1,164 @@
+""" Per-handler timing instrumentation.
+
+    When enabled, every event listener and circuit registry listener is
+    wrapped so that we record its call count, run time, and queue lag (how
+    long the event waited between arriving from tor and being handled).
+    These get logged, and optionally appended to a file as JSON lines,
+    every report interval. Note that stem truncates event arrival times to
+    whole seconds, so lags under a second are only meaningful on average.
+
+    When disabled, nothing is wrapped, so there is no overhead.
+"""
+import json
+import math
+import os
+import time
+
+from .logger import plog
+
+# Histogram resolution: each bucket is a quarter of a power of two
+_BUCKETS_PER_OCTAVE = 4
+
+def handler_name(func):
+  func = getattr(func, "func", func) # functools.partial
+  return getattr(func, "__qualname__", getattr(func, "__name__", str(func)))
+
+def _bucket(secs):
+  usecs = secs*1000000
+  if usecs < 1:
+    return 0
+  return int(math.log(usecs, 2)*_BUCKETS_PER_OCTAVE) + 1
+
+def _bucket_limit(bucket):
+  "Upper bound of 'bucket', in seconds"
+  return 2**(bucket/float(_BUCKETS_PER_OCTAVE))/1000000.0
+
+class Histogram:
+  """Log-scale histogram of durations. Percentiles are accurate to about
+  20%, which is plenty to tell a slow handler from a fast one."""
+  def __init__(self):
+    self.counts = {} # key=bucket val=count
+    self.total = 0
+    self.max = 0.0
+
+  def add(self, secs):
+    b = _bucket(secs)
+    self.counts[b] = self.counts.get(b, 0) + 1
+    self.total += 1
+    if secs > self.max:
+      self.max = secs
+
+  def percentile(self, pct):
+    if not self.total:
+      return 0.0
+    rank = self.total*pct/100.0
+    seen = 0
+    for b in sorted(self.counts):
+      seen += self.counts[b]
+      if seen >= rank:
+        return min(_bucket_limit(b), self.max)
+    return self.max
+
+class HandlerStats:
+  def __init__(self, name):
+    self.name = name
+    self.reset()
+
+  def reset(self):
+    self.calls = 0
+    self.total_secs = 0.0
+    self.times = Histogram()
+    self.lag = Histogram()
+
+  def record(self, secs, lag):
+    self.calls += 1
+    self.total_secs += secs
+    self.times.add(secs)
+    if lag is not None:
+      self.lag.add(max(lag, 0.0))
+
+  def to_dict(self):
+    return {"calls": self.calls,
+            "total_secs": self.total_secs,
+            "p50_secs": self.times.percentile(50),
+            "p99_secs": self.times.percentile(99),
+            "max_secs": self.times.max,
+            "lag_p50_secs": self.lag.percentile(50),
+            "lag_p99_secs": self.lag.percentile(99),
+            "lag_max_secs": self.lag.max}
+
+class Instrumentation:
+  def __init__(self, report_secs, dump_file=""):
+    self.handlers = {} # key=name val=HandlerStats
+    self.report_secs = report_secs
+    self.dump_file = dump_file
+    self.last_report = time.time()
+
+  def wrap(self, func, prefix=""):
+    "Returns 'func' wrapped so that its calls get recorded"
+    name = prefix+handler_name(func)
+    if name not in self.handlers:
+      self.handlers[name] = HandlerStats(name)
+    stats = self.handlers[name]
+
+    def instrumented(event):
+      start = time.time()
+      try:
+        return func(event)
+      finally:
+        end = time.time()
+        arrived_at = getattr(event, "arrived_at", None)
+        stats.record(end - start, start - arrived_at if arrived_at else None)
+        if end - self.last_report >= self.report_secs:
+          self.report(end)
+    return instrumented
+
+  def report(self, now):
+    """Logs and dumps the stats since the last report, and starts a new
+    interval."""
+    interval = now - self.last_report
+    self.last_report = now
+    busy = sorted([s for s in self.handlers.values() if s.calls],
+                  key=lambda s: -s.total_secs)
+
+    for s in busy:
+      plog("NOTICE", "Handler %s: %d calls, %.3fs total (%.1f%% of %ds). "
+           "Time p50 %.3fms, p99 %.3fms. Lag p50 %.1fms, p99 %.1fms.",
+           s.name, s.calls, s.total_secs, 100.0*s.total_secs/interval,
+           interval, 1000*s.times.percentile(50),
+           1000*s.times.percentile(99), 1000*s.lag.percentile(50),
+           1000*s.lag.percentile(99))
+
+    if self.dump_file:
+      record = {"time": now, "pid": os.getpid(), "interval_secs": interval,
+                "handlers": dict((s.name, s.to_dict()) for s in busy)}
+      try:
+        with open(self.dump_file, "a") as f:
+          f.write(json.dumps(record, sort_keys=True)+"\n")
+      except IOError as e:
+        plog("WARN", "Can't write instrumentation to "+self.dump_file+": "+
+             str(e))
+
+    for s in busy:
+      s.reset()
+
+class InstrumentedController:
+  """Passes everything through to 'controller', but wraps event listeners
+  as they are added."""
+  def __init__(self, controller, instruments):
+    self.__dict__["_controller"] = controller
+    self.__dict__["_instruments"] = instruments
+
+  def __getattr__(self, name):
+    return getattr(self._controller, name)
+
+  # Attributes such as _logguard must land on the real controller, since
+  # other code looks for them there.
+  def __setattr__(self, name, val):
+    setattr(self._controller, name, val)
+
+  def add_event_listener(self, func, *events):
+    for ev in events:
+      self._controller.add_event_listener(self._instruments.wrap(func,
+                                                                 ev+": "),
+                                          ev)
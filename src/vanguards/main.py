@@ -6,12 +6,18 @@ import sys
 import stem.response.events
 
 from . import control
+from . import circuits
+from . import fastevents
 from . import rendguard
 from . import vanguards
 from . import bandguards
 from . import logguard
 from . import cbtverify
 from . import pathverify
+from . import workers
+from . import aioengine
+from . import eventtrace
+from . import instrument
 
 from . import config
 
@@ -19,12 +25,32 @@ from .logger import plog
 
 _MIN_TOR_VERSION_FOR_BW = stem.version.Version("0.3.4.10")
 
+# Failed reconnects wait twice as long as the last one, up to this
+_MAX_RECONNECT_SECS = 16
+
+def reconnect_delay(failures):
+  "Seconds to wait before reconnecting, after 'failures' failures in a row"
+  return min(2**max(failures - 1, 0), _MAX_RECONNECT_SECS)
+
 def main():
   try:
     run_main()
   except KeyboardInterrupt as e:
     plog("NOTICE", "Got CTRL+C. Exiting.")
 
+def load_state():
+  try:
+    # TODO: Use tor's data directory.. or our own
+    state = vanguards.VanguardState.read_from_file(config.STATE_FILE)
+    plog("INFO", "Current layer2 guards: "+state.layer2_guardset())
+    plog("INFO", "Current layer3 guards: "+state.layer3_guardset())
+  except Exception as e:
+    plog("NOTICE", "Creating new vanguard state file at: "+config.STATE_FILE)
+    state = vanguards.VanguardState(config.STATE_FILE)
+
+  state.enable_vanguards = config.ENABLE_VANGUARDS
+  return state
+
 def run_main():
   try:
     config.apply_config(config._CONFIG_FILE)
@@ -44,29 +70,33 @@ def run_main():
       sys.exit(1)
     options = config.setup_options()
 
-  try:
-    # TODO: Use tor's data directory.. or our own
-    state = vanguards.VanguardState.read_from_file(config.STATE_FILE)
-    plog("INFO", "Current layer2 guards: "+state.layer2_guardset())
-    plog("INFO", "Current layer3 guards: "+state.layer3_guardset())
-  except Exception as e:
-    plog("NOTICE", "Creating new vanguard state file at: "+config.STATE_FILE)
-    state = vanguards.VanguardState(config.STATE_FILE)
+  if config.ENABLE_ASYNCIO and not aioengine.asyncio:
+    plog("ERROR", "enable_asyncio requires Python 3.")
+    sys.exit(1)
 
-  state.enable_vanguards = config.ENABLE_VANGUARDS
+  state = load_state()
   stem.response.events.PARSE_NEWCONSENSUS_EVENTS = False
 
   reconnects = 0
+  failures = 0 # In a row, since we were last connected
   last_connected_at = None
   connected = False
   while options.retry_limit == None or reconnects < options.retry_limit:
     ret = control_loop(state)
+
+    # With workers, the vanguards worker process owned our state and
+    # wrote it out. Pick up where it left off.
+    if config.ENABLE_WORKERS:
+      state = load_state()
     if not last_connected_at:
       last_connected_at = time.time()
 
     if ret == "closed":
       connected = True
-    # Try once per second but only tell the user every 10 seconds
+      failures = 0
+    else:
+      failures += 1
+    # Back off while tor is down, but only tell the user every 10 tries
     if ret == "closed" or reconnects % 10 == 0:
       if time.time() - last_connected_at > \
         bandguards.CONN_MAX_DISCONNECTED_SECS:
@@ -74,7 +104,7 @@ def run_main():
       else:
         plog("NOTICE", "Tor daemon connection "+ret+". Trying again...")
     reconnects += 1
-    time.sleep(1)
+    time.sleep(reconnect_delay(failures))
 
   if not connected:
     sys.exit(1)
@@ -116,6 +146,9 @@ def control_loop(state):
 
   control.authenticate_any(controller, config.CONTROL_PASS)
 
+  if config.ENABLE_FASTEVENTS:
+    fastevents.enable(controller)
+
   # The new_consensus_event must still get called even if vanguards
   # is "disabled", because we also have to parse the consensus to
   # update rendguard counts
@@ -136,15 +169,55 @@ def control_loop(state):
     plog("NOTICE", "Updated vanguards in torrc. Exiting.")
     sys.exit(0)
 
+  if config.ENABLE_WORKERS:
+    if config.RECORD_EVENTS:
+      plog("NOTICE", "Event recording is not supported with workers.")
+    return workers.run_workers(controller, state, setup_listeners)
+
+  recorder = None
+  if config.RECORD_EVENTS:
+    recorder = eventtrace.EventRecorder(config.RECORD_EVENTS, controller)
+    recorder.start()
+    plog("NOTICE", "Recording events to "+config.RECORD_EVENTS)
+
+  if config.ENABLE_ASYNCIO:
+    engine = aioengine.AsyncEngine(controller)
+    setup_listeners(engine.async_controller, state, engine)
+    ret = engine.run()
+  else:
+    setup_listeners(controller, state)
+
+    # Blah...
+    while controller.is_alive():
+      time.sleep(1)
+    ret = "closed"
+
+  if recorder:
+    recorder.close()
+  return ret
+
+def setup_listeners(controller, state, engine=None):
   # Thread-safety: state, timeouts, and bandwidths are effectively
   # transferred to the event thread here. They must not be used in
   # our thread anymore.
 
+  instruments = None
+  if config.ENABLE_INSTRUMENTATION:
+    instruments = instrument.Instrumentation(config.INSTRUMENT_REPORT_SECS,
+                                             config.INSTRUMENT_DUMP_FILE)
+    controller = instrument.InstrumentedController(controller, instruments)
+
+  # All CIRC and CIRC_MINOR events go through this registry, so that each
+  # component only gets the circuit transitions it cares about.
+  if instruments:
+    circs = circuits.CircuitRegistry(instruments.wrap)
+  else:
+    circs = circuits.CircuitRegistry()
+
   if config.ENABLE_RENDGUARD:
-    controller.add_event_listener(
+    circs.add_listener(circuits.CIRC_BUILT,
                  functools.partial(rendguard.RendGuard.circ_event,
-                                   state.rendguard, controller),
-                                  stem.control.EventType.CIRC)
+                                   state.rendguard, controller))
 
   # Ok, little low on fucks here. But this is fine. This will work.
   # We check for None in control.try_close_circuit()
@@ -163,17 +236,14 @@ def control_loop(state):
                                    stem.control.EventType.WARN)
 
     # For post-close logs
-    controller.add_event_listener(
-                 functools.partial(logguard.LogGuard.circ_event, logs),
-                                  stem.control.EventType.CIRC)
+    circs.add_listener(circuits.CIRC_CLOSED,
+                 functools.partial(logguard.LogGuard.circ_event, logs))
 
 
   if config.ENABLE_BANDGUARDS:
-    bandwidths = bandguards.BandwidthStats(controller)
+    # Subscribes to its circuit transitions itself
+    bandwidths = bandguards.BandwidthStats(controller, circs)
 
-    controller.add_event_listener(
-                 functools.partial(bandguards.BandwidthStats.circ_event, bandwidths),
-                                  stem.control.EventType.CIRC)
     controller.add_event_listener(
                  functools.partial(bandguards.BandwidthStats.bw_event, bandwidths),
                                   stem.control.EventType.BW)
@@ -185,41 +255,39 @@ def control_loop(state):
                                    bandwidths),
                                   stem.control.EventType.NETWORK_LIVENESS)
 
+    if engine:
+      # Check circuit ages on a loop timer, rather than on each BW event
+      bandwidths.check_ages_on_bw = False
+      engine.call_every(1, bandwidths.check_circ_ages)
+
     if controller.get_version() >= _MIN_TOR_VERSION_FOR_BW:
       controller.add_event_listener(
                    functools.partial(bandguards.BandwidthStats.circbw_event, bandwidths),
                                     stem.control.EventType.CIRC_BW)
-      controller.add_event_listener(
-                   functools.partial(bandguards.BandwidthStats.circ_minor_event, bandwidths),
-                                    stem.control.EventType.CIRC_MINOR)
     else:
       plog("NOTICE", "In order for bandwidth-based protections to be "+
                       "enabled, you must use Tor 0.3.4.10 or newer.")
 
 
   if config.ENABLE_CBTVERIFY:
-    timeouts = cbtverify.TimeoutStats()
+    # Subscribes to its circuit transitions itself
+    timeouts = cbtverify.TimeoutStats(circs)
 
-    controller.add_event_listener(
-                 functools.partial(cbtverify.TimeoutStats.circ_event, timeouts),
-                                  stem.control.EventType.CIRC)
     controller.add_event_listener(
                  functools.partial(cbtverify.TimeoutStats.cbt_event, timeouts),
                                   stem.control.EventType.BUILDTIMEOUT_SET)
 
   if config.ENABLE_PATHVERIFY:
     paths = pathverify.PathVerify(controller,
-                                  config.ENABLE_VANGUARDS,
+                                  state.enable_vanguards,
                                   vanguards.NUM_LAYER1_GUARDS,
                                   vanguards.NUM_LAYER2_GUARDS,
                                   vanguards.NUM_LAYER3_GUARDS)
 
-    controller.add_event_listener(
-                 functools.partial(pathverify.PathVerify.circ_event, paths),
-                                  stem.control.EventType.CIRC)
-    controller.add_event_listener(
-                 functools.partial(pathverify.PathVerify.circ_minor_event, paths),
-                                  stem.control.EventType.CIRC_MINOR)
+    circs.add_listener(circuits.CIRC_BUILT,
+                 functools.partial(pathverify.PathVerify.circ_event, paths))
+    circs.add_listener(circuits.CIRC_MINOR,
+                 functools.partial(pathverify.PathVerify.circ_minor_event, paths))
     controller.add_event_listener(
                  functools.partial(pathverify.PathVerify.orconn_event, paths),
                                   stem.control.EventType.ORCONN)
@@ -230,15 +298,32 @@ def control_loop(state):
                  functools.partial(pathverify.PathVerify.conf_changed_event,
                                    paths),
                                   stem.control.EventType.CONF_CHANGED)
-    # After launch pathverify, we send a NEWNYM to get fresh circs and
-    # vg-lite guards
+
+  circs.attach(controller)
+
+  # After launch pathverify, we send a NEWNYM to get fresh circs and
+  # vg-lite guards
+  if config.ENABLE_PATHVERIFY:
     controller.signal("NEWNYM")
 
 
   # Thread-safety: We're effectively transferring controller to the event
   # thread here.
   if config.ENABLE_VANGUARDS or config.ENABLE_RENDGUARD:
-    controller.add_event_listener(
+    updater = None
+    if config.ENABLE_BACKGROUND_CONSENSUS:
+      updater = vanguards.ConsensusUpdater(state, controller)
+      controller.add_event_listener(updater.new_consensus_event,
+                                    stem.control.EventType.NEWCONSENSUS)
+      # Workers handle circuit events in another process, where they
+      # don't wait for us.
+      if not config.ENABLE_WORKERS:
+        controller.add_event_listener(state.event_lag.event,
+                                      stem.control.EventType.CIRC)
+        controller.add_event_listener(state.event_lag.event,
+                                      stem.control.EventType.CIRC_BW)
+    else:
+      controller.add_event_listener(
                    functools.partial(vanguards.VanguardState.new_consensus_event,
                                      state, controller),
                                     stem.control.EventType.NEWCONSENSUS)
@@ -247,8 +332,11 @@ def control_loop(state):
                                      state, controller),
                                     stem.control.EventType.SIGNAL)
 
-  # Blah...
-  while controller.is_alive():
-    time.sleep(1)
-
-  return "closed"
+    # Rotate expired guards between consensuses
+    if config.ENABLE_VANGUARDS:
+      rotator = vanguards.GuardRotator(state, controller, updater)
+      if engine:
+        engine.call_every(1, rotator.check_expiry)
+      else:
+        controller.add_event_listener(rotator.bw_event,
+                                      stem.control.EventType.BW)
@@ -0,0 +1,449 @@
+""" A stand-in tor control port, for load testing vanguards.
+
+    This speaks just enough of the control protocol for vanguards to run
+    against it: PROTOCOLINFO, AUTHENTICATE, GETINFO, GETCONF, SETCONF,
+    SETEVENTS, SIGNAL, SAVECONF and CLOSECIRCUIT. It serves relays from a
+    cached-microdesc-consensus file, and generates synthetic CIRC, CIRC_BW,
+    ORCONN and BW events at a configurable (and optionally ramping) rate.
+
+    Once a second, it also launches a "probe" onion service circuit with
+    dropped cells, which bandguards should close. The delay between sending
+    the probe and getting its CLOSECIRCUIT shows when vanguards falls behind.
+
+    Run from the source tree with:
+      PYTHONPATH=src python -m vanguards.mocktor --rate 100 --ramp 30
+    and point vanguards at it with --control_port 9099.
+"""
+import argparse
+import base64
+import binascii
+import os
+import random
+import re
+import socket
+import threading
+import time
+
+try:
+  import socketserver
+except ImportError:
+  import SocketServer as socketserver
+
+import stem.descriptor
+
+from . import logger
+from .logger import plog
+
+_PURPOSES = [
+  ("HS_SERVICE_REND", "HSSR_JOINED"),
+  ("HS_SERVICE_INTRO", "HSSI_ESTABLISHED"),
+  ("HS_CLIENT_REND", "HSCR_JOINED"),
+  ("HS_VANGUARDS", None),
+  ("GENERAL", None),
+]
+
+# How long to wait for a probe close before we call it missed
+_PROBE_TIMEOUT_SECS = 5
+
+_KEYVAL = re.compile(r'([^\s=]+)(?:=("(?:[^"\\]|\\.)*"|\S*))?')
+
+def _iso_time(t):
+  return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(t))+".000000"
+
+def _b64_fp(fp):
+  return base64.b64encode(binascii.unhexlify(fp)).decode("ascii").rstrip("=")
+
+def _ns_all(routers):
+  "Formats microdesc consensus entries as GETINFO ns/all would"
+  lines = []
+  for r in routers:
+    identity = _b64_fp(r.fingerprint)
+    lines.append("r %s %s %s %s %s %d %d" %
+                 (r.nickname, identity, identity,
+                  r.published.strftime("%Y-%m-%d %H:%M:%S"),
+                  r.address, r.or_port, r.dir_port or 0))
+    lines.append("s "+" ".join(r.flags))
+    if r.bandwidth is not None:
+      lines.append("w Bandwidth="+str(r.bandwidth))
+  return "\n".join(lines)
+
+def _percentile(vals, pct):
+  if not vals:
+    return 0.0
+  vals = sorted(vals)
+  return vals[min(len(vals)-1, int(len(vals)*pct/100.0))]
+
+class MockTor:
+  def __init__(self, consensus_file, tor_version="0.4.8.9", password=None,
+               rate=10.0, ramp_secs=0, lifetime_secs=5, disconnect_secs=0):
+    self.tor_version = tor_version
+    self.password = password
+    self.rate = float(rate)
+    self.ramp_secs = ramp_secs
+    self.lifetime_secs = lifetime_secs
+    self.disconnect_secs = disconnect_secs
+
+    routers = list(stem.descriptor.parse_file(consensus_file,
+                     document_handler =
+                       stem.descriptor.DocumentHandler.ENTRIES))
+    self.ns_all = _ns_all(routers)
+    self.relays = [(r.fingerprint, r.nickname) for r in routers]
+    self.guards = [(r.fingerprint, r.nickname) for r in routers
+                   if "Guard" in r.flags]
+
+    # Like tor's, our config outlives control connections
+    self.conf = {"DataDirectory":
+                   os.path.dirname(os.path.abspath(consensus_file))}
+
+    self.lock = threading.Lock()
+    self.next_circ_id = 1
+    self.connections = 0
+    self.events_sent = 0
+    self.circs_launched = 0
+    self.closes = []
+    self.probes = {} # key=circ_id val=sent_at
+    self.probe_latencies = []
+    self.probes_missed = 0
+    self.started_at = time.time()
+
+  def new_circ_id(self):
+    with self.lock:
+      circ_id = self.next_circ_id
+      self.next_circ_id += 1
+    return str(circ_id)
+
+  def current_rate(self, now):
+    if self.ramp_secs:
+      return self.rate*2**int((now - self.started_at)/self.ramp_secs)
+    return self.rate
+
+  def probe_closed(self, circ_id, now):
+    with self.lock:
+      self.closes.append(circ_id)
+      if circ_id in self.probes:
+        self.probe_latencies.append(now - self.probes.pop(circ_id))
+
+  def report(self, now):
+    "Returns a one-line summary of activity since the last report"
+    with self.lock:
+      for (circ_id, sent_at) in list(self.probes.items()):
+        if now - sent_at > _PROBE_TIMEOUT_SECS:
+          del self.probes[circ_id]
+          self.probes_missed += 1
+      ret = "rate=%.0f circ/s events=%d circs=%d probes closed=%d "\
+            "missed=%d latency p50=%.1fms p99=%.1fms max=%.1fms" % \
+            (self.current_rate(now), self.events_sent, self.circs_launched,
+             len(self.probe_latencies), self.probes_missed,
+             1000*_percentile(self.probe_latencies, 50),
+             1000*_percentile(self.probe_latencies, 99),
+             1000*max(self.probe_latencies or [0]))
+      self.events_sent = 0
+      self.circs_launched = 0
+      self.probe_latencies = []
+      self.probes_missed = 0
+    return ret
+
+class ControlConnection:
+  """One control port connection. Commands are answered on the server's
+  handler thread, while a generator thread sends our synthetic events."""
+  def __init__(self, tor, rfile, wfile, sock):
+    self.tor = tor
+    self.rfile = rfile
+    self.wfile = wfile
+    self.sock = sock
+    self.write_lock = threading.Lock()
+    self.authenticated = False
+    self.events = set()
+    self.circs = {} # key=circ_id val=(path, purpose, hs_state)
+    self.guard = random.choice(tor.guards or tor.relays)
+    self.alive = True
+
+  def send(self, lines):
+    data = "".join(l+"\r\n" for l in lines).encode("utf-8")
+    with self.write_lock:
+      try:
+        self.wfile.write(data)
+        self.wfile.flush()
+      except (IOError, socket.error, ValueError):
+        self.alive = False
+
+  def send_event(self, event_type, line):
+    if event_type in self.events:
+      self.send(["650 "+line])
+      with self.tor.lock:
+        self.tor.events_sent += 1
+
+  def serve(self):
+    while self.alive:
+      line = self.rfile.readline()
+      if not line:
+        break
+      line = line.decode("utf-8").rstrip("\r\n")
+      (verb, _, args) = line.partition(" ")
+      self.command(verb.upper(), args)
+    self.alive = False
+
+  def close(self):
+    self.alive = False
+    try:
+      self.sock.shutdown(socket.SHUT_RDWR)
+    except (IOError, socket.error):
+      pass
+
+  def command(self, verb, args):
+    if verb == "PROTOCOLINFO":
+      methods = "HASHEDPASSWORD" if self.tor.password else "NULL"
+      return self.send(["250-PROTOCOLINFO 1",
+                        "250-AUTH METHODS="+methods,
+                        "250-VERSION Tor=\""+self.tor.tor_version+"\"",
+                        "250 OK"])
+    if verb == "AUTHENTICATE":
+      passwd = args.strip()
+      if passwd.startswith('"'):
+        passwd = passwd[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+      elif passwd:
+        passwd = binascii.unhexlify(passwd).decode("utf-8")
+      if self.tor.password and passwd != self.tor.password:
+        self.send(["515 Authentication failed: Password did not match "+
+                   "HashedControlPassword value from configuration"])
+        return self.close()
+      self.authenticated = True
+      self.start_traffic()
+      return self.send(["250 OK"])
+    if not self.authenticated:
+      self.send(["514 Authentication required."])
+      return self.close()
+
+    if verb == "GETINFO":
+      return self.getinfo(args.split())
+    if verb == "GETCONF":
+      return self.getconf(args.split())
+    if verb == "SETCONF" or verb == "RESETCONF":
+      return self.setconf(args)
+    if verb == "SETEVENTS":
+      self.events = set(e for e in args.split() if e != "EXTENDED")
+      return self.send(["250 OK"])
+    if verb == "SIGNAL":
+      self.send(["250 OK"])
+      return self.send_event("SIGNAL", "SIGNAL "+args.strip())
+    if verb == "CLOSECIRCUIT":
+      return self.closecircuit(args.split()[0])
+    if verb == "SAVECONF" or verb == "TAKEOWNERSHIP":
+      return self.send(["250 OK"])
+    if verb == "QUIT":
+      self.send(["250 closing connection"])
+      return self.close()
+    self.send(["510 Unrecognized command \""+verb+"\""])
+
+  def getinfo(self, keys):
+    reply = []
+    for key in keys:
+      if key == "version":
+        val = self.tor.tor_version
+      elif key == "ns/all":
+        val = self.tor.ns_all
+      elif key == "orconn-status":
+        val = "$"+self.guard[0]+"~"+self.guard[1]+" CONNECTED"
+      elif key == "network-liveness":
+        val = "up"
+      else:
+        return self.send(["552 Unrecognized key \""+key+"\""])
+
+      if "\n" in val:
+        reply += ["250+"+key+"="]+val.split("\n")+["."]
+      else:
+        reply.append("250-"+key+"="+val)
+    self.send(reply+["250 OK"])
+
+  def getconf(self, keys):
+    if not keys:
+      return self.send(["250 OK"])
+
+    reply = []
+    for key in keys:
+      val = None
+      for (k, v) in self.tor.conf.items():
+        if k.lower() == key.lower():
+          val = v
+      if val is None:
+        reply.append("250-"+key)
+      else:
+        reply.append("250-"+key+"="+val)
+    reply[-1] = "250 "+reply[-1][4:]
+    self.send(reply)
+
+  def setconf(self, args):
+    changed = []
+    for (key, val) in _KEYVAL.findall(args):
+      if val.startswith('"'):
+        val = val[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+      if val:
+        self.tor.conf[key] = val
+        changed.append(key+"="+val)
+      else:
+        self.tor.conf.pop(key, None)
+        changed.append(key)
+    self.send(["250 OK"])
+
+    if "CONF_CHANGED" in self.events and changed:
+      self.send(["650-CONF_CHANGED"]+["650-"+c for c in changed]+["650 OK"])
+
+  def closecircuit(self, circ_id):
+    circ = self.circs.pop(circ_id, None)
+    if not circ:
+      return self.send(["552 Unknown circuit \""+circ_id+"\""])
+
+    self.tor.probe_closed(circ_id, time.time())
+    self.send(["250 OK"])
+    self.send_circ(circ_id, "CLOSED", circ, " REASON=REQUESTED")
+
+  def send_circ(self, circ_id, status, circ, extra=""):
+    (path, purpose, hs_state) = circ
+    line = "CIRC "+circ_id+" "+status
+    if path:
+      line += " "+path
+    line += " BUILD_FLAGS=IS_INTERNAL,NEED_CAPACITY,NEED_UPTIME PURPOSE="+purpose
+    if hs_state:
+      line += " HS_STATE="+hs_state
+    self.send_event("CIRC", line+" TIME_CREATED="+_iso_time(time.time())+extra)
+
+  def launch_circ(self, purpose, hs_state, read_cells, delivered_cells):
+    circ_id = self.tor.new_circ_id()
+    hops = [self.guard]+random.sample(self.tor.relays, 3)
+    path = ",".join("$"+fp+"~"+nick for (fp, nick) in hops)
+    circ = (path, purpose, hs_state)
+    self.circs[circ_id] = circ
+
+    self.send_circ(circ_id, "LAUNCHED", ("", purpose, None))
+    self.send_circ(circ_id, "BUILT", circ)
+    # Each cell is 509 bytes, with 498 bytes of relay payload
+    self.send_event("CIRC_BW", "CIRC_BW ID="+circ_id+" READ="+
+                    str(509*read_cells)+" WRITTEN=509 TIME="+
+                    _iso_time(time.time())+" DELIVERED_READ="+
+                    str(498*delivered_cells)+" OVERHEAD_READ=0"+
+                    " DELIVERED_WRITTEN=498 OVERHEAD_WRITTEN=0")
+    with self.tor.lock:
+      self.tor.circs_launched += 1
+    return circ_id
+
+  def start_traffic(self):
+    t = threading.Thread(target=self.traffic_loop)
+    t.daemon = True
+    t.start()
+
+  def traffic_loop(self):
+    connected_at = time.time()
+    last_sec = connected_at
+    owed = 0.0
+    expiring = [] # list of (close_at, circ_id)
+    sent_orconn = False
+
+    while self.alive:
+      time.sleep(0.1)
+      now = time.time()
+
+      if self.tor.disconnect_secs and \
+         now - connected_at > self.tor.disconnect_secs:
+        plog("NOTICE", "Mock tor: dropping control connection")
+        return self.close()
+
+      if not sent_orconn and "ORCONN" in self.events:
+        self.send_event("ORCONN", "ORCONN $"+self.guard[0]+"~"+
+                        self.guard[1]+" CONNECTED ID=1")
+        sent_orconn = True
+
+      owed += self.tor.current_rate(now)*0.1
+      while owed >= 1:
+        (purpose, hs_state) = random.choice(_PURPOSES)
+        circ_id = self.launch_circ(purpose, hs_state, 1, 1)
+        expiring.append((now + self.tor.lifetime_secs, circ_id))
+        owed -= 1
+
+      while expiring and expiring[0][0] <= now:
+        circ_id = expiring.pop(0)[1]
+        circ = self.circs.pop(circ_id, None)
+        if circ:
+          self.send_circ(circ_id, "CLOSED", circ, " REASON=FINISHED")
+
+      if now - last_sec >= 1:
+        last_sec = now
+        self.send_event("BW", "BW 10240 20480")
+
+        # Two dropped cells on an onion service circuit. Bandguards
+        # should close this.
+        if "CIRC_BW" in self.events:
+          circ_id = self.launch_circ("HS_SERVICE_REND", "HSSR_CONNECTING",
+                                     2, 0)
+          with self.tor.lock:
+            self.tor.probes[circ_id] = time.time()
+
+class _Handler(socketserver.StreamRequestHandler):
+  def handle(self):
+    tor = self.server.tor
+    with tor.lock:
+      tor.connections += 1
+    conn = ControlConnection(tor, self.rfile, self.wfile, self.connection)
+    conn.serve()
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+  allow_reuse_address = True
+  daemon_threads = True
+
+if hasattr(socketserver, "UnixStreamServer"):
+  class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def make_server(tor, port=None, socket_file=None, ip="127.0.0.1"):
+  """Returns a socketserver for 'tor' on a control port or socket file.
+  Port 0 picks a free port (see server.server_address)."""
+  if socket_file:
+    server = _UnixServer(socket_file, _Handler)
+  else:
+    server = _TCPServer((ip, port), _Handler)
+  server.tor = tor
+  return server
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--port", type=int, default=9099,
+                      help="Control port to listen on (default: 9099)")
+  parser.add_argument("--socket", default=None,
+                      help="Listen on this control socket path instead")
+  parser.add_argument("--consensus",
+                      default=os.path.join("tests", "cached-microdesc-consensus"),
+                      help="Microdesc consensus to serve relays from")
+  parser.add_argument("--password", default=None,
+                      help="Require this control port password")
+  parser.add_argument("--rate", type=float, default=10,
+                      help="Circuits per second to launch (default: 10)")
+  parser.add_argument("--ramp", type=int, default=0,
+                      help="Double the circuit rate every RAMP seconds")
+  parser.add_argument("--lifetime", type=int, default=5,
+                      help="Seconds each circuit stays open (default: 5)")
+  parser.add_argument("--disconnect_after", type=int, default=0,
+                      help="Drop each connection after this many seconds, "+
+                           "to test reconnects")
+  parser.add_argument("--report_secs", type=int, default=10,
+                      help="Seconds between activity reports")
+  options = parser.parse_args()
+  logger.set_loglevel("NOTICE")
+
+  tor = MockTor(options.consensus, password=options.password,
+                rate=options.rate, ramp_secs=options.ramp,
+                lifetime_secs=options.lifetime,
+                disconnect_secs=options.disconnect_after)
+  server = make_server(tor, options.port, options.socket)
+  t = threading.Thread(target=server.serve_forever)
+  t.daemon = True
+  t.start()
+  plog("NOTICE", "Mock tor listening on "+str(server.server_address))
+
+  try:
+    while True:
+      time.sleep(options.report_secs)
+      plog("NOTICE", "Mock tor: "+tor.report(time.time()))
+  except KeyboardInterrupt:
+    server.shutdown()
+
+if __name__ == '__main__':
+  main()
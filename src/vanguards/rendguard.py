@@ -1,5 +1,12 @@
+import math
+import threading
+import time
+
+from array import array
+
 from . import control
 
+from .consensus import FLAG_BITS
 from .logger import plog
 
 ############## Rendguard options #####################
@@ -7,8 +14,10 @@ from .logger import plog
 # Minimum number of hops we have to see before applying use stat checks
 REND_USE_GLOBAL_START_COUNT = 1000
 
-# Number of hops to scale counts down by two at
-REND_USE_SCALE_AT_COUNT = 20000
+# Use counts (and their total) decay by half every this many hours, so
+# that new relays can't show up and get overused while older uses still
+# dominate the total. 0 disables decay.
+REND_USE_HALF_LIFE_HOURS = 24*7
 
 # Minimum number of times a relay has to be used before we check it for
 # overuse
@@ -17,6 +26,12 @@ REND_USE_RELAY_START_COUNT = 100
 # How many times more than its bandwidth must a relay be used?
 REND_USE_MAX_USE_TO_BW_RATIO = 5.0
 
+# How many standard deviations above the ratio limit a relay's use rate
+# must be before we call it overused. The rate is checked by the lower
+# end of its Wilson score interval, which is loose while the counts are
+# small and tightens as they grow. 0 checks the raw use rate.
+REND_USE_CONFIDENCE_Z = 3.0
+
 # What is percent of the network weight is not in the consensus right now?
 # Put another way, the max number of rend requests not in the consensus is
 # REND_USE_MAX_USE_TO_BW_RATIO times this churn rate.
@@ -26,42 +41,287 @@ REND_USE_MAX_CONSENSUS_WEIGHT_CHURN = 1.0
 REND_USE_CLOSE_CIRCUITS_ON_OVERUSE = True
 
 _NOT_IN_CONSENSUS_ID = "NOT_IN_CONSENSUS"
+# How many of the relays that are not in the consensus we count separately
+_OFF_CONSENSUS_TRACKED = 64
+_EXIT = FLAG_BITS["Exit"]
+
+_SEC_PER_HOUR = 60*60
+
+def decay_factor(elapsed):
+  "How much a use count decays over 'elapsed' seconds"
+  if REND_USE_HALF_LIFE_HOURS <= 0 or elapsed <= 0:
+    return 1.0
+  return 0.5**(elapsed/float(REND_USE_HALF_LIFE_HOURS*_SEC_PER_HOUR))
+
+def wilson_lower_bound(used, total, z):
+  """Returns the lower end of the Wilson score interval for a use rate of
+  'used' out of 'total', 'z' standard deviations wide"""
+  if total <= 0:
+    return 0.0
+  rate = min(used/float(total), 1.0)
+  if z <= 0:
+    return rate
+  z2 = z*z
+  center = rate + z2/(2.0*total)
+  spread = z*math.sqrt(rate*(1.0 - rate)/total + z2/(4.0*total*total))
+  return max((center - spread)/(1.0 + z2/total), 0.0)
 
 class RendUseCount:
-  def __init__(self, idhex, weight):
+  """A relay's use count, as pickled state files used to store them. Only
+  kept so that those still load."""
+  def __init__(self, idhex, weight, used=0, updated_at=None):
     self.idhex = idhex
-    self.used = 0
+    self.used = used
     self.weight = weight
+    self.updated_at = time.time() if updated_at is None else updated_at
+
+class UseCountTable:
+  """The use count and weight of every relay, in parallel arrays indexed
+  by slot, with 'index' mapping fingerprints to slots. A relay's count is
+  as of its updated_at, and only gets decayed when it is read or counted.
+  The slots of relays that leave the consensus are reused."""
+  def __init__(self, idhexes=(), now=None):
+    if now is None:
+      now = time.time()
+    self.idhexes = list(idhexes) # key=slot val=idhex, or None if free
+    self.index = dict(zip(self.idhexes, range(len(self.idhexes))))
+    self.used = array("d", [0.0])*len(self.idhexes)
+    self.weight = array("d", [0.0])*len(self.idhexes)
+    self.updated_at = array("d", [now])*len(self.idhexes)
+    self.free = []
+
+  # The index gets rebuilt from idhexes, rather than pickled
+  def __getstate__(self):
+    state = dict(self.__dict__)
+    del state["index"]
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.index = dict((idhex, i) for (i, idhex) in enumerate(self.idhexes)
+                      if idhex is not None)
+
+  def __len__(self):
+    return len(self.index)
+
+  def __contains__(self, idhex):
+    return idhex in self.index
+
+  def __iter__(self):
+    return iter(self.index)
+
+  def add(self, idhex, weight=0.0, used=0.0, updated_at=None):
+    "Sets the count of 'idhex', adding it if need be. Returns its slot."
+    if updated_at is None:
+      updated_at = time.time()
+    if idhex in self.index:
+      slot = self.index[idhex]
+    elif self.free:
+      slot = self.free.pop()
+      self.idhexes[slot] = idhex
+    else:
+      slot = len(self.idhexes)
+      self.idhexes.append(idhex)
+      self.used.append(0.0)
+      self.weight.append(0.0)
+      self.updated_at.append(0.0)
+    self.index[idhex] = slot
+    self.used[slot] = used
+    self.weight[slot] = weight
+    self.updated_at[slot] = updated_at
+    return slot
+
+  def remove(self, idhex):
+    slot = self.index.pop(idhex)
+    self.idhexes[slot] = None
+    self.used[slot] = 0.0
+    self.weight[slot] = 0.0
+    self.free.append(slot)
+
+  def used_at(self, idhex, now):
+    "Returns the count of 'idhex' as of 'now', without updating it"
+    slot = self.index[idhex]
+    return self.used[slot]*decay_factor(now - self.updated_at[slot])
+
+  def weight_of(self, idhex):
+    return self.weight[self.index[idhex]]
+
+  def decay(self, slot, now):
+    self.used[slot] *= decay_factor(now - self.updated_at[slot])
+    self.updated_at[slot] = now
+    return self.used[slot]
+
+  def total_at(self, now):
+    "Returns the sum of every count as of 'now'"
+    return float(sum(u*decay_factor(now - t)
+                     for (u, t) in zip(self.used, self.updated_at) if u))
+
+  def columns(self, now):
+    """Returns (idhexes, used, weight) for every relay, with 'used' as of
+    'now'"""
+    slots = [s for (s, idhex) in enumerate(self.idhexes) if idhex is not None]
+    used = self.used
+    updated_at = self.updated_at
+    return ([self.idhexes[s] for s in slots],
+            array("d", [used[s]*decay_factor(now - updated_at[s])
+                        if used[s] else 0.0 for s in slots]),
+            array("d", [self.weight[s] for s in slots]))
+
+  def remap(self, idhexes, now):
+    """Returns a table for 'idhexes', in that order. Their counts carry
+    over from this table, but their weights start at 0."""
+    slots = [self.index.get(idhex, -1) for idhex in idhexes]
+    used = self.used
+    updated_at = self.updated_at
+    table = UseCountTable(idhexes, now)
+    table.used = array("d", [used[s] if s >= 0 else 0.0 for s in slots])
+    table.updated_at = array("d", [updated_at[s] if s >= 0 else now
+                                   for s in slots])
+    return table
+
+class HeavyHitters:
+  """Counts uses of the relays that are not in the consensus, so that we
+  can tell which of them get used the most. Only 'capacity' relays are
+  counted, with the Space-Saving algorithm: a new relay takes over the
+  least used relay's count once we are full. Each count can be too high by
+  at most its error, which is the count it took over. Any relay used more
+  than total/capacity times is guaranteed to be counted.
+
+  Counts decay like the other use counts. They all share updated_at."""
+  def __init__(self, capacity=_OFF_CONSENSUS_TRACKED, now=None):
+    self.capacity = capacity
+    self.counts = {} # key=idhex val=[count, error]
+    self.updated_at = time.time() if now is None else now
+
+  def __len__(self):
+    return len(self.counts)
+
+  def decay(self, now):
+    factor = decay_factor(now - self.updated_at)
+    if factor != 1.0:
+      for c in self.counts.values():
+        c[0] *= factor
+        c[1] *= factor
+    self.updated_at = max(now, self.updated_at)
+
+  def add(self, idhex, now):
+    self.decay(now)
+    if idhex in self.counts:
+      self.counts[idhex][0] += 1.0
+    elif len(self.counts) < self.capacity:
+      self.counts[idhex] = [1.0, 0.0]
+    else:
+      least = min(self.counts, key=lambda r: self.counts[r][0])
+      (count, error) = self.counts.pop(least)
+      self.counts[idhex] = [count + 1.0, count]
+
+  def set(self, entries, updated_at):
+    """Replaces our counts with 'entries', a list of (idhex, count, error)
+    as of 'updated_at'. Only the top 'capacity' of them are kept."""
+    entries = sorted(entries, key=lambda e: -e[1])[:self.capacity]
+    self.counts = dict((idhex, [count, error])
+                       for (idhex, count, error) in entries)
+    self.updated_at = updated_at
+
+  def top(self, now, limit=None):
+    """Returns (idhex, count, error) for the 'limit' most used relays, as
+    of 'now', most used first"""
+    factor = decay_factor(now - self.updated_at)
+    ret = sorted(((idhex, c[0]*factor, c[1]*factor)
+                  for (idhex, c) in self.counts.items()),
+                 key=lambda e: (-e[1], e[0]))
+    return ret[:limit] if limit is not None else ret
 
 class RendGuard:
   def __init__(self):
-    self.use_counts = {}
+    self.use_counts = UseCountTable()
+    # The sum of all use counts as of total_updated_at. Every count decays
+    # at the same rate, so their sum does too.
     self.total_use_counts = 0.0
+    self.total_updated_at = time.time()
     self.pickle_revision = 1.0
+    # Held while counting a use, and while a new consensus is swapped in
+    self.lock = threading.Lock()
+    # Relays whose use counts changed since our state was last saved, or
+    # dirty_all if they all did. Weights come from the consensus, so
+    # changes to them don't count.
+    self.dirty = set()
+    self.dirty_all = False
+    # The most used relays out of those counted as not in the consensus
+    self.off_consensus = HeavyHitters()
+    self.off_consensus_dirty = False
+
+  def __getstate__(self):
+    state = dict(self.__dict__)
+    state.pop("lock", None)
+    state.pop("dirty", None)
+    state.pop("dirty_all", None)
+    state.pop("off_consensus_dirty", None)
+    return state
+
+  def __setstate__(self, state):
+    # Older pickles have a dict of RendUseCounts, which may be from before
+    # decay. Those start decaying when loaded.
+    now = time.time()
+    use_counts = state.get("use_counts", {})
+    if isinstance(use_counts, dict):
+      table = UseCountTable()
+      for count in use_counts.values():
+        table.add(count.idhex, count.weight, count.used,
+                  getattr(count, "updated_at", now))
+      state["use_counts"] = table
+    state.setdefault("total_updated_at", now)
+    state.setdefault("off_consensus", HeavyHitters(now=now))
+    self.__dict__.update(state)
+    self.lock = threading.Lock()
+    self.dirty = set()
+    self.dirty_all = False
+    self.off_consensus_dirty = False
+
+  def total_at(self, now):
+    "Returns total_use_counts as of 'now', without updating it"
+    return self.total_use_counts*decay_factor(now - self.total_updated_at)
 
-  def valid_rend_use(self, r):
+  def decay_total(self, now):
+    "Brings total_use_counts up to 'now', and returns it"
+    self.total_use_counts = self.total_at(now)
+    self.total_updated_at = now
+    return self.total_use_counts
+
+  def valid_rend_use(self, r, now=None):
+    if now is None:
+      now = time.time()
+    counts = self.use_counts
     r_name = r
-    if r not in self.use_counts:
+    if r not in counts:
       plog("INFO", "Relay "+r+" is not in our consensus.")
       r_name = r+" (not in-consensus)"
+      self.off_consensus.add(r, now)
+      self.off_consensus_dirty = True
       r = _NOT_IN_CONSENSUS_ID
-      if r not in self.use_counts:
-        self.use_counts[r] = RendUseCount(r, 0)
+      if r not in counts:
+        counts.add(r, 0)
 
-    self.use_counts[r].used += 1.0
-    self.total_use_counts += 1.0
+    slot = counts.index[r]
+    used = counts.decay(slot, now) + 1.0
+    counts.used[slot] = used
+    weight = counts.weight[slot]
+    total = self.decay_total(now) + 1.0
+    self.total_use_counts = total
+    self.dirty.add(r)
     plog("DEBUG", "Relay "+r_name+" used %d times out of %d, "+\
                    "for a use rate of %f%%. It has a consensus "
-                   "weight of %f%%", int(self.use_counts[r].used),
-                   int(self.total_use_counts),
-                   (100.0*self.use_counts[r].used)/self.total_use_counts,
-                   100.0*self.use_counts[r].weight)
+                   "weight of %f%%", int(used), int(total),
+                   (100.0*used)/total, 100.0*weight)
 
-    # TODO: Can we base this check on statistical confidence intervals?
-    if self.total_use_counts >= REND_USE_GLOBAL_START_COUNT and \
-       self.use_counts[r].used >= REND_USE_RELAY_START_COUNT and \
-       self.use_counts[r].used/self.total_use_counts > \
-         self.use_counts[r].weight*REND_USE_MAX_USE_TO_BW_RATIO:
+    # Rather than the raw use rate, check the lowest rate that is likely
+    # given the counts so far. Over a few uses, that can still be well
+    # above a relay's limit. Over many, the rate is known closely enough
+    # that noise doesn't push it over.
+    if total >= REND_USE_GLOBAL_START_COUNT and \
+       used >= REND_USE_RELAY_START_COUNT and \
+       wilson_lower_bound(used, total, REND_USE_CONFIDENCE_Z) > \
+         weight*REND_USE_MAX_USE_TO_BW_RATIO:
 
         # Let's warn if they disable ciruit closing.
         if REND_USE_CLOSE_CIRCUITS_ON_OVERUSE:
@@ -70,65 +330,90 @@ class RendGuard:
           loglevel = "WARN"
         plog(loglevel, "Relay "+r_name+" used %d times out of %d, "+\
                      "for a use rate of %f%%. This is above its consensus "
-                     "weight of %f%%", int(self.use_counts[r].used),
-                     int(self.total_use_counts),
-                     (100.0*self.use_counts[r].used)/self.total_use_counts,
-                     100.0*self.use_counts[r].weight)
+                     "weight of %f%%", int(used), int(total),
+                     (100.0*used)/total, 100.0*weight)
+        if r == _NOT_IN_CONSENSUS_ID:
+          plog(loglevel, "Most used relays not in the consensus: "+
+               ", ".join("%s (%d, at most %d too high)" % (idhex, count,
+                                                          error)
+                         for (idhex, count, error)
+                           in self.off_consensus.top(now, 5)))
         return 0
     return 1
 
-  def xfer_use_counts(self, node_gen):
+  def xfer_use_counts(self, node_gen, now=None):
+    """Moves our use counts over to the relays in a new consensus, and
+    sets their weights from it. Counts of relays that left are dropped."""
+    if now is None:
+      now = time.time()
     old_counts = self.use_counts
-    self.use_counts = {}
-    for r in node_gen.sorted_r:
-       self.use_counts[r.fingerprint] = RendUseCount(r.fingerprint, 0)
-
-    if _NOT_IN_CONSENSUS_ID not in old_counts:
-      old_counts[_NOT_IN_CONSENSUS_ID] = \
-        RendUseCount(_NOT_IN_CONSENSUS_ID,
-                     REND_USE_MAX_CONSENSUS_WEIGHT_CHURN/100.0)
-
-    self.use_counts[_NOT_IN_CONSENSUS_ID] = \
-      RendUseCount(_NOT_IN_CONSENSUS_ID,
-                   REND_USE_MAX_CONSENSUS_WEIGHT_CHURN/100.0)
-
-    i = 0
-    rlen = len(node_gen.rstr_routers)
-    while i < rlen:
-      r = node_gen.rstr_routers[i]
-
-      if "Exit" in r.flags:
-        self.use_counts[r.fingerprint].weight = \
-           node_gen.node_weights[i]/node_gen.exit_total
-      else:
-        self.use_counts[r.fingerprint].weight = \
-           node_gen.node_weights[i]/node_gen.weight_total
-      i+=1
-
-    if self.total_use_counts >= REND_USE_SCALE_AT_COUNT:
-      plog("INFO", "Total use counts %d reached the scale count %d. Scaling.",
-           self.total_use_counts, REND_USE_SCALE_AT_COUNT)
-
-    # Periodically we divide counts by two, to avoid overcounting
-    # high-uptime relays vs old ones
-    for r in old_counts:
-      if r != _NOT_IN_CONSENSUS_ID and r not in self.use_counts:
-        continue
-      if self.total_use_counts >= REND_USE_SCALE_AT_COUNT:
-        self.use_counts[r].used = old_counts[r].used/2.0
-      else:
-        self.use_counts[r].used = old_counts[r].used
+    self.use_counts = old_counts.remap([r.fingerprint
+                                        for r in node_gen.sorted_r] +
+                                       [_NOT_IN_CONSENSUS_ID], now)
+
+    index = self.use_counts.index
+    used = old_counts.used
+    for (idhex, slot) in old_counts.index.items():
+      if used[slot] and idhex not in index:
+        self.dirty.add(idhex)
+
+    self._set_weights(node_gen)
 
+    # We're visiting every count anyway, so resum the total, rather than
+    # letting rounding errors build up in it.
+    self.total_use_counts = self.use_counts.total_at(now)
+    self.total_updated_at = now
+
+  def update_use_counts(self, node_gen, removed, added, now=None):
+    """Like xfer_use_counts(), but only adds and removes the relays that
+    changed since the last consensus. Relays in both 'removed' and 'added'
+    keep their counts."""
+    if now is None:
+      now = time.time()
+    counts = self.use_counts
+    self.decay_total(now)
+    for idhex in removed:
+      if idhex in counts:
+        counts.weight[counts.index[idhex]] = 0
+    kept = set(added)
+    for idhex in removed:
+      if idhex not in kept and idhex in counts:
+        used = counts.used_at(idhex, now)
+        if used:
+          self.total_use_counts -= used
+          self.dirty.add(idhex)
+        counts.remove(idhex)
+    self.total_use_counts = max(self.total_use_counts, 0.0)
+    for idhex in added:
+      if idhex not in counts:
+        counts.add(idhex, 0, 0, now)
+
+    self._set_weights(node_gen)
+
+  def _set_weights(self, node_gen):
+    counts = self.use_counts
+    index = counts.index
+    weight = counts.weight
+    weight_total = node_gen.weight_total
+    exit_total = node_gen.exit_total
+    for (r, w) in zip(node_gen.rstr_routers, node_gen.node_weights):
+      if r.flag_mask & _EXIT:
+        weight[index[r.fingerprint]] = w/exit_total
+      else:
+        weight[index[r.fingerprint]] = w/weight_total
 
-    self.total_use_counts = sum(map(lambda x: self.use_counts[x].used,
-                                    self.use_counts))
-    self.total_use_counts = float(self.total_use_counts)
+    if _NOT_IN_CONSENSUS_ID not in counts:
+      counts.add(_NOT_IN_CONSENSUS_ID, 0, 0)
+    weight[index[_NOT_IN_CONSENSUS_ID]] = \
+      REND_USE_MAX_CONSENSUS_WEIGHT_CHURN/100.0
 
   def circ_event(self, controller, event):
     if event.status == "BUILT" and \
        event.purpose == "HS_SERVICE_REND" and \
        event.hs_state == "HSSR_CONNECTING":
-      if not self.valid_rend_use(event.path[-1][0]):
+      with self.lock:
+        valid = self.valid_rend_use(event.path[-1][0])
+      if not valid:
         if REND_USE_CLOSE_CIRCUITS_ON_OVERUSE:
            control.try_close_circuit(controller, event.id)
 
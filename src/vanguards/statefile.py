@@ -0,0 +1,347 @@
+""" Compact state file format.
+
+    The state file holds our layer2 and layer3 guards, and rendguard's use
+    counts for every relay in the consensus. We rewrite it on every
+    consensus, so rather than pickling thousands of objects, we pack them
+    into fixed-width records. The rendguard counts are stored column by
+    column, so that each column converts in one call. The fingerprints in
+    that column are text, so that they split into strings in one call:
+
+      header:   magic "VGST", format version (uint16)
+      layer2:   count (uint32), then per guard: fingerprint (20 bytes),
+                chosen_at, expires_at (doubles)
+      layer3:   same as layer2
+      rendguard: time the counts are as of, total use count (doubles),
+                 whether there is a not-in-consensus count (bool), its
+                 used and weight (doubles), count (uint32), then the
+                 fingerprints (40 hex digits each, separated by newlines),
+                 the used counts and the weights (doubles)
+      off-consensus: count (uint32), then per relay: fingerprint
+                 (20 bytes), count, error (doubles), as of the rendguard
+                 time
+      trailer:  CRC32 of everything before it (uint32)
+
+    All integers and doubles are big-endian. Older state files are pickles,
+    which we can still read.
+
+    Changes to the use counts alone are appended to a log next to the state
+    file, rather than rewriting it:
+
+      header:   magic "VGDL", format version (uint16), CRC32 trailer of
+                the state file it follows
+      batches:  count, off-consensus count (uint32s), time the counts are
+                as of, total use count (doubles), CRC32 of the entries
+                (uint32), then per entry: fingerprint (20 bytes, zeros for
+                the not-in-consensus count), used (double), then the
+                off-consensus counts, like in the state file
+
+    Each entry holds a count's new value, so replaying the batches in order
+    gives the latest counts. Batches only have off-consensus counts if they
+    changed, in which case they replace them all. The log is replaced by a
+    new state file once it grows bigger than the state file.
+"""
+import binascii
+import os
+import struct
+import sys
+import zlib
+
+from array import array
+
+MAGIC = b"VGST"
+FORMAT_VERSION = 2 # Pickled state files were version 1
+
+_HEADER = struct.Struct(">4sH")
+_COUNT = struct.Struct(">I")
+_GUARD = struct.Struct(">20sdd")
+_TRACKED = struct.Struct(">20sdd")
+_REND_HEADER = struct.Struct(">dd?dd")
+_CRC = struct.Struct(">I")
+
+LOG_MAGIC = b"VGDL"
+_LOG_HEADER = struct.Struct(">4sH4s")
+_BATCH = struct.Struct(">IIddI")
+_DELTA = struct.Struct(">20sd")
+_NOT_IN_CONSENSUS_FP = b"\0"*20
+_NOT_IN_CONSENSUS_HEX = "0"*40
+
+def is_compact(data):
+  "Returns True if 'data' is a compact state file, rather than a pickle"
+  return data[:len(MAGIC)] == MAGIC
+
+def _fp_bytes(idhex):
+  return binascii.unhexlify(idhex)
+
+def _fp_hex(fp):
+  return binascii.hexlify(fp).decode("ascii").upper()
+
+def _fp_hexes(fps):
+  "Returns the idhexes of the fingerprints in 'fps', converted in one call"
+  fps = _fp_hex(b"".join(fps))
+  return [fps[i:i+40] for i in range(0, len(fps), 40)]
+
+def _unpack_records(record, data, offset, count):
+  """Returns 'count' 'record's from 'data' at 'offset', unpacked with one
+  struct call rather than one per record"""
+  fmt = record.format
+  if not isinstance(fmt, str):
+    fmt = fmt.decode("ascii") # Python 3 before 3.7
+  fields = struct.unpack_from(fmt[0] + fmt[1:]*count, data, offset)
+  width = len(fields)//count if count else 1
+  return list(zip(*[iter(fields)]*width))
+
+_LITTLE_ENDIAN = sys.byteorder == "little"
+
+def _pack_doubles(values):
+  "Returns 'values' as big-endian doubles"
+  values = array("d", values)
+  if _LITTLE_ENDIAN:
+    values.byteswap()
+  return getattr(values, "tobytes", getattr(values, "tostring", None))()
+
+def _unpack_doubles(data):
+  "Returns an array('d') of the big-endian doubles in 'data'"
+  values = array("d")
+  getattr(values, "frombytes", getattr(values, "fromstring", None))(data)
+  if _LITTLE_ENDIAN:
+    values.byteswap()
+  return values
+
+def _pack_tracked(off_consensus):
+  return b"".join(_TRACKED.pack(_fp_bytes(idhex), count, error)
+                  for (idhex, count, error) in off_consensus)
+
+def _unpack_tracked(data, offset, count):
+  records = _unpack_records(_TRACKED, data, offset, count)
+  return list(zip(_fp_hexes([r[0] for r in records]),
+                  [r[1] for r in records], [r[2] for r in records]))
+
+def pack(layer2, layer3, as_of, total_use_counts, not_in_consensus,
+         idhexes, used, weights, off_consensus):
+  """Returns the state file for the given state. 'layer2' and 'layer3' are
+  lists of (idhex, chosen_at, expires_at). The use counts are as of time
+  'as_of'. 'not_in_consensus' is the
+  (used, weight) of the relays that weren't in the consensus, or None.
+  'idhexes', 'used' and 'weights' are the columns of the other counts.
+  'off_consensus' is a list of (idhex, count, error) for the relays that
+  weren't in the consensus."""
+  parts = [_HEADER.pack(MAGIC, FORMAT_VERSION)]
+  for layer in (layer2, layer3):
+    parts.append(_COUNT.pack(len(layer)))
+    for (idhex, chosen_at, expires_at) in layer:
+      parts.append(_GUARD.pack(_fp_bytes(idhex), chosen_at, expires_at))
+
+  if not_in_consensus is None:
+    parts.append(_REND_HEADER.pack(as_of, total_use_counts, False, 0, 0))
+  else:
+    parts.append(_REND_HEADER.pack(as_of, total_use_counts, True,
+                                   not_in_consensus[0], not_in_consensus[1]))
+  parts.append(_COUNT.pack(len(idhexes)))
+  parts.append("\n".join(idhexes).encode("ascii"))
+  parts.append(_pack_doubles(used))
+  parts.append(_pack_doubles(weights))
+  parts.append(_COUNT.pack(len(off_consensus)))
+  parts.append(_pack_tracked(off_consensus))
+
+  data = b"".join(parts)
+  return data + _CRC.pack(zlib.crc32(data) & 0xffffffff)
+
+class _Reader:
+  def __init__(self, data):
+    self.data = data
+    self.offset = 0
+
+  def records(self, record, count):
+    end = self.offset + record.size*count
+    if end > len(self.data):
+      raise ValueError("State file is truncated")
+    ret = _unpack_records(record, self.data, self.offset, count)
+    self.offset = end
+    return ret
+
+  def record(self, record):
+    return self.records(record, 1)[0]
+
+  def raw(self, size):
+    if self.offset + size > len(self.data):
+      raise ValueError("State file is truncated")
+    self.offset += size
+    return self.data[self.offset - size:self.offset]
+
+def unpack(data):
+  """Reads a state file from pack(). Returns (layer2, layer3, as_of,
+  total_use_counts, not_in_consensus, idhexes, used, weights,
+  off_consensus), in the same form that pack() takes them, with 'used' and
+  'weights' as array('d')s.
+  Raises ValueError if 'data' is not a valid state file."""
+  if len(data) < _HEADER.size + _CRC.size:
+    raise ValueError("State file is truncated")
+  (crc,) = _CRC.unpack_from(data, len(data) - _CRC.size)
+  body = data[:-_CRC.size]
+  if zlib.crc32(body) & 0xffffffff != crc:
+    raise ValueError("State file checksum does not match")
+
+  reader = _Reader(body)
+  (magic, version) = reader.record(_HEADER)
+  if magic != MAGIC:
+    raise ValueError("Not a vanguards state file")
+  if version != FORMAT_VERSION:
+    raise ValueError("Unsupported state file version %d" % version)
+
+  layers = []
+  for i in range(2):
+    (count,) = reader.record(_COUNT)
+    guards = reader.records(_GUARD, count)
+    layers.append(list(zip(_fp_hexes([g[0] for g in guards]),
+                           [g[1] for g in guards], [g[2] for g in guards])))
+
+  (as_of, total_use_counts, has_not_in, not_in_used, not_in_weight) = \
+    reader.record(_REND_HEADER)
+  not_in_consensus = None
+  if has_not_in:
+    not_in_consensus = (not_in_used, not_in_weight)
+  (count,) = reader.record(_COUNT)
+  idhexes = []
+  if count:
+    idhexes = reader.raw(41*count - 1).decode("ascii").split("\n")
+    if len(idhexes) != count:
+      raise ValueError("State file has bad fingerprints")
+  used = _unpack_doubles(reader.raw(8*count))
+  weights = _unpack_doubles(reader.raw(8*count))
+  (count,) = reader.record(_COUNT)
+  off_consensus = _unpack_tracked(reader.raw(_TRACKED.size*count), 0, count)
+  if reader.offset != len(body):
+    raise ValueError("State file has trailing data")
+
+  return (layers[0], layers[1], as_of, total_use_counts, not_in_consensus,
+          idhexes, used, weights, off_consensus)
+
+_replace = getattr(os, "replace", os.rename) # Python 2 has no os.replace
+
+def _fsync_dir(dirname):
+  "Makes renames in 'dirname' durable. Windows can't open directories."
+  if not hasattr(os, "O_DIRECTORY"):
+    return
+  fd = os.open(dirname, os.O_RDONLY | os.O_DIRECTORY)
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+def atomic_write(filename, data):
+  """Writes 'data' to 'filename' through a temporary file, so that a crash
+  leaves either the old file or the new one, never a partial one."""
+  tmp_file = filename+".tmp"
+  with open(tmp_file, "wb") as f:
+    f.write(data)
+    f.flush()
+    os.fsync(f.fileno())
+  _replace(tmp_file, filename)
+  _fsync_dir(os.path.dirname(os.path.abspath(filename)))
+
+def pack_delta(as_of, total_use_counts, counts, off_consensus=None):
+  """Returns a log batch for 'counts', a list of (idhex, used) as of time
+  'as_of'. An idhex of None is the not-in-consensus count. If they changed,
+  'off_consensus' are the off-consensus counts, like pack() takes."""
+  entries = b"".join(_DELTA.pack(_NOT_IN_CONSENSUS_FP if idhex is None
+                                   else _fp_bytes(idhex), used)
+                     for (idhex, used) in counts)
+  entries += _pack_tracked(off_consensus or [])
+  return _BATCH.pack(len(counts), len(off_consensus or []), as_of,
+                     total_use_counts,
+                     zlib.crc32(entries) & 0xffffffff) + entries
+
+def unpack_log(data, snapshot_crc):
+  """Reads the batches from a log that follows the state file with CRC32
+  trailer 'snapshot_crc'. Returns (batches, length), where batches are
+  (as_of, total_use_counts, counts, off_consensus) like pack_delta() takes,
+  and length is how much of 'data' they came from. Anything after a torn
+  or corrupt batch is ignored, as is a log for some other state file or an
+  unknown format version."""
+  batches = []
+  if len(data) < _LOG_HEADER.size:
+    return (batches, 0)
+  (magic, version, crc) = _LOG_HEADER.unpack_from(data, 0)
+  if magic != LOG_MAGIC or crc != snapshot_crc or version != FORMAT_VERSION:
+    return (batches, 0)
+
+  offset = _LOG_HEADER.size
+  while offset + _BATCH.size <= len(data):
+    (count, tracked, as_of, total_use_counts, crc) = \
+      _BATCH.unpack_from(data, offset)
+    start = offset + _BATCH.size
+    end = start + _DELTA.size*count + _TRACKED.size*tracked
+    if end > len(data) or zlib.crc32(data[start:end]) & 0xffffffff != crc:
+      break
+    deltas = _unpack_records(_DELTA, data, start, count)
+    counts = [(None if idhex == _NOT_IN_CONSENSUS_HEX else idhex, d[1])
+              for (idhex, d) in zip(_fp_hexes([d[0] for d in deltas]),
+                                    deltas)]
+    off_consensus = None
+    if tracked:
+      off_consensus = _unpack_tracked(data, start + _DELTA.size*count,
+                                      tracked)
+    batches.append((as_of, total_use_counts, counts, off_consensus))
+    offset = end
+  return (batches, offset)
+
+class StateStore:
+  """Writes a state file and its log, and counts what it wrote"""
+  def __init__(self, filename):
+    self.filename = filename
+    self.log_file = filename+".log"
+    self.snapshot_crc = None # Trailer of the state file on disk, if known
+    self.snapshot_bytes = 0
+    self.log_bytes = 0
+    self.layers = None # Guard records in the state file on disk
+
+    self.bytes_written = 0
+    self.snapshots = 0
+    self.deltas = 0
+    self.skipped = 0
+
+  def read(self):
+    """Returns the state file's contents, and the batches from its log.
+    A torn or stale log is cut back to what we could use, so that we can
+    append to it."""
+    data = open(self.filename, "rb").read()
+    self.snapshot_crc = data[-_CRC.size:]
+    self.snapshot_bytes = len(data)
+
+    batches = []
+    self.log_bytes = 0
+    if os.path.exists(self.log_file):
+      log = open(self.log_file, "rb").read()
+      (batches, self.log_bytes) = unpack_log(log, self.snapshot_crc)
+      if self.log_bytes != len(log):
+        with open(self.log_file, "r+b") as f:
+          f.truncate(self.log_bytes)
+    return (data, batches)
+
+  def needs_compaction(self):
+    return self.log_bytes > self.snapshot_bytes
+
+  def write_snapshot(self, data, layers):
+    atomic_write(self.filename, data)
+    if os.path.exists(self.log_file):
+      os.remove(self.log_file)
+    self.snapshot_crc = data[-_CRC.size:]
+    self.snapshot_bytes = len(data)
+    self.log_bytes = 0
+    self.layers = layers
+    self.bytes_written += len(data)
+    self.snapshots += 1
+
+  def append_delta(self, as_of, total_use_counts, counts,
+                   off_consensus=None):
+    data = pack_delta(as_of, total_use_counts, counts, off_consensus)
+    if not self.log_bytes:
+      data = _LOG_HEADER.pack(LOG_MAGIC, FORMAT_VERSION, self.snapshot_crc) \
+             + data
+    with open(self.log_file, "ab") as f:
+      f.write(data)
+      f.flush()
+      os.fsync(f.fileno())
+    self.log_bytes += len(data)
+    self.bytes_written += len(data)
+    self.deltas += 1
@@ -1,22 +1,30 @@
 #!/usr/bin/env python
 
+import bisect
+import heapq
 import random
 import os
 import time
 import pickle
 import sys
 import string
+import threading
 
+from ipaddress import ip_address
 from ipaddress import ip_network as net
 
 import stem
 
 from .NodeSelection import BwWeightedGenerator, NodeRestrictionList
 from .NodeSelection import FlagsRestriction
+from .NodeSelection import RestrictionError
+from .NodeSelection import router_sort_key
 from .logger import plog
 
+from . import consensus
 from . import control
 from . import rendguard
+from . import statefile
 
 # Unicode, damnit
 try:
@@ -43,21 +51,189 @@ MAX_LAYER3_LIFETIME_HOURS = 48
 
 _SEC_PER_HOUR = (60*60)
 
+# Addresses to look up per GETINFO, when checking country excludes
+_GEOIP_BATCH_SIZE = 100
+
+# Seconds to wait before trying again, if rotating an expired guard failed
+_ROTATE_RETRY_SECS = 60
+
 class GuardNode:
   def __init__(self, idhex, chosen_at, expires_at):
     self.idhex = idhex
     self.chosen_at = chosen_at
     self.expires_at = expires_at
 
+class GuardLayers:
+  """Working copies of the layer2 and layer3 guard lists. Guards get
+  removed and picked on these, and they only replace our state's layers
+  once everything worked."""
+  def __init__(self, layer2, layer3):
+    self.layer2 = list(layer2)
+    self.layer3 = list(layer3)
+
+  # Returns a func that says which of a list of routers can't go in
+  # 'layer': either they're already in it, or 'excluded' (an ExcludeNodes)
+  # excludes them. It only gets asked about the routers we draw, so the
+  # GeoIP lookups for excluded countries are only done for those, in one
+  # batch per draw.
+  def _layer_excluded(self, layer, excluded):
+    in_layer = set(map(lambda g: g.idhex, layer))
+    def layer_mask(routers):
+      mask = excluded.exclusion_mask(routers)
+      return [m or r.fingerprint in in_layer for (r, m) in zip(routers, mask)]
+    return layer_mask
+
+  # Adds 'count' new layer2 guards, that 'excluded' (an ExcludeNodes)
+  # doesn't exclude
+  def add_new_layer2(self, generator, excluded, count=1):
+    for guard in generator.choose_distinct(count,
+                      self._layer_excluded(self.layer2, excluded)):
+      now = time.time()
+      expires = now + max(random.uniform(MIN_LAYER2_LIFETIME_HOURS*_SEC_PER_HOUR,
+                                         MAX_LAYER2_LIFETIME_HOURS*_SEC_PER_HOUR),
+                          random.uniform(MIN_LAYER2_LIFETIME_HOURS*_SEC_PER_HOUR,
+                                         MAX_LAYER2_LIFETIME_HOURS*_SEC_PER_HOUR))
+      self.layer2.append(GuardNode(guard.fingerprint, now, expires))
+      plog("INFO", "New layer2 guard: "+guard.fingerprint)
+
+  def add_new_layer3(self, generator, excluded, count=1):
+    for guard in generator.choose_distinct(count,
+                      self._layer_excluded(self.layer3, excluded)):
+      now = time.time()
+      expires = now + max(random.uniform(MIN_LAYER3_LIFETIME_HOURS*_SEC_PER_HOUR,
+                                         MAX_LAYER3_LIFETIME_HOURS*_SEC_PER_HOUR),
+                          random.uniform(MIN_LAYER3_LIFETIME_HOURS*_SEC_PER_HOUR,
+                                         MAX_LAYER3_LIFETIME_HOURS*_SEC_PER_HOUR))
+      self.layer3.append(GuardNode(guard.fingerprint, now, expires))
+      plog("INFO", "New layer3 guard: "+guard.fingerprint)
+
+  def remove_excluded_from_layer(self, layer, dict_r, excluded):
+    # Check the whole layer at once, so its countries get looked up in
+    # one batch
+    mask = excluded.exclusion_mask([dict_r[g.idhex] for g in layer])
+    for (g, is_excluded) in list(zip(layer, mask)):
+      if is_excluded:
+        layer.remove(g)
+        plog("INFO", "Removing newly-excluded guard "+g.idhex)
+
+  def remove_expired_from_layer(self, layer):
+    now = time.time()
+    for g in list(layer):
+      if g.expires_at < now:
+        layer.remove(g)
+        plog("INFO", "Removing expired guard "+g.idhex)
+
+  def remove_down_from_layer(self, layer, dict_r):
+    for g in list(layer):
+      if not g.idhex in dict_r:
+        layer.remove(g)
+        plog("INFO", "Removing down guard "+g.idhex)
+
+  def replenish_layers(self, generator, excluded):
+    # Trim layers in case params changed
+    self.layer2 = self.layer2[:NUM_LAYER2_GUARDS]
+    self.layer3 = self.layer3[:NUM_LAYER3_GUARDS]
+
+    if len(self.layer2) >= NUM_LAYER2_GUARDS and \
+       len(self.layer3) >= NUM_LAYER3_GUARDS:
+      return
+
+    if len(self.layer2) < NUM_LAYER2_GUARDS:
+      self.add_new_layer2(generator, excluded,
+                          NUM_LAYER2_GUARDS - len(self.layer2))
+
+    if len(self.layer3) < NUM_LAYER3_GUARDS:
+      self.add_new_layer3(generator, excluded,
+                          NUM_LAYER3_GUARDS - len(self.layer3))
+
+class CountryCache:
+  """Caches tor's answers to ip-to-country lookups, by address. Tor only
+  rereads its GeoIP files on SIGHUP, so entries stay valid across
+  consensuses until then, or until we connect to a different tor.
+
+  invalidate() runs on the event thread, while lookups can run on the
+  consensus thread. It swaps in a new dict rather than clearing the old
+  one, and lookups only use the dict they started with."""
+  def __init__(self):
+    self.countries = {} # key=address val=lowercase country or None
+    self.controller = None
+
+  def invalidate(self):
+    self.countries = {}
+
+  def lookup(self, controller, addresses):
+    """Looks up any of 'addresses' that we don't have yet, in batches.
+    Returns their countries, by address."""
+    if controller is not self.controller:
+      self.invalidate()
+      self.controller = controller
+
+    countries = self.countries
+    missing = sorted(set(a for a in addresses if a not in countries))
+    for i in range(0, len(missing), _GEOIP_BATCH_SIZE):
+      batch = missing[i:i+_GEOIP_BATCH_SIZE]
+      keys = list(map(lambda a: "ip-to-country/"+a, batch))
+      try:
+        vals = controller.get_info(keys)
+      except stem.ControllerError:
+        # One bad address fails the whole batch. Fall back to asking
+        # for them one at a time.
+        vals = {}
+        for k in keys:
+          vals[k] = controller.get_info(k, None)
+
+      for (addr, k) in zip(batch, keys):
+        country = vals.get(k)
+        countries[addr] = country.lower() if country != None else None
+    return dict((a, countries[a]) for a in addresses)
+
+  def country(self, controller, address):
+    return self.lookup(controller, [address])[address]
+
+class NetworkIndex:
+  """The address ranges of a list of networks, merged and sorted by start
+  address, per IP version. Checking an address is then a binary search on
+  integers, rather than an overlap test against each network in turn."""
+  def __init__(self, networks):
+    self.starts = {4: [], 6: []}
+    self.ends = {4: [], 6: []}
+
+    ranges = {4: [], 6: []}
+    for network in networks:
+      ranges[network.version].append((int(network.network_address),
+                                      int(network.broadcast_address)))
+
+    for version in ranges:
+      starts = self.starts[version]
+      ends = self.ends[version]
+      for (start, end) in sorted(ranges[version]):
+        if ends and start <= ends[-1] + 1:
+          ends[-1] = max(ends[-1], end)
+        else:
+          starts.append(start)
+          ends.append(end)
+
+  def contains(self, address):
+    addr = ip_address(unicode(address))
+    key = int(addr)
+    i = bisect.bisect_right(self.starts[addr.version], key) - 1
+    return i >= 0 and key <= self.ends[addr.version][i]
+
 class ExcludeNodes:
-  def __init__(self, controller):
+  def __init__(self, controller, country_cache=None):
     self.networks = []
     self.idhexes = set()
     self.nicks = set()
     self.countries = set()
+    self.geoip_available = {} # key=ipv4 or ipv6 val=bool
     self.controller = controller
+    # Pass in a cache that outlives us, to keep lookups across consensuses
+    if country_cache is None:
+      country_cache = CountryCache()
+    self.country_cache = country_cache
     self.exclude_unknowns = controller.get_conf("GeoIPExcludeUnknown")
     self._parse_line(controller.get_conf("ExcludeNodes"))
+    self.network_index = NetworkIndex(self.networks)
 
   def _parse_line(self, conf_line):
     # We assume Tor has validated the line already. So this parsing
@@ -99,44 +275,287 @@ class ExcludeNodes:
         self.countries.add("??")
         self.countries.add("a1")
 
-      if self.controller.get_info("ip-to-country/ipv4-available", "0") == "0":
+      if not self._geoip_available(False):
         plog("WARN", "ExcludeNodes contains countries, but Tor has no GeoIP file! "+
              "Tor is not excluding countries!")
       else:
         plog("INFO", "Excluding countries "+str(self.countries))
 
+  # Any of a router's addresses can get it excluded. or_addresses holds
+  # the extra (in practice, IPv6) addresses from the consensus 'a' lines.
+  def _addresses(self, r):
+    return [(r.address, r.or_port, False)] + \
+           list(getattr(r, "or_addresses", None) or [])
+
+  # Tor's GeoIP availability only changes on SIGHUP, so we ask once per
+  # consensus rather than once per address.
+  def _geoip_available(self, is_ipv6):
+    family = "ipv6" if is_ipv6 else "ipv4"
+    if family not in self.geoip_available:
+      self.geoip_available[family] = self.controller.get_info(
+                        "ip-to-country/"+family+"-available", "0") == "1"
+    return self.geoip_available[family]
+
   def router_is_excluded(self, r):
     if r.fingerprint in self.idhexes:
       return True
     if r.nickname in self.nicks:
       return True
-    if "or_addresses" in r.__dict__: # Stem 1.7.0 only
-      addresses = r.or_addresses
-    else:
-      addresses = [(r.address, 9001, False)]
-    for addr in addresses:
+    for addr in self._addresses(r):
       is_ipv6 = addr[2]
-      if len(self.countries):
-        country = None
-        if is_ipv6 and \
-          self.controller.get_info("ip-to-country/ipv6-available", "0") == "1":
-          country = self.controller.get_info("ip-to-country/"+addr[0])
-        if not is_ipv6 and \
-          self.controller.get_info("ip-to-country/ipv4-available", "0") == "1":
-          country = self.controller.get_info("ip-to-country/"+addr[0])
-
-        if country != None and country.lower() in self.countries:
+      if len(self.countries) and self._geoip_available(is_ipv6):
+        country = self.country_cache.country(self.controller, addr[0])
+        if country != None and country in self.countries:
           return True
 
-      for network in self.networks:
-        if is_ipv6:
-          if network.version == 6 and net(addr[0]+"/128").overlaps(network):
-            return True
-        else:
-          if network.version == 4 and net(addr[0]+"/32").overlaps(network):
-            return True
+      if len(self.networks) and self.network_index.contains(addr[0]):
+        return True
     return False
 
+  def exclusion_mask(self, routers):
+    "Returns a list of bools saying which of 'routers' are excluded"
+    if len(self.countries):
+      # Fetch every country we need up front, in batches
+      self.country_cache.lookup(self.controller,
+                                [addr[0] for r in routers
+                                   for addr in self._addresses(r)
+                                     if self._geoip_available(addr[2])])
+    return [self.router_is_excluded(r) for r in routers]
+
+def _router_changed(old, new):
+  return old.measured != new.measured or old.flag_mask != new.flag_mask or \
+         old.address != new.address or old.nickname != new.nickname or \
+         old.or_addresses != new.or_addresses
+
+class ConsensusIndex:
+  """The routers and node generators built from the last consensus. A new
+  consensus with the same bandwidth-weights is applied to them as a diff,
+  rather than rebuilding them all."""
+  def __init__(self, sorted_r, dict_r, weights):
+    self.weights = weights
+    self.sorted_r = sorted_r
+    self.dict_r = dict_r
+    self.sort_keys = list(map(router_sort_key, sorted_r))
+
+    self.layer_gen = BwWeightedGenerator(sorted_r,
+                       NodeRestrictionList(
+                             [FlagsRestriction(["Fast", "Stable", "Valid"],
+                                               ["Authority"])]),
+                             weights, BwWeightedGenerator.POSITION_MIDDLE)
+
+    self.rend_gen = BwWeightedGenerator(sorted_r,
+                       NodeRestrictionList(
+                             [FlagsRestriction(["Fast", "Valid"],
+                                               ["Authority"])]),
+                             weights, BwWeightedGenerator.POSITION_MIDDLE)
+
+    # Repair Exit-flagged node weights, since they can be chosen
+    # sometimes by other clients as RPs (when cannibalized)
+    self.rend_gen.repair_exits()
+
+  def update(self, routers):
+    """Applies the consensus 'routers' (ConsensusRouters) as a diff
+    against the last one.
+    Returns the (removed, added) routers, sorted. Changed routers are in
+    both."""
+    removed = []
+    added = []
+    new_fps = set()
+    dict_r = self.dict_r
+    for r in routers:
+      new_fps.add(r.fingerprint)
+      old = dict_r.get(r.fingerprint)
+      if old is None:
+        added.append(r)
+      elif old is not r and _router_changed(old, r):
+        removed.append(old)
+        added.append(r)
+    for fp in set(self.dict_r) - new_fps:
+      removed.append(self.dict_r[fp])
+    removed.sort(key = router_sort_key)
+    added.sort(key = router_sort_key)
+
+    for r in removed:
+      key = router_sort_key(r)
+      i = bisect.bisect_left(self.sort_keys, key)
+      del self.sort_keys[i]
+      del self.sorted_r[i]
+      del self.dict_r[r.fingerprint]
+    for r in added:
+      key = router_sort_key(r)
+      i = bisect.bisect_left(self.sort_keys, key)
+      self.sort_keys.insert(i, key)
+      self.sorted_r.insert(i, r)
+      self.dict_r[r.fingerprint] = r
+
+    for gen in (self.layer_gen, self.rend_gen):
+      gen.update_routers(removed, added)
+      gen.sorted_r = self.sorted_r
+
+    if removed or added:
+      plog("INFO", "Applied consensus diff: %d relays removed, %d added.",
+           len(removed), len(added))
+    return (removed, added)
+
+class ConsensusSnapshot:
+  """The result of build_consensus(): the new consensus index and guard
+  layers, and the relays that changed (None after a full rebuild)."""
+  def __init__(self, index, layer2, layer3, removed, added):
+    self.index = index
+    self.layer2 = layer2
+    self.layer3 = layer3
+    self.removed = removed
+    self.added = added
+
+class EventLag:
+  """The most that the CIRC and CIRC_BW events we handled lagged behind
+  tor, while a consensus was being processed and swapped in. Those events
+  keep coming while ConsensusUpdater works in the background, so this is
+  how far behind the work left us. Stem only stamps events with whole
+  seconds, so this can be up to a second high."""
+  def __init__(self):
+    self.tracking = False
+    self.max_lag = 0.0
+
+  def start(self):
+    self.max_lag = 0.0
+    self.tracking = True
+
+  def stop(self):
+    self.tracking = False
+    return self.max_lag
+
+  def event(self, event):
+    if self.tracking:
+      lag = time.time() - event.arrived_at
+      if lag > self.max_lag:
+        self.max_lag = lag
+
+class ConsensusUpdater:
+  """Runs new_consensus_event() on a background thread, so that circuit
+  and bandwidth events keep getting handled while we read the consensus,
+  look up ExcludeNodes, pick guards, and write our state file. Consensuses
+  that arrive while one is being processed are coalesced into one more
+  run."""
+  def __init__(self, state, controller):
+    self.state = state
+    self.controller = controller
+    self.lock = threading.Lock()
+    self.running = False
+    self.pending = False
+    self.event = None # The newest consensus event we haven't processed
+    self.thread = None
+
+  def new_consensus_event(self, event):
+    with self.lock:
+      self.event = event
+      if self.running:
+        self.pending = True
+        return
+      self.running = True
+    self.thread = threading.Thread(target=self._run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _run(self):
+    while True:
+      with self.lock:
+        event = self.event
+        self.event = None
+      try:
+        self.state.new_consensus_event(self.controller, event)
+      except SystemExit:
+        # This is fatal, but exiting only ends this thread. Drop the
+        # connection, so the main thread reconnects and hits it again.
+        plog("ERROR", "Can't process the new consensus. Reconnecting.")
+        if hasattr(self.controller, "close"):
+          self.controller.close()
+      except Exception as e:
+        plog("WARN", "Can't process the new consensus: "+str(e))
+
+      with self.lock:
+        if not self.pending:
+          self.running = False
+          return
+        self.pending = False
+
+  def busy(self):
+    with self.lock:
+      return self.running
+
+class GuardRotator:
+  """Rotates layer2 and layer3 guards as soon as they expire, rather than
+  waiting for the next consensus. Expiry times are kept in a min-heap, so
+  checking costs nothing until a guard is due. Replacements are chosen
+  from the node generator of the last consensus, without reading it
+  again, and only the layers that changed get sent to tor.
+
+  check_expiry() must run on the same thread as new_consensus_event(), so
+  that it can't start a consensus update while we rotate."""
+  def __init__(self, state, controller, updater=None):
+    self.state = state
+    self.controller = controller
+    self.updater = updater
+    self.heap = [] # (expires_at, idhex)
+    # The layer lists the heap was built from. A consensus swaps in new
+    # ones.
+    self.layer2 = None
+    self.layer3 = None
+    self.retry_at = 0 # Don't try again before this, after a failure
+
+  def schedule(self):
+    self.layer2 = self.state.layer2
+    self.layer3 = self.state.layer3
+    self.retry_at = 0
+    self.heap = [(g.expires_at, g.idhex) for g in self.layer2 + self.layer3]
+    heapq.heapify(self.heap)
+
+  def bw_event(self, event):
+    self.check_expiry(time.time())
+
+  def check_expiry(self, now):
+    state = self.state
+    if state.layer2 is not self.layer2 or state.layer3 is not self.layer3:
+      self.schedule()
+    if not self.heap or self.heap[0][0] >= now or now < self.retry_at:
+      return
+
+    # The consensus update removes expired guards itself
+    if state.consensus_index is None or \
+       (self.updater and self.updater.busy()):
+      return
+
+    # Rotate on copies, so that a failure leaves our layers as they were.
+    # The expired guards stay in the heap until we succeed.
+    layers = GuardLayers(state.layer2, state.layer3)
+    layers.remove_expired_from_layer(layers.layer2)
+    layers.remove_expired_from_layer(layers.layer3)
+    try:
+      layers.replenish_layers(state.consensus_index.layer_gen,
+                              ExcludeNodes(self.controller,
+                                           state.country_cache))
+    except (RestrictionError, stem.ControllerError) as e:
+      plog("WARN", "Can't replace expired guards (%s). Trying again in "
+           "%d seconds.", str(e), _ROTATE_RETRY_SECS)
+      self.retry_at = now + _ROTATE_RETRY_SECS
+      return
+
+    old_layer2 = state.layer2_guardset()
+    old_layer3 = state.layer3_guardset()
+    state.layer2 = layers.layer2
+    state.layer3 = layers.layer3
+    self.schedule()
+
+    if state.layer2_guardset() != old_layer2:
+      self.controller.set_conf("HSLayer2Nodes", state.layer2_guardset())
+    if NUM_LAYER3_GUARDS and state.layer3_guardset() != old_layer3:
+      self.controller.set_conf("HSLayer3Nodes", state.layer3_guardset())
+
+    try:
+      state.write_state_file()
+    except (IOError, OSError) as e:
+      plog("ERROR", "Cannot write state to "+state.state_file+": "+str(e))
+
 class VanguardState:
   def __init__(self, state_file):
     self.layer2 = []
@@ -145,65 +564,103 @@ class VanguardState:
     self.rendguard = rendguard.RendGuard()
     self.pickle_revision = 1
     self.enable_vanguards = True # Set from main, irrelevant to pickle
+    self.consensus_index = None # Rebuilt from each consensus, not pickled
+    self.store = None # Our statefile.StateStore, once we read or write one
+    self.country_cache = CountryCache() # Tor's GeoIP answers, not pickled
+    self.event_lag = EventLag() # Not pickled
+
+  def __getstate__(self):
+    state = dict(self.__dict__)
+    state.pop("consensus_index", None)
+    state.pop("store", None)
+    state.pop("country_cache", None)
+    state.pop("event_lag", None)
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.consensus_index = None
+    self.store = None
+    self.country_cache = CountryCache()
+    self.event_lag = EventLag()
 
   def set_state_file(self, state_file):
     self.state_file = state_file
+    self.store = None
 
   def sort_and_index_routers(self, routers):
-    sorted_r = list(routers)
+    sorted_r = consensus.compact_routers(routers)
     dict_r = {}
 
-    for r in sorted_r:
-      if r.measured == None:
-        # FIXME: Hrmm...
-        r.measured = r.bandwidth
-    sorted_r.sort(key = lambda x: x.measured, reverse = True)
+    sorted_r.sort(key = router_sort_key)
     for r in sorted_r: dict_r[r.fingerprint] = r
     return (sorted_r, dict_r)
 
   def consensus_update(self, routers, weights, exclude):
-    (sorted_r, dict_r) = self.sort_and_index_routers(routers)
-    ng = BwWeightedGenerator(sorted_r,
-                       NodeRestrictionList(
-                             [FlagsRestriction(["Fast", "Stable", "Valid"],
-                                               ["Authority"])]),
-                             weights, BwWeightedGenerator.POSITION_MIDDLE)
-    gen = ng.generate()
+    self.apply_consensus(self.build_consensus(routers, weights, exclude))
+
+  def build_consensus(self, routers, weights, exclude):
+    """Does the work for a new consensus, without changing any of the state
+    that our event handlers use. Returns a ConsensusSnapshot to hand to
+    apply_consensus()."""
+    # Only the relays that changed since the last consensus need work,
+    # unless the bandwidth-weights changed too. The index is only used
+    # by consensus processing, so updating it in place is fine.
+    index = self.consensus_index
+    # Don't keep a half-updated index if this fails
+    self.consensus_index = None
+    if index and index.weights == weights:
+      (removed, added) = index.update(consensus.compact_routers(routers))
+    else:
+      (sorted_r, dict_r) = self.sort_and_index_routers(routers)
+      index = ConsensusIndex(sorted_r, dict_r, weights)
+      removed = added = None
+
+    # Select guards on copies of our layers
+    layers = GuardLayers(self.layer2, self.layer3)
+
+    dict_r = index.dict_r
+    ng = index.layer_gen
     if self.enable_vanguards:
       # Remove any nodes that are now down in the consensus
-      self.remove_down_from_layer(self.layer2, dict_r)
-      self.remove_down_from_layer(self.layer3, dict_r)
+      layers.remove_down_from_layer(layers.layer2, dict_r)
+      layers.remove_down_from_layer(layers.layer3, dict_r)
 
-      # Remove any nodes whose rotation times are past due.
-      # FIXME: We should check this more often... But we also
-      # need to replenish our layers if they get too low/empty.
-      # This can be slow (consensus parse required)... :/
-      self.remove_expired_from_layer(self.layer2)
-      self.remove_expired_from_layer(self.layer3)
+      # Remove any nodes whose rotation times are past due. GuardRotator
+      # usually gets to them first, but not while we're running.
+      layers.remove_expired_from_layer(layers.layer2)
+      layers.remove_expired_from_layer(layers.layer3)
 
       # Remove any nodes in case ExcludeNodes changed.
-      self.remove_excluded_from_layer(self.layer2, dict_r, exclude)
-      self.remove_excluded_from_layer(self.layer3, dict_r, exclude)
+      layers.remove_excluded_from_layer(layers.layer2, dict_r, exclude)
+      layers.remove_excluded_from_layer(layers.layer3, dict_r, exclude)
 
       # Replenish our guard lists with new nodes
-      self.replenish_layers(gen, exclude)
+      layers.replenish_layers(ng, exclude)
 
-    ng = BwWeightedGenerator(sorted_r,
-                       NodeRestrictionList(
-                             [FlagsRestriction(["Fast", "Valid"],
-                                               ["Authority"])]),
-                             weights, BwWeightedGenerator.POSITION_MIDDLE)
+    return ConsensusSnapshot(index, layers.layer2, layers.layer3,
+                             removed, added)
+
+  def apply_consensus(self, snapshot):
+    """Swaps in a snapshot from build_consensus(). Only rendguard's use
+    counting waits for this."""
+    self.layer2 = snapshot.layer2
+    self.layer3 = snapshot.layer3
+    self.consensus_index = snapshot.index
 
-    # Repair Exit-flagged node weights, since they can be chosen
-    # sometimes by other clients as RPs (when cannibalized)
-    ng.repair_exits()
     # Transfer and scale RP use counts to this consensus
-    self.rendguard.xfer_use_counts(ng)
+    with self.rendguard.lock:
+      if snapshot.removed is None:
+        self.rendguard.xfer_use_counts(snapshot.index.rend_gen)
+      else:
+        self.rendguard.update_use_counts(snapshot.index.rend_gen,
+                                [r.fingerprint for r in snapshot.removed],
+                                [r.fingerprint for r in snapshot.added])
 
   def new_consensus_event(self, controller, event):
-    routers = controller.get_network_statuses()
-
-    exclude_nodes = ExcludeNodes(controller)
+    start = time.time()
+    self.event_lag.start()
+    exclude_nodes = ExcludeNodes(controller, self.country_cache)
 
     data_dir = controller.get_conf("DataDirectory")
     if data_dir == None:
@@ -215,24 +672,40 @@ class VanguardState:
                              "cached-microdesc-consensus")
 
     try:
-      weights = control.get_consensus_weights(consensus_file)
-    except IOError as e:
-      raise stem.DescriptorUnavailable("Cannot read "+consensus_file+": "+str(e))
-
-    self.consensus_update(routers, weights, exclude_nodes)
+      (routers, weights) = consensus.read_consensus(consensus_file)
+    except (IOError, OSError, ValueError) as e:
+      plog("INFO", "Can't read "+consensus_file+" ourselves ("+str(e)+
+           "). Asking Tor for the consensus instead.")
+      routers = controller.get_network_statuses()
+      try:
+        weights = control.get_consensus_weights(consensus_file)
+      except IOError as e:
+        raise stem.DescriptorUnavailable("Cannot read "+consensus_file+": "+str(e))
+
+    snapshot = self.build_consensus(routers, weights, exclude_nodes)
+
+    swap_start = time.time()
+    self.apply_consensus(snapshot)
+    swap_secs = time.time() - swap_start
 
     if self.enable_vanguards:
       self.configure_tor(controller)
 
     try:
-      self.write_to_file(open(self.state_file, "wb"))
-    except IOError as e:
+      self.write_state_file()
+    except (IOError, OSError) as e:
       plog("ERROR", "Cannot write state to "+self.state_file+": "+str(e))
       sys.exit(1)
 
+    plog("INFO", "Processed new consensus in %.3fs. Swapping it in took "
+         "%.1fms. Circuit events lagged by up to %.0fs meanwhile.",
+         time.time() - start, 1000*swap_secs, self.event_lag.stop())
+
   def signal_event(self, controller, event):
     if event.signal == "RELOAD":
       plog("NOTICE", "Tor got SIGHUP. Reapplying vanguards.")
+      # Tor rereads its GeoIP files on SIGHUP
+      self.country_cache.invalidate()
       self.configure_tor(controller)
 
   def configure_tor(self, controller):
@@ -253,12 +726,145 @@ class VanguardState:
            "Vanguards requires Tor 0.3.3.x (and ideally 0.3.4.x or newer).")
       sys.exit(1)
 
+  def _layer_records(self):
+    return ([(g.idhex, g.chosen_at, g.expires_at) for g in self.layer2],
+            [(g.idhex, g.chosen_at, g.expires_at) for g in self.layer3])
+
+  # Must be called with the rendguard lock held. Use counts are written
+  # as of 'now', so that they can share one timestamp.
+  def _pack(self, layers, now):
+    rg = self.rendguard
+    counts = rg.use_counts
+    not_in_consensus = None
+    not_in_id = rendguard._NOT_IN_CONSENSUS_ID
+    if not_in_id in counts:
+      not_in_consensus = (counts.used_at(not_in_id, now),
+                          counts.weight_of(not_in_id))
+    (idhexes, used, weights) = counts.columns(now)
+    if not_in_consensus is not None:
+      slot = idhexes.index(not_in_id)
+      del idhexes[slot]
+      del used[slot]
+      del weights[slot]
+    return statefile.pack(layers[0], layers[1], now, rg.total_at(now),
+                          not_in_consensus, idhexes, used, weights,
+                          rg.off_consensus.top(now))
+
+  def to_bytes(self):
+    "Returns our state in the statefile format"
+    layers = self._layer_records()
+    # Rendguard keeps counting while we write from the background
+    with self.rendguard.lock:
+      return self._pack(layers, time.time())
+
+  @staticmethod
+  def from_bytes(data, state_file):
+    "Returns the VanguardState in 'data', from to_bytes()"
+    (layer2, layer3, as_of, total_use_counts, not_in_consensus,
+     idhexes, used, weights, off_consensus) = statefile.unpack(data)
+    ret = VanguardState(state_file)
+    ret.layer2 = [GuardNode(*g) for g in layer2]
+    ret.layer3 = [GuardNode(*g) for g in layer3]
+
+    rg = ret.rendguard
+    rg.total_use_counts = total_use_counts
+    rg.total_updated_at = as_of
+    rg.use_counts = rendguard.UseCountTable(idhexes, as_of)
+    rg.use_counts.used = used
+    rg.use_counts.weight = weights
+    if not_in_consensus is not None:
+      rg.use_counts.add(rendguard._NOT_IN_CONSENSUS_ID, not_in_consensus[1],
+                        not_in_consensus[0], as_of)
+    rg.off_consensus.set(off_consensus, as_of)
+    return ret
+
   def write_to_file(self, outfile):
-    return pickle.dump(self, outfile)
+    outfile.write(self.to_bytes())
+
+  def write_state_file(self):
+    """Saves whatever changed since our state was last saved. Guard
+    changes atomically replace the state file. Use count changes get
+    appended to its log, until the log outgrows it. Nothing gets written if
+    nothing changed. Counts decaying over time is not a change, since they
+    are saved with the time they are as of."""
+    if self.store is None:
+      self.store = statefile.StateStore(self.state_file)
+    store = self.store
+    rg = self.rendguard
+    layers = self._layer_records()
+    snapshot = counts = off_consensus = None
+    now = time.time()
+
+    with rg.lock:
+      if store.snapshot_crc is None or layers != store.layers or \
+         rg.dirty_all or store.needs_compaction():
+        snapshot = self._pack(layers, now)
+      elif rg.dirty or rg.off_consensus_dirty:
+        counts = []
+        for idhex in rg.dirty:
+          used = 0
+          if idhex in rg.use_counts:
+            used = rg.use_counts.used_at(idhex, now)
+          if idhex == rendguard._NOT_IN_CONSENSUS_ID:
+            idhex = None
+          counts.append((idhex, used))
+        total_use_counts = rg.total_at(now)
+        if rg.off_consensus_dirty:
+          off_consensus = rg.off_consensus.top(now)
+      rg.dirty = set()
+      rg.dirty_all = False
+      rg.off_consensus_dirty = False
+
+    try:
+      if snapshot:
+        store.write_snapshot(snapshot, layers)
+      elif counts is not None:
+        store.append_delta(now, total_use_counts, counts, off_consensus)
+      else:
+        store.skipped += 1
+    except (IOError, OSError):
+      # We don't know what made it to disk. Start over next time.
+      rg.dirty_all = True
+      raise
+
+    plog("DEBUG", "State file: %d rewrites, %d log appends, %d skipped. "
+         "%d bytes written in all.", store.snapshots, store.deltas,
+         store.skipped, store.bytes_written)
+
+  def _apply_log(self, batches):
+    rg = self.rendguard
+    for (as_of, total_use_counts, counts, off_consensus) in batches:
+      for (idhex, used) in counts:
+        if idhex is None:
+          idhex = rendguard._NOT_IN_CONSENSUS_ID
+        if idhex in rg.use_counts:
+          slot = rg.use_counts.index[idhex]
+          rg.use_counts.used[slot] = used
+          rg.use_counts.updated_at[slot] = as_of
+        elif used:
+          # Its weight comes with the next consensus
+          rg.use_counts.add(idhex, 0, used, as_of)
+      if off_consensus is not None:
+        rg.off_consensus.set(off_consensus, as_of)
+      rg.total_use_counts = total_use_counts
+      rg.total_updated_at = as_of
 
   @staticmethod
   def read_from_file(infile):
-    ret = pickle.load(open(infile, "rb"))
+    store = statefile.StateStore(infile)
+    (data, batches) = store.read()
+    if statefile.is_compact(data):
+      ret = VanguardState.from_bytes(data, infile)
+      ret._apply_log(batches)
+      store.layers = ret._layer_records()
+      ret.store = store
+      return ret
+
+    # State files used to be pickles. We write them back out in the
+    # new format after the next consensus.
+    ret = pickle.loads(data)
+    plog("NOTICE", "Read pickled state file "+infile+". It will be "
+                   "rewritten in the new format.")
     ret.set_state_file(infile)
     return ret
 
@@ -267,62 +873,3 @@ class VanguardState:
 
   def layer3_guardset(self):
     return ",".join(map(lambda g: g.idhex, self.layer3))
-
-  # Adds a new layer2 guard
-  def add_new_layer2(self, generator, excluded):
-    guard = next(generator)
-    while guard.fingerprint in map(lambda g: g.idhex, self.layer2) or \
-      excluded.router_is_excluded(guard):
-      guard = next(generator)
-
-    now = time.time()
-    expires = now + max(random.uniform(MIN_LAYER2_LIFETIME_HOURS*_SEC_PER_HOUR,
-                                       MAX_LAYER2_LIFETIME_HOURS*_SEC_PER_HOUR),
-                        random.uniform(MIN_LAYER2_LIFETIME_HOURS*_SEC_PER_HOUR,
-                                       MAX_LAYER2_LIFETIME_HOURS*_SEC_PER_HOUR))
-    self.layer2.append(GuardNode(guard.fingerprint, now, expires))
-    plog("INFO", "New layer2 guard: "+guard.fingerprint)
-
-  def add_new_layer3(self, generator, excluded):
-    guard = next(generator)
-    while guard.fingerprint in map(lambda g: g.idhex, self.layer3) or \
-      excluded.router_is_excluded(guard):
-      guard = next(generator)
-
-    now = time.time()
-    expires = now + max(random.uniform(MIN_LAYER3_LIFETIME_HOURS*_SEC_PER_HOUR,
-                                       MAX_LAYER3_LIFETIME_HOURS*_SEC_PER_HOUR),
-                        random.uniform(MIN_LAYER3_LIFETIME_HOURS*_SEC_PER_HOUR,
-                                       MAX_LAYER3_LIFETIME_HOURS*_SEC_PER_HOUR))
-    self.layer3.append(GuardNode(guard.fingerprint, now, expires))
-    plog("INFO", "New layer3 guard: "+guard.fingerprint)
-
-  def remove_excluded_from_layer(self, layer, dict_r, excluded):
-    for g in list(layer):
-      if excluded.router_is_excluded(dict_r[g.idhex]):
-        layer.remove(g)
-        plog("INFO", "Removing newly-excluded guard "+g.idhex)
-
-  def remove_expired_from_layer(self, layer):
-    now = time.time()
-    for g in list(layer):
-      if g.expires_at < now:
-        layer.remove(g)
-        plog("INFO", "Removing expired guard "+g.idhex)
-
-  def remove_down_from_layer(self, layer, dict_r):
-    for g in list(layer):
-      if not g.idhex in dict_r:
-        layer.remove(g)
-        plog("INFO", "Removing down guard "+g.idhex)
-
-  def replenish_layers(self, generator, excluded):
-    # Trim layers in case params changed
-    self.layer2 = self.layer2[:NUM_LAYER2_GUARDS]
-    self.layer3 = self.layer3[:NUM_LAYER3_GUARDS]
-
-    while len(self.layer2) < NUM_LAYER2_GUARDS:
-      self.add_new_layer2(generator, excluded)
-
-    while len(self.layer3) < NUM_LAYER3_GUARDS:
-      self.add_new_layer3(generator, excluded)
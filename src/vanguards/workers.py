@@ -0,0 +1,286 @@
+""" Multi-process mode.
+
+    The parent (ingest) process owns the one control port connection. It
+    forwards each raw event, unparsed, to the worker processes that
+    subscribed to its type. Workers run the usual components against a
+    WorkerController, which sends commands (CLOSECIRCUIT, SETCONF, GETINFO,
+    etc) back to the ingest process to run on the real connection.
+
+    This replaces running several vanguards instances with
+    vanguards_parallel.sh, which made tor send every event once per
+    instance.
+"""
+import multiprocessing
+import pickle
+import threading
+import time
+
+import stem
+import stem.response
+
+from stem.response import ControlMessage
+
+from . import config
+from . import consensus
+from . import fastevents
+
+from .logger import plog
+
+# Which components each worker runs, by config.py option name. Workers
+# only get started if at least one of their components is enabled.
+_WORKERS = [
+  ("vanguards", ["ENABLE_VANGUARDS", "ENABLE_RENDGUARD"]),
+  ("bandguards", ["ENABLE_BANDGUARDS", "ENABLE_CBTVERIFY",
+                  "ENABLE_PATHVERIFY"]),
+  ("logguard", ["ENABLE_LOGGUARD"]),
+]
+
+# How long to wait for workers to exit before killing them
+_WORKER_EXIT_SECS = 5
+
+def _rebuild_exception(cls, msg):
+  # Stem's exceptions have differing constructors, so we can't rely on
+  # pickle or cls(msg) to rebuild them.
+  e = cls.__new__(cls)
+  Exception.__init__(e, msg)
+  e.message = msg
+  return e
+
+def _pickle_reply(reply):
+  # The queue would pickle the reply on its feeder thread, where failures
+  # just get logged and the worker waits for the reply forever. Pickle it
+  # here instead, and send the worker the error.
+  try:
+    return pickle.dumps(reply, pickle.HIGHEST_PROTOCOL)
+  except Exception as e:
+    return pickle.dumps((reply[0], False,
+                         (stem.ControllerError,
+                          "Can't send the reply to the worker: "+str(e))),
+                        pickle.HIGHEST_PROTOCOL)
+
+class WorkerController:
+  """Stands in for stem's Controller inside a worker process. Commands are
+  proxied to the ingest process, and events arrive from it."""
+  def __init__(self, name, cmd_queue, reply_queue):
+    self.name = name
+    self.cmd_queue = cmd_queue
+    self.reply_queue = reply_queue
+    self.listeners = {} # key=event type val=list of funcs
+    self.next_req_id = 0
+    self._logguard = None
+    # Consensus processing sends commands from its own thread
+    self.call_lock = threading.Lock()
+
+  def _call(self, method, *args):
+    with self.call_lock:
+      self.next_req_id += 1
+      self.cmd_queue.put((self.name, self.next_req_id, method, args))
+
+      while True:
+        (req_id, ok, result) = pickle.loads(self.reply_queue.get())
+        if req_id == self.next_req_id:
+          break
+
+    if not ok:
+      raise _rebuild_exception(result[0], result[1])
+    return result
+
+  def add_event_listener(self, func, *events):
+    for ev in events:
+      if ev not in self.listeners:
+        self.listeners[ev] = []
+        self._call("add_event_listener", ev)
+      self.listeners[ev].append(func)
+
+  def close_circuit(self, circ_id):
+    return self._call("close_circuit", circ_id)
+
+  def get_conf(self, key, default=None):
+    return self._call("get_conf", key, default)
+
+  def set_conf(self, key, val):
+    return self._call("set_conf", key, val)
+
+  def save_conf(self):
+    return self._call("save_conf")
+
+  def get_info(self, key, default=None):
+    return self._call("get_info", key, default)
+
+  def get_network_statuses(self):
+    return self._call("get_network_statuses")
+
+  def get_version(self):
+    return self._call("get_version")
+
+  def signal(self, sig):
+    return self._call("signal", sig)
+
+  def handle_event(self, raw, arrived_at):
+    event_message = ControlMessage.from_str(raw, arrived_at=arrived_at)
+    event = None
+    if config.ENABLE_FASTEVENTS:
+      event = fastevents.parse_event(event_message)
+    if event is None:
+      stem.response.convert("EVENT", event_message)
+      event = event_message
+
+    for func in self.listeners.get(event.type, []):
+      try:
+        func(event)
+      except Exception as e:
+        plog("WARN", "Worker "+self.name+" listener raised an exception ("+
+             str(e)+"): "+raw)
+
+def _worker_main(name, setup_listeners, state,
+                 event_queue, cmd_queue, reply_queue):
+  # This is our own process, so we can just switch off the components
+  # that other workers are running.
+  for (worker, options) in _WORKERS:
+    if worker != name:
+      for opt in options:
+        setattr(config, opt, False)
+
+  controller = WorkerController(name, cmd_queue, reply_queue)
+  setup_listeners(controller, state)
+
+  while True:
+    item = event_queue.get()
+    if item[0] == "event":
+      controller.handle_event(item[1], item[2])
+    elif item[0] == "dump":
+      if controller._logguard:
+        controller._logguard.dump_log_queue(item[1], "Pre")
+    elif item[0] == "stop":
+      break
+
+class WorkerHandle:
+  def __init__(self, name, process, event_queue, reply_queue):
+    self.name = name
+    self.process = process
+    self.event_queue = event_queue
+    self.reply_queue = reply_queue
+
+def _mp_context():
+  # Workers inherit our parsed config and open log handles, so they must be
+  # forked rather than spawned.
+  if hasattr(multiprocessing, "get_context"):
+    return multiprocessing.get_context("fork")
+  return multiprocessing
+
+class Ingest:
+  def __init__(self, controller):
+    self.controller = controller
+    self.mp = _mp_context()
+    self.cmd_queue = self.mp.Queue()
+    self.workers = {} # key=name val=WorkerHandle
+    self.subscriptions = {} # key=event type val=list of WorkerHandles
+    self.cmd_thread = None
+    self.stem_handler = controller._handle_event
+
+  def start(self, setup_listeners, state):
+    # Events arrive on stem's event thread. Forward them before stem
+    # parses them.
+    self.controller._handle_event = self.forward_event
+
+    self.cmd_thread = threading.Thread(target=self.command_loop)
+    self.cmd_thread.daemon = True
+    self.cmd_thread.start()
+
+    for (name, options) in _WORKERS:
+      if not any(getattr(config, opt) for opt in options):
+        continue
+
+      event_queue = self.mp.Queue()
+      reply_queue = self.mp.Queue()
+      process = self.mp.Process(target=_worker_main,
+                                name="vanguards-"+name,
+                                args=(name, setup_listeners, state,
+                                      event_queue, self.cmd_queue,
+                                      reply_queue))
+      process.daemon = True
+      self.workers[name] = WorkerHandle(name, process, event_queue,
+                                        reply_queue)
+      process.start()
+      plog("NOTICE", "Started "+name+" worker (pid "+str(process.pid)+")")
+
+  def forward_event(self, event_message):
+    (code, divider, line) = event_message.content()[0]
+    event_type = line.split(" ", 1)[0]
+
+    workers = self.subscriptions.get(event_type)
+    if not workers:
+      return self.stem_handler(event_message)
+
+    raw = event_message.raw_content()
+    for w in workers:
+      w.event_queue.put(("event", raw, event_message.arrived_at))
+
+  def subscribe(self, worker, event_type):
+    if event_type not in self.subscriptions:
+      self.subscriptions[event_type] = []
+      # Our forward_event() gets these before stem's listeners would.
+      # This just makes stem ask tor for the event.
+      self.controller.add_event_listener(lambda ev: None, event_type)
+    self.subscriptions[event_type].append(worker)
+
+  def command_loop(self):
+    while True:
+      item = self.cmd_queue.get()
+      if item is None:
+        return
+
+      (name, req_id, method, args) = item
+      worker = self.workers[name]
+
+      try:
+        if method == "add_event_listener":
+          result = self.subscribe(worker, *args)
+        else:
+          if method == "close_circuit" and "logguard" in self.workers and \
+             name != "logguard":
+            # The log buffer lives in the logguard worker
+            self.workers["logguard"].event_queue.put(("dump", args[0]))
+          result = getattr(self.controller, method)(*args)
+          if method == "get_network_statuses":
+            # Stem gives us a generator, which can't be pickled
+            result = consensus.compact_routers(result)
+        reply = (req_id, True, result)
+      except Exception as e:
+        reply = (req_id, False, (e.__class__, getattr(e, "message", str(e))))
+
+      worker.reply_queue.put(_pickle_reply(reply))
+
+  def workers_alive(self):
+    for w in self.workers.values():
+      if not w.process.is_alive():
+        plog("ERROR", "The "+w.name+" worker exited unexpectedly.")
+        return False
+    return True
+
+  def stop(self):
+    for w in self.workers.values():
+      w.event_queue.put(("stop",))
+
+    for w in self.workers.values():
+      w.process.join(_WORKER_EXIT_SECS)
+      if w.process.is_alive():
+        w.process.terminate()
+
+    self.cmd_queue.put(None)
+    self.cmd_thread.join()
+    self.controller._handle_event = self.stem_handler
+
+def run_workers(controller, state, setup_listeners):
+  ingest = Ingest(controller)
+  ingest.start(setup_listeners, state)
+
+  while controller.is_alive() and ingest.workers_alive():
+    time.sleep(1)
+
+  ingest.stop()
+
+  if controller.is_alive():
+    controller.close()
+    return "failed: worker exited"
+  return "closed"
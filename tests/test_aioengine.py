@@ -0,0 +1,96 @@
+import queue
+import threading
+import time
+
+import stem
+import stem.control
+
+from stem.response import ControlMessage
+
+from vanguards import aioengine
+from vanguards import control
+
+ORCONN = "650 ORCONN $3E53D3979DB07EFD736661C934A1DED14127B684~Unnamed CONNECTED ID=1\r\n"
+
+class MockController:
+  def __init__(self):
+    self.alive = True
+    self.status_listeners = []
+    self.handled = [] # (thread, event_message)
+    self.closed = []
+    self.release_close = threading.Event()
+    # Where stem's reader thread puts events for its event thread
+    self._event_queue = queue.Queue()
+
+  def _handle_event(self, event_message):
+    self.handled.append((threading.current_thread(), event_message))
+
+  def add_status_listener(self, func, spawn=True):
+    self.status_listeners.append(func)
+
+  def remove_status_listener(self, func):
+    self.status_listeners.remove(func)
+
+  def close_circuit(self, circ_id):
+    # Tor is slow to reply
+    self.release_close.wait(30)
+    self.closed.append(circ_id)
+    if circ_id == "bogus":
+      raise stem.InvalidRequest("552", "Unknown circuit \"bogus\"")
+
+  def is_alive(self):
+    return self.alive
+
+  def close(self):
+    self.alive = False
+    for func in list(self.status_listeners):
+      func(self, stem.control.State.CLOSED, time.time())
+
+# Test plan:
+#  - Events are handled on the loop (main) thread, both the ones stem
+#    had queued already and the ones its reader thread queues after
+#  - Closing a circuit does not wait for tor's reply
+#  - Timers run, and the loop exits when the connection closes
+def test_engine():
+  c = MockController()
+  stem_handler = c._handle_event
+  engine = aioengine.AsyncEngine(c)
+  ticks = []
+  close_returned = []
+
+  def tick(now):
+    ticks.append(now)
+    if len(ticks) == 1:
+      start = time.time()
+      control.try_close_circuit(engine.async_controller, "1")
+      control.try_close_circuit(engine.async_controller, "bogus")
+      close_returned.append(time.time() - start)
+      threading.Thread(target=tor_thread).start()
+
+  # Stands in for stem's event and reader threads
+  def tor_thread():
+    c._handle_event(ControlMessage.from_str(ORCONN))
+    c._event_queue.put(ControlMessage.from_str(ORCONN))
+    c.release_close.set()
+    while len(c.closed) < 2 or len(ticks) < 2:
+      time.sleep(0.05)
+    c.close()
+
+  stem_queue = c._event_queue
+  stem_queue.put(ControlMessage.from_str(ORCONN))
+  engine.call_every(0.1, tick)
+  assert engine.run() == "closed"
+
+  assert len(close_returned) == 1 and close_returned[0] < 5
+  assert c.closed == ["1", "bogus"]
+  assert len(c.handled) == 3
+  for (thread, event_message) in c.handled:
+    assert thread == threading.current_thread()
+  assert c._event_queue is stem_queue and stem_queue.empty()
+  assert c.status_listeners == []
+  assert c._handle_event == stem_handler
+
+def test_already_closed():
+  c = MockController()
+  c.alive = False
+  assert aioengine.AsyncEngine(c).run() == "closed"
@@ -14,6 +14,7 @@ from vanguards.bandguards import CONN_MAX_DISCONNECTED_SECS
 from vanguards.bandguards import _CELL_PAYLOAD_SIZE
 from vanguards.bandguards import _CELL_DATA_RATE
 from vanguards.bandguards import _SECS_PER_HOUR
+from vanguards.bandguards import _CLOSE_RETRY_SECS
 from vanguards.bandguards import _BYTES_PER_KB
 from vanguards.bandguards import _BYTES_PER_MB
 
@@ -42,7 +43,7 @@ class MockController:
 
   def close_circuit(self, circ_id):
     self.closed_circ = circ_id
-    self.bwstats.circ_event(closed_circ(circ_id))
+    self.bwstats.registry.circ_event(closed_circ(circ_id))
     raise stem.InvalidRequest("Coverage")
 
   def get_info(self, key):
@@ -188,23 +189,23 @@ def test_bwstats():
 
   # - BUILT -> FAILED,CLOSED removed from map
   # - BUILT -> CLOSED removed from map
-  state.circ_event(built_circ(circ_id, "HS_VANGUARDS"))
+  state.registry.circ_event(built_circ(circ_id, "HS_VANGUARDS"))
   assert str(circ_id) in state.circs
-  state.circ_event(failed_circ(circ_id))
+  state.registry.circ_event(failed_circ(circ_id))
   assert str(circ_id) not in state.circs
-  state.circ_event(closed_circ(circ_id))
+  state.registry.circ_event(closed_circ(circ_id))
   assert str(circ_id) not in state.circs
 
   circ_id += 1
-  state.circ_event(built_circ(circ_id, "HS_VANGUARDS"))
+  state.registry.circ_event(built_circ(circ_id, "HS_VANGUARDS"))
   assert str(circ_id) in state.circs
-  state.circ_event(closed_circ(circ_id))
+  state.registry.circ_event(closed_circ(circ_id))
   assert str(circ_id) not in state.circs
 
   # - HSDIR size cap exceeded for direct service circ
   circ_id += 1
   controller.closed_circ = None
-  state.circ_event(built_hsdir_circ(circ_id))
+  state.registry.circ_event(built_hsdir_circ(circ_id))
   assert state.circs[str(circ_id)].is_hsdir == True
   assert state.circs[str(circ_id)].is_service == True
   check_hsdir(state, controller, circ_id)
@@ -213,9 +214,9 @@ def test_bwstats():
   # - HSDIR size cap exceeded for cannibalized circ
   circ_id += 1
   controller.closed_circ = None
-  state.circ_event(built_circ(circ_id, "HS_VANGUARDS"))
+  state.registry.circ_event(built_circ(circ_id, "HS_VANGUARDS"))
   assert state.circs[str(circ_id)].is_hsdir == False
-  state.circ_minor_event(cannibalized_circ(circ_id, "HS_CLIENT_HSDIR"))
+  state.registry.circ_minor_event(cannibalized_circ(circ_id, "HS_CLIENT_HSDIR"))
   assert state.circs[str(circ_id)].is_hsdir == True
   assert state.circs[str(circ_id)].is_service == False
   check_hsdir(state, controller, circ_id)
@@ -224,7 +225,7 @@ def test_bwstats():
   # - HSDIR size cap disabled
   circ_id += 1
   controller.closed_circ = None
-  state.circ_event(built_hsdir_circ(circ_id))
+  state.registry.circ_event(built_hsdir_circ(circ_id))
   vanguards.bandguards.CIRC_MAX_HSDESC_KILOBYTES = 0
   assert vanguards.bandguards.CIRC_MAX_HSDESC_KILOBYTES != CIRC_MAX_HSDESC_KILOBYTES
   assert state.circs[str(circ_id)].is_hsdir == True
@@ -236,7 +237,7 @@ def test_bwstats():
   # - INTRO size cap disabled by default
   circ_id += 1
   controller.closed_circ = None
-  state.circ_event(built_serv_intro_circ(circ_id))
+  state.registry.circ_event(built_serv_intro_circ(circ_id))
   assert vanguards.bandguards.CIRC_MAX_SERV_INTRO_KILOBYTES == CIRC_MAX_SERV_INTRO_KILOBYTES
   assert state.circs[str(circ_id)].is_serv_intro == True
   assert state.circs[str(circ_id)].is_service == True
@@ -248,7 +249,7 @@ def test_bwstats():
   controller.closed_circ = None
   vanguards.bandguards.CIRC_MAX_SERV_INTRO_KILOBYTES = 1024
   CIRC_MAX_SERV_INTRO_KILOBYTES = 1024
-  state.circ_event(built_serv_intro_circ(circ_id))
+  state.registry.circ_event(built_serv_intro_circ(circ_id))
   assert state.circs[str(circ_id)].is_serv_intro == True
   assert state.circs[str(circ_id)].is_service == True
   check_serv_intro(state, controller, circ_id)
@@ -257,9 +258,9 @@ def test_bwstats():
   # - INTRO size cap exceeded for cannibalized circ
   circ_id += 1
   controller.closed_circ = None
-  state.circ_event(built_circ(circ_id, "HS_VANGUARDS"))
+  state.registry.circ_event(built_circ(circ_id, "HS_VANGUARDS"))
   assert state.circs[str(circ_id)].is_serv_intro == False
-  state.circ_minor_event(cannibalized_circ(circ_id, "HS_SERVICE_INTRO"))
+  state.registry.circ_minor_event(cannibalized_circ(circ_id, "HS_SERVICE_INTRO"))
   assert state.circs[str(circ_id)].is_serv_intro == True
   assert state.circs[str(circ_id)].is_service == True
   check_serv_intro(state, controller, circ_id)
@@ -272,63 +273,65 @@ def test_bwstats():
   controller.closed_circ = None
   vanguards.bandguards.CIRC_MAX_MEGABYTES = 100
   CIRC_MAX_MEGABYTES = 100
-  state.circ_event(built_circ(circ_id, "HS_VANGUARDS"))
+  state.registry.circ_event(built_circ(circ_id, "HS_VANGUARDS"))
   check_maxbytes(state, controller, circ_id)
   assert controller.closed_circ == str(circ_id)
 
   # - Max bytes disabled
   circ_id += 1
   controller.closed_circ = None
-  state.circ_event(built_circ(circ_id, "HS_SERVICE_REND"))
+  state.registry.circ_event(built_circ(circ_id, "HS_SERVICE_REND"))
   vanguards.bandguards.CIRC_MAX_MEGABYTES = 0
   assert vanguards.bandguards.CIRC_MAX_MEGABYTES != CIRC_MAX_MEGABYTES
   check_maxbytes(state, controller, circ_id)
   assert controller.closed_circ == None
   vanguards.bandguards.CIRC_MAX_MEGABYTES = CIRC_MAX_MEGABYTES
 
-  # - Frob circ.created_at to close circ (bw event)
+  # - Check circ ages a day from now to close circ. The oldest circs get
+  #   closed first, and each circ only once.
   circ_id += 1
   controller.closed_circ = None
-  state.circ_event(built_circ(circ_id, "HS_CLIENT_REND"))
+  state.registry.circ_event(built_circ(circ_id, "HS_CLIENT_REND"))
   state.bw_event(MockEvent(time.time()))
   assert controller.closed_circ == None
-  state.circs[str(circ_id)].created_at = time.time() - \
-    (1+CIRC_MAX_AGE_HOURS*_SECS_PER_HOUR)
-  state.bw_event(MockEvent(time.time()))
+  later = time.time() + 1 + CIRC_MAX_AGE_HOURS*_SECS_PER_HOUR
+  state.check_circ_ages(later)
   assert controller.closed_circ == str(circ_id)
+  controller.closed_circ = None
+  state.check_circ_ages(later)
+  assert controller.closed_circ == None
 
   # - Test disabled circ lifetime
   circ_id += 1
   controller.closed_circ = None
-  state.circ_event(built_circ(circ_id, "HS_CLIENT_REND"))
+  state.registry.circ_event(built_circ(circ_id, "HS_CLIENT_REND"))
   state.bw_event(MockEvent(time.time()))
   assert controller.closed_circ == None
   vanguards.bandguards.CIRC_MAX_AGE_HOURS = 0
   assert vanguards.bandguards.CIRC_MAX_AGE_HOURS != CIRC_MAX_AGE_HOURS
-  state.circs[str(circ_id)].created_at = time.time() - \
-    (1+CIRC_MAX_AGE_HOURS*_SECS_PER_HOUR)
-  state.bw_event(MockEvent(time.time()))
+  state.check_circ_ages(time.time() + 1 + CIRC_MAX_AGE_HOURS*_SECS_PER_HOUR)
   assert controller.closed_circ == None
+  vanguards.bandguards.CIRC_MAX_AGE_HOURS = CIRC_MAX_AGE_HOURS
 
   # Test that regular reading is ok
   circ_id += 1
   controller.closed_circ = None
-  state.circ_event(built_circ(circ_id, "HS_VANGUARDS"))
+  state.registry.circ_event(built_circ(circ_id, "HS_VANGUARDS"))
   check_dropped_bytes(state, controller, circ_id, 100, 0)
   assert controller.closed_circ == None
 
   # Test that no dropped cells are allowed before app data
   circ_id += 1
   controller.closed_circ = None
-  state.circ_event(built_circ(circ_id, "HS_VANGUARDS"))
+  state.registry.circ_event(built_circ(circ_id, "HS_VANGUARDS"))
   check_dropped_bytes(state, controller, circ_id, 0, 1)
   assert controller.closed_circ == str(circ_id)
 
   # Test that 0 dropped cells are allowed on pathbias
   circ_id += 1
   controller.closed_circ = None
-  state.circ_event(built_circ(circ_id, "HS_SERVICE_REND"))
-  state.circ_minor_event(purpose_changed_circ(circ_id,
+  state.registry.circ_event(built_circ(circ_id, "HS_SERVICE_REND"))
+  state.registry.circ_minor_event(purpose_changed_circ(circ_id,
                                              "HS_SERVICE_REND",
                                              "PATH_BIAS_TESTING"))
   check_dropped_bytes(state, controller, circ_id, 0, 1)
@@ -337,10 +340,10 @@ def test_bwstats():
   # Test that dropped cells are allowed on not-built circ.
   circ_id += 1
   controller.closed_circ = None
-  state.circ_event(extended_circ(circ_id, "HS_VANGUARDS"))
+  state.registry.circ_event(extended_circ(circ_id, "HS_VANGUARDS"))
   check_dropped_bytes(state, controller, circ_id, 0, 1)
   assert controller.closed_circ == None
-  state.circ_event(built_circ(circ_id, "HS_VANGUARDS"))
+  state.registry.circ_event(built_circ(circ_id, "HS_VANGUARDS"))
   state.circbw_event(circ_bw(circ_id,
                     _CELL_PAYLOAD_SIZE, _CELL_PAYLOAD_SIZE,
                     12, 0,
@@ -351,49 +354,49 @@ def test_bwstats():
   # and then we close.
   circ_id += 1
   controller.closed_circ = None
-  state.circ_event(built_circ(circ_id, "HS_VANGUARDS"))
+  state.registry.circ_event(built_circ(circ_id, "HS_VANGUARDS"))
   check_dropped_bytes(state, controller, circ_id, 1000, 1)
   assert controller.closed_circ == str(circ_id)
 
   # Test Non-HS circs closed with dropped cells.
   circ_id += 1
   controller.closed_circ = None
-  state.circ_event(built_general_circ(circ_id))
+  state.registry.circ_event(built_general_circ(circ_id))
   check_dropped_bytes(state, controller, circ_id, 1000, 1)
   assert controller.closed_circ == str(circ_id)
 
   # Test workaround for #29700:
   circ_id += 1
   controller.closed_circ = None
-  state.circ_event(built_hs_circ(circ_id, "HS_SERVICE_REND", "HSSR_CONNECTING"))
+  state.registry.circ_event(built_hs_circ(circ_id, "HS_SERVICE_REND", "HSSR_CONNECTING"))
   check_dropped_bytes(state, controller, circ_id, 1000, 1)
   assert controller.closed_circ == str(circ_id)
 
   # Test workaround for #29927:
   circ_id += 1
   controller.closed_circ = None
-  state.circ_event(built_hs_circ(circ_id, "HS_CLIENT_INTRO", "HSCI_DONE"))
+  state.registry.circ_event(built_hs_circ(circ_id, "HS_CLIENT_INTRO", "HSCI_DONE"))
   check_dropped_bytes(state, controller, circ_id, 1000, 1)
   assert controller.closed_circ == str(circ_id)
 
   circ_id += 1
   controller.closed_circ = None
-  state.circ_event(built_hs_circ(circ_id, "HS_CLIENT_INTRO", "HSCI_CONNECTING"))
+  state.registry.circ_event(built_hs_circ(circ_id, "HS_CLIENT_INTRO", "HSCI_CONNECTING"))
   check_dropped_bytes(state, controller, circ_id, 1000, 1)
   assert controller.closed_circ == str(circ_id)
 
   # Test workaround for #29699
   circ_id += 1
   controller.closed_circ = None
-  state.circ_event(built_hs_circ(circ_id, "HS_SERVICE_INTRO", "HSSI_ESTABLISHED"))
+  state.registry.circ_event(built_hs_circ(circ_id, "HS_SERVICE_INTRO", "HSSI_ESTABLISHED"))
   check_dropped_bytes(state, controller, circ_id, 1000, 1)
   assert controller.closed_circ == str(circ_id)
 
   # Test workaround for #40359
   circ_id += 1
   controller.closed_circ = None
-  state.circ_event(built_hs_circ(circ_id, "HS_CLIENT_INTRO", "HSCI_CONNECTING"))
-  state.circ_minor_event(purpose_changed_hs_circ(circ_id,
+  state.registry.circ_event(built_hs_circ(circ_id, "HS_CLIENT_INTRO", "HSCI_CONNECTING"))
+  state.registry.circ_minor_event(purpose_changed_hs_circ(circ_id,
                                              "HS_CLIENT_INTRO",
                                              "CIRCUIT_PADDING",
                                              "HSCI_INTRO_SENT",
@@ -404,8 +407,8 @@ def test_bwstats():
   # Test workaround for #29786 (should close now)
   circ_id += 1
   controller.closed_circ = None
-  state.circ_event(built_hs_circ(circ_id, "HS_SERVICE_INTRO", "HSSI_ESTABLISHED"))
-  state.circ_minor_event(purpose_changed_hs_circ(circ_id,
+  state.registry.circ_event(built_hs_circ(circ_id, "HS_SERVICE_INTRO", "HSSI_ESTABLISHED"))
+  state.registry.circ_minor_event(purpose_changed_hs_circ(circ_id,
                                              "HS_SERVICE_INTRO",
                                              "PATH_BIAS_TESTING",
                                              "HSSI_CONNECTING",
@@ -415,8 +418,8 @@ def test_bwstats():
 
   circ_id += 1
   controller.closed_circ = None
-  state.circ_event(built_hs_circ(circ_id, "HS_CLIENT_INTRO", "HSCI_CONNECTING"))
-  state.circ_minor_event(purpose_changed_hs_circ(circ_id,
+  state.registry.circ_event(built_hs_circ(circ_id, "HS_CLIENT_INTRO", "HSCI_CONNECTING"))
+  state.registry.circ_minor_event(purpose_changed_hs_circ(circ_id,
                                              "HS_CLIENT_INTRO",
                                              "PATH_BIAS_TESTING",
                                              "HSCI_CONNECTING",
@@ -427,8 +430,8 @@ def test_bwstats():
   # Test workaround for #29700
   circ_id += 1
   controller.closed_circ = None
-  state.circ_event(built_circ(circ_id, "HS_VANGUARDS"))
-  state.circ_minor_event(purpose_changed_hs_circ(circ_id,
+  state.registry.circ_event(built_circ(circ_id, "HS_VANGUARDS"))
+  state.registry.circ_minor_event(purpose_changed_hs_circ(circ_id,
                                              "HS_VANGUARDS",
                                              "HS_SERVICE_REND",
                                              "None",
@@ -439,8 +442,8 @@ def test_bwstats():
   # Test workaround for #29927
   circ_id += 1
   controller.closed_circ = None
-  state.circ_event(built_circ(circ_id, "HS_VANGUARDS"))
-  state.circ_minor_event(purpose_changed_hs_circ(circ_id,
+  state.registry.circ_event(built_circ(circ_id, "HS_VANGUARDS"))
+  state.registry.circ_minor_event(purpose_changed_hs_circ(circ_id,
                                              "HS_VANGUARDS",
                                              "HS_CLIENT_REND",
                                              "None",
@@ -450,8 +453,8 @@ def test_bwstats():
 
   circ_id += 1
   controller.closed_circ = None
-  state.circ_event(built_circ(circ_id, "HS_VANGUARDS"))
-  state.circ_minor_event(purpose_changed_hs_circ(circ_id,
+  state.registry.circ_event(built_circ(circ_id, "HS_VANGUARDS"))
+  state.registry.circ_minor_event(purpose_changed_hs_circ(circ_id,
                                              "HS_VANGUARDS",
                                              "HS_CLIENT_INTRO",
                                              "None",
@@ -461,8 +464,8 @@ def test_bwstats():
 
   circ_id += 1
   controller.closed_circ = None
-  state.circ_event(built_circ(circ_id, "HS_VANGUARDS"))
-  state.circ_minor_event(purpose_changed_hs_circ(circ_id,
+  state.registry.circ_event(built_circ(circ_id, "HS_VANGUARDS"))
+  state.registry.circ_minor_event(purpose_changed_hs_circ(circ_id,
                                              "HS_VANGUARDS",
                                              "HS_CLIENT_INTRO",
                                              "None",
@@ -471,6 +474,120 @@ def test_bwstats():
   assert controller.closed_circ == str(circ_id)
 
 
+# Test plan:
+#  - Closed circuits are not checked or closed when they would expire
+#  - Entries of closed circuits don't pile up under churn
+#  - A circuit id that got reused expires with its new circuit
+#  - Circuits that don't close, or fail to, get closed again later
+class FailingController(MockController):
+  def __init__(self, fail):
+    MockController.__init__(self)
+    self.fail = fail
+    self.attempts = 0
+
+  def close_circuit(self, circ_id):
+    self.attempts += 1
+    if self.fail:
+      raise self.fail
+    self.closed_circ = circ_id # But tor never says it closed
+
+def test_circ_ages():
+  controller = MockController()
+  state = BandwidthStats(controller)
+  controller.bwstats = state
+  max_age = CIRC_MAX_AGE_HOURS*_SECS_PER_HOUR
+
+  for circ_id in xrange(1000):
+    state.registry.circ_event(built_circ(circ_id, "HS_SERVICE_REND"))
+    state.registry.circ_event(closed_circ(circ_id))
+  assert len(state.circ_ages) <= 2*len(state.circs) + 101
+  state.check_circ_ages(time.time() + 1 + max_age)
+  assert controller.closed_circ == None
+  assert not state.circ_ages
+
+  state.registry.circ_event(built_circ(5000, "HS_SERVICE_REND"))
+  state.registry.circ_event(closed_circ(5000))
+  while time.time() == state.circ_ages[0][0]:
+    pass
+  state.registry.circ_event(built_circ(5000, "HS_SERVICE_REND"))
+  created_at = state.circs["5000"].created_at
+  state.check_circ_ages(created_at + max_age)
+  assert controller.closed_circ == None
+  assert len(state.circ_ages) == 1
+  state.check_circ_ages(created_at + max_age + 1)
+  assert controller.closed_circ == "5000"
+
+  for fail in [stem.OperationFailed("551", "Busy"), None]:
+    controller = FailingController(fail)
+    state = BandwidthStats(controller)
+    state.registry.circ_event(built_circ(1, "HS_SERVICE_REND"))
+    expires_at = state.circs["1"].created_at + max_age + 1
+    state.check_circ_ages(expires_at)
+    assert controller.attempts == 1
+    state.check_circ_ages(expires_at + _CLOSE_RETRY_SECS - 1)
+    assert controller.attempts == 1
+    state.check_circ_ages(expires_at + _CLOSE_RETRY_SECS + 1)
+    assert controller.attempts == 2
+
+    # Once it's closed, we stop
+    state.registry.circ_event(closed_circ(1))
+    state.check_circ_ages(expires_at + 3*_CLOSE_RETRY_SECS)
+    assert controller.attempts == 2
+    assert not state.circ_ages
+
+# Test plan:
+#  - In-use circuits are indexed by their guard, from BUILT and from
+#    HS_VANGUARDS purpose changes, and leave the index when they close
+#  - A guard connection closing only marks that guard's in-use circuits
+#  - The pending count matches the circuits that aren't built, whatever
+#    order their events come in
+def test_circuit_index():
+  controller = MockController()
+  state = BandwidthStats(controller)
+  controller.bwstats = state
+  (guard1, guard2) = ("$5416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed",
+                      "$3E53D3979DB07EFD736661C934A1DED14127B684~Unnamed")
+  (fp1, fp2) = (guard1[1:41], guard2[1:41])
+
+  def check_pending():
+    assert state.registry.pending_circs == \
+           len([c for c in state.circs.values() if not c.built])
+
+  state.registry.circ_event(extended_circ(1, "HS_SERVICE_REND", guard1))
+  state.registry.circ_event(extended_circ(2, "HS_VANGUARDS", guard2))
+  state.registry.circ_event(extended_circ(3, "GENERAL", guard2))
+  check_pending()
+  assert state.registry.pending_circs == 3
+  assert state.any_circuits_pending()
+  assert state.any_circuits_pending("1")
+
+  state.registry.circ_event(built_circ(1, "HS_SERVICE_REND", guard1))
+  state.registry.circ_event(built_circ(1, "HS_SERVICE_REND", guard1))
+  state.registry.circ_event(built_circ(2, "HS_VANGUARDS", guard2))
+  check_pending()
+  assert state.registry.in_use_circs == {fp1: set(["1"])}
+  state.registry.circ_minor_event(purpose_changed_circ(2, "HS_VANGUARDS",
+                                              "HS_SERVICE_REND", guard2))
+  assert state.registry.in_use_circs == {fp1: set(["1"]), fp2: set(["2"])}
+  assert state.any_circuits_pending()
+  assert not state.any_circuits_pending("3")
+
+  state.orconn_event(orconn_event(7, guard2, "CONNECTED"))
+  state.orconn_event(orconn_event(7, guard2, "CLOSED"))
+  assert state.circs["2"].possibly_destroyed_at
+  assert not state.circs["1"].possibly_destroyed_at
+
+  state.registry.circ_event(failed_circ(3))
+  state.registry.circ_event(closed_circ(3))
+  state.registry.circ_event(closed_circ(2))
+  state.registry.circ_event(closed_circ(2))
+  check_pending()
+  assert not state.any_circuits_pending()
+  assert state.registry.in_use_circs == {fp1: set(["1"])}
+  state.registry.circ_event(closed_circ(1))
+  assert state.registry.in_use_circs == {}
+  assert state.registry.pending_circs == 0
+
 def test_connguard():
   controller = MockController()
   state = BandwidthStats(controller)
@@ -489,16 +606,16 @@ def test_connguard():
   state.orconn_event(
          orconn_event(11,"$5416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed",
                       "CONNECTED"))
-  state.circ_event(built_circ(23, "HS_SERVICE_INTRO",
+  state.registry.circ_event(built_circ(23, "HS_SERVICE_INTRO",
                               "$5416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed"))
-  state.circ_event(built_circ(24, "HS_SERVICE_INTRO",
+  state.registry.circ_event(built_circ(24, "HS_SERVICE_INTRO",
                               "$5416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed"))
   state.orconn_event(
          orconn_event(11,"$5416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed",
                       "CLOSED"))
-  state.circ_event(destroyed_circ(24,
+  state.registry.circ_event(destroyed_circ(24,
                     "$5416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed"))
-  state.circ_event(destroyed_circ(23,
+  state.registry.circ_event(destroyed_circ(23,
                    "$5416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed"))
   assert state.guards["5416F3E8F80101A133B1970495B04FDBD1C7446B"].killed_conns == 1
   assert state.circs_destroyed_total == 2
@@ -508,23 +625,23 @@ def test_connguard():
   state.orconn_event(
          orconn_event(12,"$5416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed",
                       "CONNECTED"))
-  state.circ_event(built_circ(24, "HS_VANGUARDS",
+  state.registry.circ_event(built_circ(24, "HS_VANGUARDS",
                               "$5416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed"))
-  state.circ_minor_event(purpose_changed_circ(24, "HS_VANGUARDS", "HS_SERVICE_REND",
+  state.registry.circ_minor_event(purpose_changed_circ(24, "HS_VANGUARDS", "HS_SERVICE_REND",
                               "$5416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed"))
   state.orconn_event(
          orconn_event(12,"$5416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed",
                       "CLOSED"))
-  state.circ_event(destroyed_circ(24,
+  state.registry.circ_event(destroyed_circ(24,
                     "$5416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed"))
   assert state.guards["5416F3E8F80101A133B1970495B04FDBD1C7446B"].killed_conns == 2
   assert state.circs_destroyed_total == 3
 
   # Test cannibalized close on pre-existing conn
   assert state.circs_destroyed_total == 3
-  state.circ_event(built_circ(2323, "HS_VANGUARDS",
+  state.registry.circ_event(built_circ(2323, "HS_VANGUARDS",
                               "$3E53D3979DB07EFD736661C934A1DED14127B684~Unnamed"))
-  state.circ_minor_event(purpose_changed_circ(2323, "HS_VANGUARDS", "HS_SERVICE_REND",
+  state.registry.circ_minor_event(purpose_changed_circ(2323, "HS_VANGUARDS", "HS_SERVICE_REND",
                               "$3E53D3979DB07EFD736661C934A1DED14127B684~Unnamed"))
   assert not state.circs["2323"].possibly_destroyed_at
   assert state.circs["2323"].in_use
@@ -532,7 +649,7 @@ def test_connguard():
          orconn_event(5,"$3E53D3979DB07EFD736661C934A1DED14127B684~Unnamed",
                       "CLOSED"))
   assert state.circs["2323"].possibly_destroyed_at
-  state.circ_event(destroyed_circ(2323,
+  state.registry.circ_event(destroyed_circ(2323,
                     "$3E53D3979DB07EFD736661C934A1DED14127B684~Unnamed"))
   assert state.guards["5416F3E8F80101A133B1970495B04FDBD1C7446B"].killed_conns == 2
   assert state.guards["3E53D3979DB07EFD736661C934A1DED14127B684"].killed_conns == 1
@@ -544,12 +661,12 @@ def test_connguard():
   state.orconn_event(
          orconn_event(13,"$5416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed",
                       "CONNECTED"))
-  state.circ_event(built_circ(25, "HS_VANGUARDS",
+  state.registry.circ_event(built_circ(25, "HS_VANGUARDS",
                               "$5416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed"))
   state.orconn_event(
          orconn_event(13,"$5416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed",
                       "CLOSED"))
-  state.circ_event(destroyed_circ(25,
+  state.registry.circ_event(destroyed_circ(25,
                     "$5416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed"))
   assert state.guards["5416F3E8F80101A133B1970495B04FDBD1C7446B"].killed_conns == 2
   assert state.circs_destroyed_total == 4
@@ -559,12 +676,12 @@ def test_connguard():
   state.orconn_event(
          orconn_event(14,"$5416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed",
                       "CONNECTED"))
-  state.circ_event(built_general_circ(26,
+  state.registry.circ_event(built_general_circ(26,
                               "$5416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed"))
   state.orconn_event(
          orconn_event(14,"$5416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed",
                       "CLOSED"))
-  state.circ_event(destroyed_circ(26,
+  state.registry.circ_event(destroyed_circ(26,
                     "$5416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed"))
   assert state.guards["5416F3E8F80101A133B1970495B04FDBD1C7446B"].killed_conns == 2
   assert state.circs_destroyed_total == 4
@@ -574,7 +691,7 @@ def test_connguard():
   state.orconn_event(
          orconn_event(15,"$5416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed",
                       "CONNECTED"))
-  state.circ_event(built_circ(27, "HS_SERVICE_INTRO",
+  state.registry.circ_event(built_circ(27, "HS_SERVICE_INTRO",
                               "$5416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed"))
   state.orconn_event(
          orconn_event(15,"$5416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed",
@@ -582,7 +699,7 @@ def test_connguard():
   ev = destroyed_circ(27,
                     "$5416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed")
   ev.arrived_at = time.time()+5
-  state.circ_event(ev)
+  state.registry.circ_event(ev)
   assert state.guards["5416F3E8F80101A133B1970495B04FDBD1C7446B"].killed_conns == 2
   assert state.circs_destroyed_total == 4
 
@@ -591,12 +708,12 @@ def test_connguard():
   state.orconn_event(
          orconn_event(16,"$5416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed",
                       "CONNECTED"))
-  state.circ_event(built_circ(28, "HS_SERVICE_INTRO",
+  state.registry.circ_event(built_circ(28, "HS_SERVICE_INTRO",
                               "$6416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed"))
   state.orconn_event(
          orconn_event(16,"$5416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed",
                       "CLOSED"))
-  state.circ_event(destroyed_circ(28,
+  state.registry.circ_event(destroyed_circ(28,
                     "$6416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed"))
   assert state.guards["5416F3E8F80101A133B1970495B04FDBD1C7446B"].killed_conns == 2
   assert state.circs_destroyed_total == 4
@@ -647,7 +764,7 @@ def test_connguard():
 
   ev = built_general_circ(29)
   ev.arrived_at = last_conn
-  state.circ_event(ev)
+  state.registry.circ_event(ev)
   assert state.no_circs_since == None
   state.bw_event(ev)
   assert state.disconnected_circs == False
@@ -662,7 +779,7 @@ def test_connguard():
   # Failure then quiet doesn't, when no circs:
   ev = failed_circ(31)
   ev.arrived_at = last_conn
-  state.circ_event(ev)
+  state.registry.circ_event(ev)
   assert state.no_circs_since == None
   assert state.disconnected_circs == False
   ev.arrived_at = last_conn+CIRC_MAX_DISCONNECTED_SECS*2
@@ -672,14 +789,14 @@ def test_connguard():
   # Failure then quiet does, when no circs:
   ev = extended_circ(333, "HS_VANGUARDS")
   ev.arrived_at = last_conn
-  state.circ_event(ev)
+  state.registry.circ_event(ev)
   ev.arrived_at = last_conn+CIRC_MAX_DISCONNECTED_SECS*2
   state.bw_event(ev)
   assert state.no_circs_since == None
   assert state.disconnected_circs == False
   ev = failed_circ(31)
   ev.arrived_at = last_conn
-  state.circ_event(ev)
+  state.registry.circ_event(ev)
   ev = network_liveness_event("DOWN")
   ev.arrived_at = last_conn
   state.network_liveness_event(ev)
@@ -692,7 +809,7 @@ def test_connguard():
   # Success clears it
   ev = built_general_circ(32)
   ev.arrived_at = last_conn
-  state.circ_event(ev)
+  state.registry.circ_event(ev)
   ev = network_liveness_event("UP")
   ev.arrived_at = last_conn
   state.network_liveness_event(ev)
@@ -704,7 +821,7 @@ def test_connguard():
   # Failure then success is also ok
   ev = failed_circ(34)
   ev.arrived_at = last_conn
-  state.circ_event(ev)
+  state.registry.circ_event(ev)
   assert state.no_circs_since
   assert state.disconnected_circs == False
   ev.arrived_at = last_conn+CIRC_MAX_DISCONNECTED_SECS*2
@@ -712,7 +829,7 @@ def test_connguard():
   assert state.disconnected_circs == True
   ev = extended_circ(35, "GENERAL")
   ev.arrived_at = last_conn
-  state.circ_event(ev)
+  state.registry.circ_event(ev)
   assert state.no_circs_since == None
   ev.arrived_at = last_conn+CIRC_MAX_DISCONNECTED_SECS*2
   state.bw_event(ev)
@@ -721,7 +838,7 @@ def test_connguard():
   # Failure then circbw is also ok
   ev = failed_circ(34)
   ev.arrived_at = last_conn
-  state.circ_event(ev)
+  state.registry.circ_event(ev)
   assert state.no_circs_since
   assert state.disconnected_circs == False
   ev.arrived_at = last_conn+CIRC_MAX_DISCONNECTED_SECS*2
@@ -738,7 +855,7 @@ def test_connguard():
   assert CIRC_MAX_DISCONNECTED_SECS # Didn't change local val
   ev = failed_circ(313)
   ev.arrived_at = last_conn
-  state.circ_event(ev)
+  state.registry.circ_event(ev)
   assert state.no_circs_since
   assert state.disconnected_circs == False
   ev.arrived_at = last_conn+CIRC_MAX_DISCONNECTED_SECS*2
@@ -756,13 +873,13 @@ def test_coverage():
   circ_id = 1
 
   # Stray circ_minor event
-  state.circ_minor_event(cannibalized_circ(circ_id, "HS_SERVICE_REND"))
+  state.registry.circ_minor_event(cannibalized_circ(circ_id, "HS_SERVICE_REND"))
   assert str(circ_id) not in state.circs
 
   # Insane bw values
   circ_id += 1
   controller.closed_circ = None
-  state.circ_event(built_circ(circ_id, "HS_VANGUARDS"))
+  state.registry.circ_event(built_circ(circ_id, "HS_VANGUARDS"))
   state.circbw_event(circ_bw(circ_id, _CELL_PAYLOAD_SIZE, _CELL_PAYLOAD_SIZE,
                              _CELL_PAYLOAD_SIZE, _CELL_PAYLOAD_SIZE, 0, 0))
 
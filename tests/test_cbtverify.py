@@ -51,47 +51,47 @@ def test_cbt():
   i = 0
   while i < 8:
     i += 1
-    ts.circ_event(launched_hs_circ(i))
-    ts.circ_event(built_circ(i))
+    ts.registry.circ_event(launched_hs_circ(i))
+    ts.registry.circ_event(built_circ(i))
 
   i += 1
-  ts.circ_event(launched_hs_circ(i))
-  ts.circ_event(timeout_circ(i))
-  ts.circ_event(expired_circ(i))
+  ts.registry.circ_event(launched_hs_circ(i))
+  ts.registry.circ_event(timeout_circ(i))
+  ts.registry.circ_event(expired_circ(i))
   i += 1
-  ts.circ_event(launched_hs_circ(i))
-  ts.circ_event(timeout_circ(i))
+  ts.registry.circ_event(launched_hs_circ(i))
+  ts.registry.circ_event(timeout_circ(i))
   assert ts.timeout_rate_hs() == 0.2
   assert ts.timeout_rate_all() == 0.2
   assert i == 10
 
   while i < 19:
     i += 1
-    ts.circ_event(launched_general_circ(i))
-    ts.circ_event(built_circ(i))
+    ts.registry.circ_event(launched_general_circ(i))
+    ts.registry.circ_event(built_circ(i))
 
   i += 1
-  ts.circ_event(launched_general_circ(i))
-  ts.circ_event(timeout_circ(i))
+  ts.registry.circ_event(launched_general_circ(i))
+  ts.registry.circ_event(timeout_circ(i))
   assert ts.timeout_rate_hs() == 0.2
   assert ts.timeout_rate_all() == 0.15
   assert i == 20
 
   i+=1
-  ts.circ_event(launched_general_circ(i))
-  ts.circ_event(failed_circ(i))
+  ts.registry.circ_event(launched_general_circ(i))
+  ts.registry.circ_event(failed_circ(i))
   i+=1
-  ts.circ_event(launched_hs_circ(i))
-  ts.circ_event(failed_circ(i))
+  ts.registry.circ_event(launched_hs_circ(i))
+  ts.registry.circ_event(failed_circ(i))
   assert ts.timeout_rate_hs() == 0.2
   assert ts.timeout_rate_all() == 0.15
 
   i+=1
-  ts.circ_event(launched_general_circ(i))
-  ts.circ_event(closed_circ(i))
+  ts.registry.circ_event(launched_general_circ(i))
+  ts.registry.circ_event(closed_circ(i))
   i+=1
-  ts.circ_event(launched_hs_circ(i))
-  ts.circ_event(closed_circ(i))
+  ts.registry.circ_event(launched_hs_circ(i))
+  ts.registry.circ_event(closed_circ(i))
   assert ts.timeout_rate_hs() == 0.2
   assert ts.timeout_rate_all() == 0.15
 
@@ -99,8 +99,8 @@ def test_cbt():
 
   # Cover double-launch:
   i+=1
-  ts.circ_event(launched_hs_circ(i))
-  ts.circ_event(launched_hs_circ(i))
+  ts.registry.circ_event(launched_hs_circ(i))
+  ts.registry.circ_event(launched_hs_circ(i))
 
   # Test reset and make sure not counted
   ts.cbt_event(cbt_reset())
@@ -110,16 +110,16 @@ def test_cbt():
   i = 0
   while i < 8:
     i += 1
-    ts.circ_event(launched_hs_circ(i))
-    ts.circ_event(built_circ(i))
+    ts.registry.circ_event(launched_hs_circ(i))
+    ts.registry.circ_event(built_circ(i))
 
   i += 1
-  ts.circ_event(launched_hs_circ(i))
-  ts.circ_event(timeout_circ(i))
-  ts.circ_event(expired_circ(i))
+  ts.registry.circ_event(launched_hs_circ(i))
+  ts.registry.circ_event(timeout_circ(i))
+  ts.registry.circ_event(expired_circ(i))
   i += 1
-  ts.circ_event(launched_hs_circ(i))
-  ts.circ_event(timeout_circ(i))
+  ts.registry.circ_event(launched_hs_circ(i))
+  ts.registry.circ_event(timeout_circ(i))
   assert ts.timeout_rate_hs() == 0.0
   assert ts.timeout_rate_all() == 0.0
 
@@ -129,16 +129,16 @@ def test_cbt():
   i = 0
   while i < 8:
     i += 1
-    ts.circ_event(launched_hs_circ(i))
-    ts.circ_event(built_circ(i))
+    ts.registry.circ_event(launched_hs_circ(i))
+    ts.registry.circ_event(built_circ(i))
 
   i += 1
-  ts.circ_event(launched_hs_circ(i))
-  ts.circ_event(timeout_circ(i))
-  ts.circ_event(expired_circ(i))
+  ts.registry.circ_event(launched_hs_circ(i))
+  ts.registry.circ_event(timeout_circ(i))
+  ts.registry.circ_event(expired_circ(i))
   i += 1
-  ts.circ_event(launched_hs_circ(i))
-  ts.circ_event(timeout_circ(i))
+  ts.registry.circ_event(launched_hs_circ(i))
+  ts.registry.circ_event(timeout_circ(i))
   assert ts.timeout_rate_hs() == 0.2
   assert ts.timeout_rate_all() == 0.2
 
@@ -0,0 +1,129 @@
+from stem.response import ControlMessage
+
+from vanguards import circuits
+from vanguards.circuits import CircuitRegistry
+
+def launched_circ(circ_id, purpose):
+  s = "650 CIRC "+str(circ_id)+" LAUNCHED BUILD_FLAGS=IS_INTERNAL,NEED_CAPACITY,NEED_UPTIME PURPOSE="+purpose+" TIME_CREATED=2018-05-08T17:03:14.906877\r\n"
+  return ControlMessage.from_str(s, "EVENT")
+
+def built_circ(circ_id, purpose):
+  s = "650 CIRC "+str(circ_id)+" BUILT $5416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed,$1F9544C0A80F1C5D8A5117FBFFB50694469CC7F4~as44194l10501,$DBD67767640197FF96EC6A87684464FC48F611B6~nocabal,$387B065A38E4DAA16D9D41C2964ECBC4B31D30FF~redjohn1 BUILD_FLAGS=IS_INTERNAL,NEED_CAPACITY,NEED_UPTIME PURPOSE="+purpose+" TIME_CREATED=2018-05-04T06:09:32.751920\r\n"
+  return ControlMessage.from_str(s, "EVENT")
+
+def purpose_changed_circ(circ_id, old_purpose, new_purpose):
+  s = "650 CIRC_MINOR "+str(circ_id)+" PURPOSE_CHANGED $5416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed,$1F9544C0A80F1C5D8A5117FBFFB50694469CC7F4~as44194l10501,$DBD67767640197FF96EC6A87684464FC48F611B6~nocabal,$387B065A38E4DAA16D9D41C2964ECBC4B31D30FF~redjohn1 BUILD_FLAGS=IS_INTERNAL,NEED_CAPACITY,NEED_UPTIME PURPOSE="+new_purpose+" OLD_PURPOSE="+old_purpose+" TIME_CREATED=2018-05-04T06:09:32.751920\r\n"
+  return ControlMessage.from_str(s, "EVENT")
+
+def closed_circ(circ_id):
+  s = "650 CIRC "+str(circ_id)+" CLOSED $5416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed BUILD_FLAGS=IS_INTERNAL,NEED_CAPACITY,NEED_UPTIME PURPOSE=HS_CLIENT_REND HS_STATE=HSCR_JOINED REND_QUERY=4u56zw2g4uvyyq7i TIME_CREATED=2018-05-04T05:50:41.751938 REASON=FINISHED\r\n"
+  return ControlMessage.from_str(s, "EVENT")
+
+class MockController:
+  def __init__(self):
+    self.events = []
+
+  def add_event_listener(self, func, ev):
+    self.events.append(ev)
+
+class Recorder:
+  def __init__(self):
+    self.seen = []
+
+  def record(self, transition, event):
+    self.seen.append((transition, event.id))
+
+def subscribe_all(registry, rec):
+  for t in [circuits.CIRC_ADDED, circuits.CIRC_BUILT, circuits.CIRC_EXTENDED,
+            circuits.CIRC_CLOSED, circuits.CIRC_MINOR]:
+    registry.add_listener(t, lambda ev, t=t: rec.record(t, ev))
+
+# Test plan:
+#  - Only the matching transitions are delivered
+#  - HS circs are in use once built; HS_VANGUARDS once repurposed
+#  - In-use circs are indexed by guard, unbuilt circs are counted
+#  - Closed circuits are forgotten, after the close is delivered
+#  - We only subscribe to events once there are listeners
+#  - Listener exceptions are not swallowed
+def test_transitions():
+  registry = CircuitRegistry()
+  rec = Recorder()
+  subscribe_all(registry, rec)
+
+  registry.circ_event(launched_circ(1, "GENERAL"))
+  assert rec.seen == [(circuits.CIRC_ADDED, "1")]
+  assert not registry.circs["1"].is_hs
+  assert registry.pending_circs == 1
+  assert registry.any_circuits_pending()
+  assert not registry.any_circuits_pending("1")
+
+  rec.seen = []
+  registry.circ_event(built_circ(1, "GENERAL"))
+  assert rec.seen == [(circuits.CIRC_BUILT, "1")]
+  assert registry.circs["1"].built
+  assert not registry.circs["1"].in_use
+  assert registry.pending_circs == 0
+
+  rec.seen = []
+  registry.circ_event(built_circ(2, "HS_SERVICE_HSDIR"))
+  assert rec.seen == [(circuits.CIRC_ADDED, "2"), (circuits.CIRC_BUILT, "2")]
+  assert registry.circs["2"].is_hs
+  assert registry.circs["2"].is_hsdir
+  assert registry.circs["2"].in_use
+  guard_fp = "5416F3E8F80101A133B1970495B04FDBD1C7446B"
+  assert registry.circs["2"].guard_fp == guard_fp
+  assert registry.in_use_circs == {guard_fp: set(["2"])}
+
+  rec.seen = []
+  registry.circ_event(built_circ(3, "HS_VANGUARDS"))
+  assert not registry.circs["3"].in_use
+  rec.seen = []
+  registry.circ_minor_event(purpose_changed_circ(3, "HS_VANGUARDS",
+                                                 "HS_CLIENT_INTRO"))
+  assert rec.seen == [(circuits.CIRC_MINOR, "3")]
+  assert registry.circs["3"].in_use
+  assert not registry.circs["3"].is_service
+  assert registry.in_use_circs == {guard_fp: set(["2", "3"])}
+
+  # The circuit is still around while its close is delivered
+  rec.seen = []
+  registry.add_listener(circuits.CIRC_CLOSED,
+                        lambda ev: rec.seen.append(("in", ev.id in registry.circs)))
+  registry.circ_event(closed_circ(2))
+  assert rec.seen == [(circuits.CIRC_CLOSED, "2"), ("in", True)]
+  assert "2" not in registry.circs
+  assert registry.in_use_circs == {guard_fp: set(["3"])}
+
+  # Closes for unknown circuits still get delivered
+  rec.seen = []
+  registry.circ_event(closed_circ(2))
+  assert rec.seen == [(circuits.CIRC_CLOSED, "2"), ("in", False)]
+
+def test_attach():
+  registry = CircuitRegistry()
+  c = MockController()
+  registry.attach(c)
+  assert c.events == []
+
+  registry.add_listener(circuits.CIRC_CLOSED, lambda ev: None)
+  registry.attach(c)
+  assert c.events == ["CIRC", "CIRC_MINOR"]
+
+  try:
+    registry.add_listener("BOGUS", lambda ev: None)
+    assert False
+  except ValueError:
+    pass
+
+def test_listener_exception():
+  registry = CircuitRegistry()
+
+  def broken(ev):
+    raise KeyError("ded")
+
+  registry.add_listener(circuits.CIRC_ADDED, broken)
+  try:
+    registry.circ_event(launched_circ(1, "GENERAL"))
+    assert False
+  except KeyError:
+    pass
@@ -0,0 +1,186 @@
+import os
+import shutil
+import tempfile
+
+import stem.descriptor
+
+from vanguards import consensus
+from vanguards import vanguards
+from vanguards.control import get_consensus_weights
+
+CONSENSUS = os.path.join("tests", "cached-microdesc-consensus")
+
+FIELDS = ["fingerprint", "nickname", "address", "or_port"]
+
+def same_router(r, s):
+  for field in FIELDS:
+    assert getattr(r, field) == getattr(s, field)
+  assert list(r.or_addresses) == s.or_addresses
+  assert set(r.flags) == set(s.flags)
+  assert r.flag_mask == consensus.flag_mask(s.flags)
+  if s.measured != None:
+    assert r.measured == s.measured
+  elif s.bandwidth != None:
+    assert r.measured == s.bandwidth
+  else:
+    assert r.measured == 0
+
+EXTRA_ENTRY = """r extra AAoQ1DAR6kkoo19hBAX5K0QztNw 2018-04-21 10:27:59 1.2.3.4 443 0
+a [2001:db8::1]:9001
+m cjljpvcQdBcRMSzHSHE+KB7mGCdJBleTTQ4w+Z3KMKU
+s Exit Fast Running Valid
+w Bandwidth=20 Measured=30 Unmeasured=1
+"""
+
+NO_W_ENTRY = """r nobw AAoQ1DAR6kkoo19hBAX5K0QztNx 2018-04-21 10:27:59 1.2.3.5 443 0
+m cjljpvcQdBcRMSzHSHE+KB7mGCdJBleTTQ4w+Z3KMKU
+s Fast Running Stable Valid
+"""
+
+def write_consensus(path, transform):
+  with open(CONSENSUS) as f:
+    data = f.read()
+  with open(path, "w") as f:
+    f.write(transform(data))
+
+class FallbackController:
+  def __init__(self, data_dir):
+    self.data_dir = data_dir
+    self.got_network_statuses = False
+
+  def get_network_statuses(self):
+    self.got_network_statuses = True
+    return list(stem.descriptor.parse_file(CONSENSUS,
+                   document_handler =
+                      stem.descriptor.DocumentHandler.ENTRIES))
+
+  def get_conf(self, key, default=None):
+    if key == "DataDirectory":
+      return self.data_dir
+    return default
+
+  def get_info(self, key, default=None):
+    return default
+
+  def set_conf(self, key, val):
+    pass
+
+# Test plan:
+#  - Every entry and the weights match what stem parses
+#  - 'a' lines and Measured bandwidths are read like stem does, and stem
+#    entries convert to the same records
+#  - Routers without a w line get no bandwidth, and don't break sorting
+#    or consensus diffs
+#  - Unreadable or incomplete files raise, and new_consensus_event()
+#    falls back to asking tor
+def test_matches_stem():
+  (routers, weights) = consensus.read_consensus(CONSENSUS)
+  stem_routers = list(stem.descriptor.parse_file(CONSENSUS,
+                 document_handler =
+                    stem.descriptor.DocumentHandler.ENTRIES))
+
+  assert weights == get_consensus_weights(CONSENSUS)
+  assert len(routers) == len(stem_routers)
+  for (r, s) in zip(routers, stem_routers):
+    same_router(r, s)
+    same_router(consensus.compact_router(s), s)
+
+def test_extra_lines():
+  tmpdir = tempfile.mkdtemp()
+  try:
+    path = os.path.join(tmpdir, "cached-microdesc-consensus")
+    write_consensus(path, lambda d: d.replace("directory-footer\n",
+                                              EXTRA_ENTRY+"directory-footer\n"))
+    (routers, weights) = consensus.read_consensus(path)
+    stem_routers = list(stem.descriptor.parse_file(path,
+                   document_handler =
+                      stem.descriptor.DocumentHandler.ENTRIES))
+    assert routers[-1].nickname == "extra"
+    assert routers[-1].or_addresses == [("2001:db8::1", 9001, True)]
+    assert routers[-1].measured == 30
+    same_router(routers[-1], stem_routers[-1])
+    same_router(consensus.compact_router(stem_routers[-1]), stem_routers[-1])
+
+    # Unknown flags get their own bits
+    r = routers[-1]
+    r.flags = ["Exit", "SomeNewFlag"]
+    assert set(r.flags) == set(["Exit", "SomeNewFlag"])
+    assert r.flag_mask & consensus.FLAG_BITS["Exit"]
+  finally:
+    shutil.rmtree(tmpdir)
+
+def test_no_w_line():
+  tmpdir = tempfile.mkdtemp()
+  try:
+    path = os.path.join(tmpdir, "cached-microdesc-consensus")
+    write_consensus(path, lambda d: d.replace("directory-footer\n",
+                                              NO_W_ENTRY+"directory-footer\n"))
+    (routers, weights) = consensus.read_consensus(path)
+    stem_routers = list(stem.descriptor.parse_file(path,
+                   document_handler =
+                      stem.descriptor.DocumentHandler.ENTRIES))
+    assert routers[-1].nickname == "nobw"
+    assert routers[-1].measured == 0
+    same_router(routers[-1], stem_routers[-1])
+    same_router(consensus.compact_router(stem_routers[-1]), stem_routers[-1])
+
+    # Both a full rebuild and a diff take it
+    state = vanguards.VanguardState(os.path.join(tmpdir, "vanguards.state"))
+    state.consensus_update(routers[:-1], weights,
+                           vanguards.ExcludeNodes(FallbackController(tmpdir)))
+    state.consensus_update(routers, weights,
+                           vanguards.ExcludeNodes(FallbackController(tmpdir)))
+    assert state.consensus_index.dict_r[routers[-1].fingerprint] is \
+           routers[-1]
+    state = vanguards.VanguardState(os.path.join(tmpdir, "vanguards.state"))
+    state.consensus_update(stem_routers, weights,
+                           vanguards.ExcludeNodes(FallbackController(tmpdir)))
+    assert routers[-1].fingerprint in state.consensus_index.dict_r
+  finally:
+    shutil.rmtree(tmpdir)
+
+def test_fallback():
+  tmpdir = tempfile.mkdtemp()
+  try:
+    path = os.path.join(tmpdir, "cached-microdesc-consensus")
+    try:
+      consensus.read_consensus(path)
+      assert False
+    except (IOError, OSError):
+      pass
+
+    open(path, "w").close()
+    try:
+      consensus.read_consensus(path)
+      assert False
+    except ValueError:
+      pass
+
+    write_consensus(path, lambda d: d[:d.index("directory-footer")])
+    try:
+      consensus.read_consensus(path)
+      assert False
+    except ValueError:
+      pass
+
+    write_consensus(path, lambda d: d.replace("microdesc\n", "\n", 1))
+    try:
+      consensus.read_consensus(path)
+      assert False
+    except ValueError:
+      pass
+
+    # Stem can still read the weights from this one, so the fallback works
+    write_consensus(path, lambda d: d.replace(" microdesc\n", " ns\n", 1))
+    controller = FallbackController(tmpdir)
+    state = vanguards.VanguardState(os.path.join(tmpdir, "vanguards.state"))
+    state.new_consensus_event(controller, None)
+    assert controller.got_network_statuses
+    assert len(state.layer2) == vanguards.NUM_LAYER2_GUARDS
+
+    # And the fast path doesn't ask tor at all
+    controller = FallbackController("tests")
+    state.new_consensus_event(controller, None)
+    assert not controller.got_network_statuses
+  finally:
+    shutil.rmtree(tmpdir)
@@ -0,0 +1,79 @@
+import gzip
+import os
+import shutil
+import tempfile
+
+import stem
+
+from stem.response import ControlMessage
+
+from vanguards import config
+from vanguards import eventtrace
+from vanguards import main
+from vanguards import vanguards
+
+TOR_VERSION = stem.version.Version("0.4.8.9")
+
+EVENTS = [
+ "650 CIRC 2 BUILT $5416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed,$1F9544C0A80F1C5D8A5117FBFFB50694469CC7F4~as44194l10501,$DBD67767640197FF96EC6A87684464FC48F611B6~nocabal,$387B065A38E4DAA16D9D41C2964ECBC4B31D30FF~redjohn1 BUILD_FLAGS=IS_INTERNAL,NEED_CAPACITY,NEED_UPTIME PURPOSE=HS_SERVICE_REND HS_STATE=HSSR_CONNECTING REND_QUERY=icqercdaxolm2ykx TIME_CREATED=2018-05-04T06:09:32.751920\r\n",
+ # Dropped cells, so bandguards closes it
+ "650 CIRC_BW ID=2 READ=1018 WRITTEN=0 TIME=2018-05-04T06:08:55.751726 DELIVERED_READ=0 OVERHEAD_READ=0 DELIVERED_WRITTEN=0 OVERHEAD_WRITTEN=0\r\n",
+ "650 SIGNAL RELOAD\r\n",
+]
+
+class MockController:
+  def __init__(self):
+    self.handled = []
+
+  def _handle_event(self, event_message):
+    self.handled.append(event_message)
+
+  def get_version(self):
+    return TOR_VERSION
+
+# Test plan:
+#  - Recording doesn't get in the way of event handling
+#  - Sessions append, and replay reports handlers and closed circuits
+#  - Truncated traces (ie: from a crash) still replay
+def test_record_replay():
+  tmpdir = tempfile.mkdtemp()
+  trace = os.path.join(tmpdir, "trace.gz")
+  saved = config.ENABLE_PATHVERIFY, config.ENABLE_CBTVERIFY
+  try:
+    for session in range(2):
+      c = MockController()
+      recorder = eventtrace.EventRecorder(trace, c)
+      recorder.start()
+      for e in EVENTS:
+        c._handle_event(ControlMessage.from_str(e))
+      recorder.close()
+      assert len(c.handled) == len(EVENTS)
+      assert c._handle_event == c._handle_event.__self__._handle_event
+
+    records = list(eventtrace.read_trace(trace))
+    assert [r[0] for r in records] == ["V", "E", "E", "E"]*2
+    assert records[1][2] == EVENTS[0]
+
+    config.ENABLE_PATHVERIFY = True
+    config.ENABLE_CBTVERIFY = True
+    state = vanguards.VanguardState(os.path.join(tmpdir, "replay.state"))
+    stats = eventtrace.replay(trace, main.setup_listeners, state)
+
+    assert stats.events == 4
+    assert stats.skipped == 2
+    assert stats.closed_circs == ["2", "2"]
+    assert stats.handler_calls["CircuitRegistry.circ_event"] == 2
+    assert stats.handler_calls["BandwidthStats.circbw_event"] == 2
+    assert "Would have closed 2 circuits" in stats.report()
+
+    # Chop off the end of the trace
+    data = gzip.open(trace, "rb").read()
+    out = gzip.open(trace, "wb")
+    out.write(data[:-20])
+    out.close()
+    stats = eventtrace.replay(trace, main.setup_listeners, state)
+    assert stats.events == 4
+    assert stats.skipped == 1
+  finally:
+    (config.ENABLE_PATHVERIFY, config.ENABLE_CBTVERIFY) = saved
+    shutil.rmtree(tmpdir)
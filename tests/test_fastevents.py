@@ -0,0 +1,98 @@
+import threading
+import stem.response
+
+from stem.response import ControlMessage
+
+from vanguards import fastevents
+from vanguards.bandguards import BandwidthStats
+
+CIRC_LINES = [
+ "650 CIRC 1 LAUNCHED BUILD_FLAGS=IS_INTERNAL,NEED_CAPACITY,NEED_UPTIME PURPOSE=HS_VANGUARDS TIME_CREATED=2018-05-08T17:03:14.906877\r\n",
+ "650 CIRC 2 BUILT $5416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed,$1F9544C0A80F1C5D8A5117FBFFB50694469CC7F4~as44194l10501,$DBD67767640197FF96EC6A87684464FC48F611B6~nocabal,$387B065A38E4DAA16D9D41C2964ECBC4B31D30FF~redjohn1 BUILD_FLAGS=IS_INTERNAL,NEED_CAPACITY,NEED_UPTIME PURPOSE=HS_VANGUARDS TIME_CREATED=2018-05-04T06:09:32.751920\r\n",
+ "650 CIRC 3 BUILT $5416F3E8F80101A133B1970495B04FDBD1C7446B=Unnamed,$855BC2DABE24C861CD887DB9B2E950424B49FC34,Logforme BUILD_FLAGS=IS_INTERNAL PURPOSE=HS_SERVICE_REND HS_STATE=HSSR_CONNECTING REND_QUERY=icqercdaxolm2ykx TIME_CREATED=2018-05-06T18:27:52.754441\r\n",
+ "650 CIRC 4 CLOSED $5416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed,$855BC2DABE24C861CD887DB9B2E950424B49FC34~Logforme BUILD_FLAGS=IS_INTERNAL,NEED_CAPACITY,NEED_UPTIME PURPOSE=HS_CLIENT_REND HS_STATE=HSCR_JOINED REND_QUERY=4u56zw2g4uvyyq7i TIME_CREATED=2018-05-04T05:50:41.751938 REASON=DESTROYED REMOTE_REASON=CHANNEL_CLOSED\r\n",
+ "650 CIRC 5 FAILED $66CA5474346F35E375C4D4514C51A540545347EE~ToolspireRelay BUILD_FLAGS=IS_INTERNAL,NEED_UPTIME PURPOSE=HS_SERVICE_INTRO HS_STATE=HSSI_CONNECTING TIME_CREATED=2018-05-04T06:08:53.883058 REASON=TIMEOUT\r\n",
+]
+
+CIRC_BW_LINES = [
+ "650 CIRC_BW ID=7 READ=509 WRITTEN=0 TIME=2018-05-04T06:08:55.751726 DELIVERED_READ=498 OVERHEAD_READ=0 DELIVERED_WRITTEN=0 OVERHEAD_WRITTEN=0\r\n",
+ "650 CIRC_BW ID=8 READ=1018 WRITTEN=509 TIME=2018-05-04T06:08:55.751726 DELIVERED_READ=10 OVERHEAD_READ=488 DELIVERED_WRITTEN=498 OVERHEAD_WRITTEN=0\r\n",
+]
+
+FALLBACK_LINES = [
+ # Quoted values
+ "650 CIRC 9 BUILT $5416F3E8F80101A133B1970495B04FDBD1C7446B~Unnamed PURPOSE=GENERAL SOCKS_USERNAME=\"a b\" TIME_CREATED=2018-05-04T06:09:32.751920\r\n",
+ # Malformed path
+ "650 CIRC 10 BUILT $5416F3E8F8~Unnamed PURPOSE=GENERAL\r\n",
+ # Not a CIRC_BW READ count
+ "650 CIRC_BW ID=11 READ=lol WRITTEN=0\r\n",
+ # Not something we parse
+ "650 ORCONN $3E53D3979DB07EFD736661C934A1DED14127B684~Unnamed CONNECTED ID=1\r\n",
+]
+
+def msg(line):
+  return ControlMessage.from_str(line)
+
+def test_circ():
+  for l in CIRC_LINES:
+    slow = msg(l)
+    fast = fastevents.parse_event(slow)
+    stem.response.convert("EVENT", slow)
+    assert fast.type == slow.type
+    for attr in ["id", "status", "path", "purpose", "hs_state", "reason",
+                 "remote_reason", "arrived_at"]:
+      assert getattr(fast, attr) == getattr(slow, attr)
+    assert fast.raw_content() == slow.raw_content()
+
+def test_circ_bw():
+  for l in CIRC_BW_LINES:
+    slow = msg(l)
+    fast = fastevents.parse_event(slow)
+    stem.response.convert("EVENT", slow)
+    assert fast.type == slow.type
+    for attr in ["id", "read", "written", "delivered_read",
+                 "delivered_written", "overhead_read", "overhead_written",
+                 "arrived_at"]:
+      assert getattr(fast, attr) == getattr(slow, attr)
+    assert fast.raw_content() == slow.raw_content()
+
+def test_fallback():
+  for l in FALLBACK_LINES:
+    assert fastevents.parse_event(msg(l)) == None
+
+class MockController:
+  def __init__(self):
+    self._event_listeners_lock = threading.RLock()
+    self._event_listeners = {}
+    self.stem_events = []
+    self._logguard = None
+
+  def _handle_event(self, event_message):
+    self.stem_events.append(event_message)
+
+  def get_info(self, key):
+    if key == "orconn-status":
+      return ""
+    if key == "network-liveness":
+      return "up"
+
+def test_enable():
+  c = MockController()
+  bw = BandwidthStats(c)
+  c._event_listeners["CIRC"] = [bw.registry.circ_event]
+  c._event_listeners["CIRC_BW"] = [bw.circbw_event]
+  fastevents.enable(c)
+
+  c._handle_event(msg(CIRC_LINES[1]))
+  c._handle_event(msg(CIRC_BW_LINES[0].replace("ID=7", "ID=2")))
+  assert bw.circs["2"].built
+  assert bw.circs["2"].read_bytes == 509
+  assert bw.circs["2"].delivered_read_bytes == 498
+  assert c.stem_events == []
+
+  c._handle_event(msg(FALLBACK_LINES[3]))
+  assert len(c.stem_events) == 1
+
+  # Listener exceptions don't escape
+  c._event_listeners["CIRC_BW"] = [lambda ev: 1/0]
+  c._handle_event(msg(CIRC_BW_LINES[0]))
@@ -0,0 +1,106 @@
+import functools
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from vanguards import circuits
+from vanguards import instrument
+
+class MockEvent:
+  def __init__(self, arrived_at):
+    self.arrived_at = arrived_at
+
+class MockController:
+  def __init__(self):
+    self.listeners = {}
+    self._logguard = None
+
+  def add_event_listener(self, func, ev):
+    self.listeners[ev] = func
+
+class Component:
+  def __init__(self):
+    self.seen = 0
+
+  def event(self, ev):
+    self.seen += 1
+
+# Test plan:
+#  - Histogram percentiles land in the right buckets
+#  - Wrapped handlers still run, and record calls, time and lag
+#  - Reports are logged, dumped as JSON, and start a new interval
+#  - Registry listeners get wrapped, and attributes reach the controller
+def test_histogram():
+  h = instrument.Histogram()
+  assert h.percentile(50) == 0.0
+  for i in range(98):
+    h.add(0.001)
+  h.add(0.1)
+  h.add(0.2)
+  assert 0.0008 < h.percentile(50) < 0.0013
+  assert 0.08 < h.percentile(99) < 0.13
+  assert h.percentile(100) == 0.2
+  assert h.max == 0.2
+
+def test_wrap_report():
+  tmpdir = tempfile.mkdtemp()
+  dump = os.path.join(tmpdir, "instruments.json")
+  try:
+    instruments = instrument.Instrumentation(3600, dump)
+    c = Component()
+    wrapped = instruments.wrap(functools.partial(Component.event, c), "BW: ")
+
+    now = time.time()
+    wrapped(MockEvent(now - 0.5))
+    wrapped(MockEvent(now - 0.5))
+    assert c.seen == 2
+
+    stats = instruments.handlers["BW: Component.event"]
+    assert stats.calls == 2
+    assert stats.lag.percentile(50) >= 0.4
+
+    # Exceptions still propagate to stem's handling, but get counted
+    def broken(ev):
+      return 1/0
+    try:
+      instruments.wrap(broken, "BW: ")(MockEvent(now))
+      assert False
+    except ZeroDivisionError:
+      pass
+    assert sum(s.calls for s in instruments.handlers.values()) == 3
+
+    instruments.report(time.time())
+    assert stats.calls == 0
+
+    report = json.loads(open(dump).read())
+    assert report["handlers"]["BW: Component.event"]["calls"] == 2
+    assert report["handlers"]["BW: Component.event"]["lag_p50_secs"] >= 0.4
+
+    # Reports fire from the wrapper once the interval passes
+    instruments.report_secs = 0
+    wrapped(MockEvent(time.time()))
+    assert len(open(dump).readlines()) == 2
+  finally:
+    shutil.rmtree(tmpdir)
+
+def test_controller():
+  instruments = instrument.Instrumentation(3600)
+  c = MockController()
+  ic = instrument.InstrumentedController(c, instruments)
+  comp = Component()
+
+  ic.add_event_listener(comp.event, "BW")
+  c.listeners["BW"](MockEvent(time.time()))
+  assert comp.seen == 1
+  assert instruments.handlers["BW: Component.event"].calls == 1
+
+  ic._logguard = "logs"
+  assert c._logguard == "logs"
+
+  registry = circuits.CircuitRegistry(instruments.wrap)
+  registry.add_listener(circuits.CIRC_CLOSED, comp.event)
+  registry.listeners[circuits.CIRC_CLOSED][0](MockEvent(time.time()))
+  assert comp.seen == 2
+  assert instruments.handlers["CIRC CLOSED: Component.event"].calls == 1
@@ -8,6 +8,7 @@ import stem.control
 import vanguards.control
 import vanguards.config
 import vanguards.main
+import vanguards.rendguard
 
 GOT_SOCKET = ""
 THROW_SOCKET = False
@@ -362,3 +363,30 @@ def test_oneshot():
     assert GOT_SAVE_CONF
 
   os.remove("vanguards.state.test")
+
+# Test plan:
+# - Reconnects wait 1 second at first, then back off up to the limit
+def test_reconnect_delay():
+  delays = [vanguards.main.reconnect_delay(f) for f in range(8)]
+  assert delays[:3] == [1, 1, 2]
+  assert delays == sorted(delays)
+  assert delays[-1] == vanguards.main._MAX_RECONNECT_SECS
+
+# Test plan:
+# - Config files that still set a dropped option get a warning, and
+#   still apply
+def test_deprecated_options():
+  with open("tests/deprecated.conf.test", "w") as f:
+    f.write("[Rendguard]\nrend_use_scale_at_count = 20000\n"+
+            "rend_use_relay_start_count = 100\n")
+  warnings = []
+  plog = vanguards.config.plog
+  vanguards.config.plog = lambda level, msg, *args: warnings.append(msg)
+  try:
+    vanguards.config.apply_config("tests/deprecated.conf.test")
+  finally:
+    vanguards.config.plog = plog
+    os.remove("tests/deprecated.conf.test")
+  assert any("rend_use_scale_at_count" in w for w in warnings)
+  assert not hasattr(vanguards.rendguard, "REND_USE_SCALE_AT_COUNT")
+  vanguards.config.apply_config(DEFAULT_CONFIG)
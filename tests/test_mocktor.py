@@ -0,0 +1,58 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import vanguards
+
+from vanguards import mocktor
+
+def wait_for(cond, timeout=60):
+  start = time.time()
+  while not cond():
+    if time.time() - start > timeout:
+      return False
+    time.sleep(0.1)
+  return True
+
+# Test plan:
+#  - A real vanguards process connects, authenticates, and fetches the
+#    consensus from us
+#  - Its SETCONFs stick, and our probe circuits get closed
+#  - It reconnects after we drop the connection
+def test_mock_tor():
+  tmpdir = tempfile.mkdtemp()
+  tor = mocktor.MockTor(os.path.abspath(os.path.join("tests",
+                                          "cached-microdesc-consensus")),
+                        password="foo", rate=50, lifetime_secs=1,
+                        disconnect_secs=5)
+  server = mocktor.make_server(tor, 0)
+  t = threading.Thread(target=server.serve_forever)
+  t.daemon = True
+  t.start()
+
+  env = dict(os.environ)
+  env["PYTHONPATH"] = os.path.dirname(os.path.dirname(vanguards.__file__))
+  proc = subprocess.Popen([sys.executable, "-c",
+                           "import vanguards.main; vanguards.main.main()",
+                           "--control_port", str(server.server_address[1]),
+                           "--control_pass", "foo",
+                           "--state", os.path.join(tmpdir, "vanguards.state"),
+                           "--loglevel", "ERROR"],
+                          cwd=tmpdir, env=env)
+  try:
+    assert wait_for(lambda: tor.closes)
+    assert "HSLayer2Nodes" in tor.conf
+    assert "HSLayer3Nodes" in tor.conf
+    assert wait_for(lambda: tor.connections >= 2)
+    assert proc.poll() is None
+    assert "probes closed=" in tor.report(time.time())
+  finally:
+    proc.kill()
+    proc.wait()
+    server.shutdown()
+    server.server_close()
+    shutil.rmtree(tmpdir)
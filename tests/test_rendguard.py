@@ -1,4 +1,7 @@
+import os
+import shutil
 import stem
+import tempfile
 import time
 
 from stem.response import ControlMessage
@@ -6,10 +9,12 @@ from stem.response import ControlMessage
 import vanguards.rendguard
 from vanguards.rendguard import REND_USE_GLOBAL_START_COUNT
 from vanguards.rendguard import REND_USE_RELAY_START_COUNT
-from vanguards.rendguard import REND_USE_SCALE_AT_COUNT
 from vanguards.rendguard import REND_USE_MAX_USE_TO_BW_RATIO
+from vanguards.rendguard import REND_USE_CONFIDENCE_Z
 from vanguards.rendguard import REND_USE_MAX_CONSENSUS_WEIGHT_CHURN
+from vanguards.rendguard import HeavyHitters
 from vanguards.rendguard import RendGuard
+from vanguards.rendguard import wilson_lower_bound
 from vanguards.vanguards import VanguardState
 from vanguards.rendguard import _NOT_IN_CONSENSUS_ID
 
@@ -63,6 +68,21 @@ def rend_circ3(circ_id):
 
 # Test plan:
 def test_usecounts():
+  # Exact counts are easier to check without decay
+  half_life = vanguards.rendguard.REND_USE_HALF_LIFE_HOURS
+  vanguards.rendguard.REND_USE_HALF_LIFE_HOURS = 0
+  # The state file, and the log next to it, go in here
+  tmpdir = tempfile.mkdtemp()
+  try:
+    check_usecounts(os.path.join(tmpdir, "vanguards.state"))
+  finally:
+    vanguards.rendguard.REND_USE_HALF_LIFE_HOURS = half_life
+    shutil.rmtree(tmpdir)
+
+def used(rg, idhex):
+  return rg.use_counts.used[rg.use_counts.index[idhex]]
+
+def check_usecounts(state_file):
   rg = RendGuard()
   c = MockController()
 
@@ -72,7 +92,7 @@ def test_usecounts():
     rg.circ_event(c, rend_circ(i))
     assert c.closed_circ == None
     # Verify we're getting the right rend node
-    assert rg.use_counts[_NOT_IN_CONSENSUS_ID].used == i
+    assert used(rg, _NOT_IN_CONSENSUS_ID) == i
     i += 1
 
   # Test circuit closing functionality
@@ -88,7 +108,7 @@ def test_usecounts():
   vanguards.rendguard.REND_USE_CLOSE_CIRCUITS_ON_OVERUSE = True
 
   # Test use limit with an in-consensus relay
-  state = VanguardState("tests/junk")
+  state = VanguardState(state_file)
   state.rendguard = rg
   state.new_consensus_event(c, None)
   r = 1
@@ -99,32 +119,149 @@ def test_usecounts():
     r += 1
 
   # Test closing in-consensus relay
-  while rg.use_counts["BC630CBBB518BE7E9F4E09712AB0269E9DC7D626"].used < \
-          rg.use_counts["BC630CBBB518BE7E9F4E09712AB0269E9DC7D626"].weight \
-           * rg.total_use_counts * REND_USE_MAX_USE_TO_BW_RATIO:
+  fp = "BC630CBBB518BE7E9F4E09712AB0269E9DC7D626"
+  while used(rg, fp) < REND_USE_RELAY_START_COUNT or \
+        wilson_lower_bound(used(rg, fp), rg.total_use_counts,
+                           REND_USE_CONFIDENCE_Z) <= \
+          rg.use_counts.weight_of(fp) * REND_USE_MAX_USE_TO_BW_RATIO:
     assert c.closed_circ == None
     rg.circ_event(c, rend_circ2(i))
     r += 1
     i += 1
 
   assert c.closed_circ == str(i-1)
+  # Its raw use rate went over the limit well before that
+  assert used(rg, fp)/rg.total_use_counts > \
+           rg.use_counts.weight_of(fp) * REND_USE_MAX_USE_TO_BW_RATIO
 
-  # Test almost-scaling with an in-consensus relay
-  while i < REND_USE_SCALE_AT_COUNT-1:
-    rg.circ_event(c, rend_circ2(i))
-    i += 1
-    r += 1
-
+  # Counts carry over to the next consensus, and still add up
+  total = rg.total_use_counts
   state.new_consensus_event(c, None)
-  assert rg.total_use_counts == REND_USE_SCALE_AT_COUNT-1
-  assert rg.use_counts[_NOT_IN_CONSENSUS_ID].used + \
-         rg.use_counts["BC630CBBB518BE7E9F4E09712AB0269E9DC7D626"].used \
-            == rg.total_use_counts
+  assert rg.total_use_counts == total
+  assert used(rg, _NOT_IN_CONSENSUS_ID) + used(rg, fp) == rg.total_use_counts
 
-  # Test scaling with in-consensus relay
-  rg.circ_event(c, rend_circ2(i))
-  state.new_consensus_event(c, None)
-  assert rg.total_use_counts == REND_USE_SCALE_AT_COUNT/2
-  assert rg.use_counts[_NOT_IN_CONSENSUS_ID].used + \
-         rg.use_counts["BC630CBBB518BE7E9F4E09712AB0269E9DC7D626"].used \
-            == rg.total_use_counts
+# Test plan:
+#  - The bound is the raw rate with z=0, and is below it otherwise
+#  - It tightens as the counts grow
+#  - A relay used well over its limit is flagged as soon as the start
+#    counts are reached, while one just over its limit on a busy service
+#    is not
+def test_confidence():
+  assert wilson_lower_bound(5, 10, 0) == 0.5
+  assert wilson_lower_bound(0, 0, 3.0) == 0.0
+  assert wilson_lower_bound(0, 10, 3.0) < 1e-9
+  assert wilson_lower_bound(10, 10, 3.0) < 1.0
+  bounds = [wilson_lower_bound(n//10, n, 3.0) for n in (10, 100, 1000, 10000)]
+  assert bounds == sorted(bounds)
+  assert 0.09 < bounds[-1] < 0.1
+
+  # Exact counts are easier to check without decay
+  half_life = vanguards.rendguard.REND_USE_HALF_LIFE_HOURS
+  vanguards.rendguard.REND_USE_HALF_LIFE_HOURS = 0
+  try:
+    limit = 0.01*REND_USE_MAX_USE_TO_BW_RATIO
+    (quiet, busy) = ("A"*40, "B"*40)
+
+    rg = RendGuard()
+    rg.use_counts.add(quiet, 0.01, 0)
+    rg.use_counts.add("C"*40, 0.98, 0)
+    for i in xrange(REND_USE_GLOBAL_START_COUNT - REND_USE_RELAY_START_COUNT):
+      rg.valid_rend_use("C"*40)
+    for i in xrange(REND_USE_RELAY_START_COUNT - 1):
+      assert rg.valid_rend_use(quiet)
+    assert not rg.valid_rend_use(quiet)
+    assert rg.total_use_counts == REND_USE_GLOBAL_START_COUNT
+
+    rg = RendGuard()
+    rg.use_counts.add(busy, 0.01, 5099)
+    rg.use_counts.add("C"*40, 0.99, 100000 - 5100)
+    rg.total_use_counts = 100000 - 1
+    assert rg.valid_rend_use(busy)
+    assert used(rg, busy)/rg.total_use_counts > limit
+  finally:
+    vanguards.rendguard.REND_USE_HALF_LIFE_HOURS = half_life
+
+# Test plan:
+#  - Off-consensus relays go to their own counts, as well as the shared one
+#  - Memory stays bounded however many relays we see
+#  - Heavily used relays are found, and their counts are within their
+#    error of the truth
+#  - Counts decay like the others
+def test_heavy_hitters():
+  rg = RendGuard()
+  now = 1000000.0
+  rg.total_updated_at = rg.off_consensus.updated_at = now
+  heavy = "F"*40
+  for i in xrange(20000):
+    if i % 10 == 0:
+      rg.valid_rend_use(heavy, now)
+    else:
+      rg.valid_rend_use("%040X" % i, now)
+  assert used(rg, _NOT_IN_CONSENSUS_ID) == 20000
+  assert rg.off_consensus_dirty
+
+  tracker = rg.off_consensus
+  assert len(tracker) == tracker.capacity
+  (idhex, count, error) = tracker.top(now)[0]
+  assert idhex == heavy
+  assert count - error <= 2000 <= count
+  assert len(tracker.top(now, 5)) == 5
+
+  hour = 60*60
+  half_life = vanguards.rendguard.REND_USE_HALF_LIFE_HOURS
+  vanguards.rendguard.REND_USE_HALF_LIFE_HOURS = 1
+  try:
+    assert tracker.top(now + hour)[0][1] == count/2
+    tracker.add(heavy, now + hour)
+    assert tracker.top(now + hour)[0][1] == count/2 + 1
+  finally:
+    vanguards.rendguard.REND_USE_HALF_LIFE_HOURS = half_life
+
+  small = HeavyHitters(2, now)
+  small.set([("A"*40, 3.0, 0.0), ("B"*40, 1.0, 0.0), ("C"*40, 2.0, 1.0)],
+            now)
+  assert [e[0] for e in small.top(now)] == ["A"*40, "C"*40]
+
+# Test plan:
+#  - Counts and their total halve every half-life, but only get updated
+#    when they are read or counted
+#  - A relay that is newly used heavily can't hide behind older uses
+#  - Counts of relays that leave the consensus leave the total too
+def test_decay():
+  half_life = vanguards.rendguard.REND_USE_HALF_LIFE_HOURS
+  vanguards.rendguard.REND_USE_HALF_LIFE_HOURS = 1
+  try:
+    rg = RendGuard()
+    now = 1000000.0
+    (old, new) = ("A"*40, "B"*40)
+    rg.use_counts.add(old, 0.5, 0, now)
+    rg.use_counts.add(new, 0.5, 0, now)
+    rg.total_updated_at = now
+
+    for i in xrange(8):
+      rg.valid_rend_use(old, now)
+    assert rg.total_use_counts == 8
+
+    hour = 60*60
+    for i in xrange(4):
+      rg.valid_rend_use(new, now + hour)
+    assert used(rg, old) == 8
+    assert rg.use_counts.used_at(old, now + hour) == 4
+    assert used(rg, new) == 4
+    assert rg.total_use_counts == 8
+    assert rg.total_at(now + 2*hour) == 4
+
+    # Without decay, 'new' would have 1/3 of the uses, rather than 1/2
+    assert used(rg, new)/rg.total_use_counts == 0.5
+
+    # 'old' leaves the consensus
+    class Gen:
+      rstr_routers = []
+      node_weights = []
+      weight_total = exit_total = 1.0
+    rg.update_use_counts(Gen(), [old], [], now + 2*hour)
+    assert old not in rg.use_counts
+    assert rg.total_use_counts == 2
+    assert rg.total_updated_at == now + 2*hour
+  finally:
+    vanguards.rendguard.REND_USE_HALF_LIFE_HOURS = half_life
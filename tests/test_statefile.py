@@ -0,0 +1,196 @@
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import zlib
+
+from vanguards import consensus
+from vanguards import rendguard
+from vanguards import statefile
+
+from vanguards.vanguards import ExcludeNodes
+from vanguards.vanguards import VanguardState
+
+class MockController:
+  def get_conf(self, key):
+    return None
+
+  def get_info(self, key, default=None):
+    return default
+
+def raises_value_error(data):
+  try:
+    statefile.unpack(data)
+    return False
+  except ValueError:
+    return True
+
+def consensus_state(state_file):
+  state = VanguardState(state_file)
+  (routers, weights) = consensus.read_consensus(
+                            "tests/cached-microdesc-consensus")
+  state.consensus_update(routers, weights, ExcludeNodes(MockController()))
+  counts = state.rendguard.use_counts
+  for i in range(len(counts.used)):
+    counts.used[i] = float(i % 7)
+  state.rendguard.total_use_counts = sum(counts.used)
+  now = time.time()
+  for i in range(10):
+    state.rendguard.off_consensus.add("%040X" % (i % 4), now)
+  return state
+
+def close(a, b):
+  return abs(a - b) <= 1e-9*max(abs(a), 1.0)
+
+# Counts get saved as of the time they were written, so compare them as of
+# one time.
+def same_state(a, b):
+  now = time.time()
+  for (la, lb) in ((a.layer2, b.layer2), (a.layer3, b.layer3)):
+    assert [(g.idhex, g.chosen_at, g.expires_at) for g in la] == \
+           [(g.idhex, g.chosen_at, g.expires_at) for g in lb]
+  assert close(a.rendguard.total_at(now), b.rendguard.total_at(now))
+  (ca, cb) = (a.rendguard.use_counts, b.rendguard.use_counts)
+  assert set(ca) == set(cb)
+  for idhex in ca:
+    assert close(ca.used_at(idhex, now), cb.used_at(idhex, now))
+    assert ca.weight_of(idhex) == cb.weight_of(idhex)
+  (ta, tb) = (a.rendguard.off_consensus.top(now),
+              b.rendguard.off_consensus.top(now))
+  assert [e[0] for e in ta] == [e[0] for e in tb]
+  for (ea, eb) in zip(ta, tb):
+    assert close(ea[1], eb[1]) and close(ea[2], eb[2])
+
+# Test plan:
+#  - State survives a round trip through the compact format exactly
+#  - Pickled state files still load, and get rewritten in the new format
+#  - Truncated, corrupted and unknown-version files are rejected
+#  - Writes replace the file without leaving a temporary file behind
+def test_round_trip():
+  tmpdir = tempfile.mkdtemp()
+  try:
+    state_file = os.path.join(tmpdir, "vanguards.state")
+    state = consensus_state(state_file)
+    assert rendguard._NOT_IN_CONSENSUS_ID in state.rendguard.use_counts
+    state.write_state_file()
+    assert os.listdir(tmpdir) == ["vanguards.state"]
+
+    loaded = VanguardState.read_from_file(state_file)
+    assert loaded.state_file == state_file
+    same_state(state, loaded)
+
+    # A state that has never seen a consensus
+    empty = VanguardState(state_file)
+    same_state(empty, VanguardState.from_bytes(empty.to_bytes(), state_file))
+  finally:
+    shutil.rmtree(tmpdir)
+
+def test_pickle_migration():
+  tmpdir = tempfile.mkdtemp()
+  try:
+    state_file = os.path.join(tmpdir, "vanguards.state")
+    shutil.copy("tests/state.mock", state_file)
+    old = pickle.load(open("tests/state.mock", "rb"))
+    state = VanguardState.read_from_file(state_file)
+    same_state(old, state)
+
+    state.write_state_file()
+    assert statefile.is_compact(open(state_file, "rb").read())
+    same_state(old, VanguardState.read_from_file(state_file))
+  finally:
+    shutil.rmtree(tmpdir)
+
+def test_bad_files():
+  data = consensus_state("unused").to_bytes()
+
+  assert raises_value_error(data[:len(data)//2])
+  assert raises_value_error(data[:5])
+
+  corrupt = bytearray(data)
+  corrupt[len(data)//2] ^= 0xff
+  assert raises_value_error(bytes(corrupt))
+
+  future = statefile.pack([], [], 0.0, 0.0, None, [], [], [], [])
+  future = future[:4] + b"\x00\x63" + future[6:-4]
+  future += statefile._CRC.pack(zlib.crc32(future) & 0xffffffff)
+  assert raises_value_error(future)
+
+  # Right length for two fingerprints, but three of them
+  split = statefile.pack([], [], 0.0, 0.0, None, ["A"*20+"\n"+"A"*19, "B"*40],
+                         [0.0, 0.0], [0.0, 0.0], [])
+  assert raises_value_error(split)
+
+# Test plan:
+#  - Unchanged state is not written
+#  - Use counts alone go to the log, and are replayed on load
+#  - Guard changes and failed writes rewrite the state file and drop the
+#    log
+#  - The log is compacted once it outgrows the state file
+#  - Torn and stale logs are ignored, and cut back so we can append
+def test_delta_log():
+  tmpdir = tempfile.mkdtemp()
+  try:
+    state_file = os.path.join(tmpdir, "vanguards.state")
+    log_file = state_file+".log"
+    state = consensus_state(state_file)
+    state.write_state_file()
+    store = state.store
+    assert store.snapshots == 1
+    written = store.bytes_written
+
+    state.write_state_file()
+    assert store.skipped == 1
+    assert store.bytes_written == written
+    assert not os.path.exists(log_file)
+
+    rg = state.rendguard
+    (fp1, fp2) = [fp for fp in rg.use_counts
+                  if fp != rendguard._NOT_IN_CONSENSUS_ID][:2]
+    rg.valid_rend_use(fp1)
+    rg.valid_rend_use(fp1)
+    rg.valid_rend_use("0"*40) # Not in the consensus
+    state.write_state_file()
+    rg.valid_rend_use(fp2)
+    state.write_state_file()
+    assert store.snapshots == 1
+    assert store.deltas == 2
+    assert store.bytes_written - written == os.path.getsize(log_file)
+    same_state(state, VanguardState.read_from_file(state_file))
+
+    # A torn append is dropped, and the next one still gets replayed
+    with open(log_file, "ab") as f:
+      f.write(statefile.pack_delta(time.time(), 1.0, [(fp1, 1.0)])[:-3])
+    loaded = VanguardState.read_from_file(state_file)
+    same_state(state, loaded)
+    loaded.rendguard.valid_rend_use(fp2)
+    loaded.write_state_file()
+    same_state(loaded, VanguardState.read_from_file(state_file))
+
+    # Guard changes rewrite the state file
+    state.layer3 = state.layer3[1:]
+    state.write_state_file()
+    assert store.snapshots == 2
+    assert not os.path.exists(log_file)
+    same_state(state, VanguardState.read_from_file(state_file))
+
+    # A log left from an older state file is ignored
+    with open(log_file, "wb") as f:
+      f.write(statefile._LOG_HEADER.pack(statefile.LOG_MAGIC,
+                                         statefile.FORMAT_VERSION, b"\0"*4) +
+              statefile.pack_delta(time.time(), 1.0, [(fp1, 1000.0)]))
+    same_state(state, VanguardState.read_from_file(state_file))
+
+    # So does a failed write
+    rg.dirty_all = True
+    state.write_state_file()
+    assert store.snapshots == 3
+
+    # Enough appends get compacted
+    while store.snapshots == 3:
+      rg.dirty = set(fp for fp in rg.use_counts)
+      state.write_state_file()
+    assert store.log_bytes == 0
+    same_state(state, VanguardState.read_from_file(state_file))
+  finally:
+    shutil.rmtree(tmpdir)
@@ -1,15 +1,26 @@
+import pickle
+import random
 import stem
 import time
 import os
+import threading
 import shutil
 
 from stem.response import ControlMessage
 
+from vanguards import consensus
 from vanguards.control import get_consensus_weights
 
+from vanguards.NodeSelection import BwWeightedGenerator
+from vanguards.NodeSelection import FlagsRestriction
+from vanguards.NodeSelection import NoNodesRemain
+from vanguards.NodeSelection import NodeRestrictionList
+
 import vanguards.vanguards
 from vanguards.vanguards import VanguardState
+from vanguards.vanguards import GuardLayers
 from vanguards.vanguards import ExcludeNodes
+from vanguards.vanguards import NetworkIndex
 from vanguards.vanguards import _SEC_PER_HOUR
 
 from vanguards.vanguards import NUM_LAYER3_GUARDS
@@ -24,6 +35,11 @@ try:
 except NameError:
   xrange = range
 
+try:
+  unicode
+except NameError:
+  unicode = str
+
 def replacement_checks(state, routers, weights):
   remove2_idhex = state.layer2[0].idhex
   remove3_idhex = state.layer3[0].idhex
@@ -129,6 +145,7 @@ class MockController:
     self.got_set_conf = False
     self.got_save_conf = False
     self.get_info_vals = {}
+    self.get_info_calls = 0
     self._logguard = None
 
   def signal(self, sig):
@@ -158,6 +175,9 @@ class MockController:
     raise stem.OperationFailed("Bad")
 
   def get_info(self, key, default=None):
+    self.get_info_calls += 1
+    if isinstance(key, list):
+      return dict((k, self.get_info_vals.get(k, default)) for k in key)
     if key in self.get_info_vals:
       return self.get_info_vals[key]
     else:
@@ -255,6 +275,109 @@ def test_excludenodes():
 
   # FIXME: IPv6. Stem before 1.7.0 does not support IPv6 relays..
 
+# Test plan:
+#  - NetworkIndex agrees with ipaddress overlap checks, for IPv4 and IPv6
+#    networks that overlap, nest and abut
+def test_network_index():
+  from ipaddress import ip_network
+
+  rng = random.Random(7)
+  networks = [ip_network(u"10.0.0.0/8"), ip_network(u"10.1.0.0/16"),
+              ip_network(u"11.0.0.0/8"), ip_network(u"192.168.1.7/32"),
+              ip_network(u"2001:db8::/32"), ip_network(u"2001:db8:1::/48")]
+  for i in xrange(200):
+    networks.append(ip_network(u"%d.%d.0.0/%d" % (rng.randint(0, 255),
+                                                  rng.randint(0, 255),
+                                                  rng.randint(8, 16)),
+                               strict=False))
+  index = NetworkIndex(networks)
+
+  addresses = ["10.255.255.255", "12.0.0.0", "9.255.255.255", "192.168.1.7",
+               "192.168.1.8", "2001:db8:ffff::1", "2001:db9::", "::1"]
+  for i in xrange(2000):
+    addresses.append("%d.%d.%d.%d" % tuple(rng.randint(0, 255)
+                                           for j in xrange(4)))
+  for a in addresses:
+    host = ip_network(unicode(a))
+    expected = any(n.version == host.version and n.overlaps(host)
+                   for n in networks)
+    assert index.contains(a) == expected
+
+  assert not NetworkIndex([]).contains("1.2.3.4")
+
+# Test plan:
+#  - Countries are only looked up for drawn routers, and cached across
+#    consensuses
+#  - A layer's guards get their countries looked up in one batch
+#  - The cache is dropped on SIGHUP, and for a new controller
+#  - Dropping the cache during a lookup doesn't break it
+def test_country_cache():
+  controller = MockController()
+  state = VanguardState("tests/state.mock2")
+  routers = list(stem.descriptor.parse_file("tests/cached-microdesc-consensus",
+                 document_handler =
+                    stem.descriptor.DocumentHandler.ENTRIES))
+  weights = get_consensus_weights("tests/cached-microdesc-consensus")
+  (sorted_r, dict_r) = state.sort_and_index_routers(routers)
+
+  controller.exclude_nodes = "{us}"
+  controller.get_info_vals["ip-to-country/ipv4-available"] = "1"
+  for r in routers:
+    controller.get_info_vals["ip-to-country/"+r.address] = "DE"
+  state.consensus_update(routers, weights,
+                         ExcludeNodes(controller, state.country_cache))
+  sanity_check(state)
+
+  # Only for the routers that got drawn
+  assert controller.get_info_calls < 3*(NUM_LAYER2_GUARDS + NUM_LAYER3_GUARDS)
+  guard = dict_r[state.layer2[0].idhex]
+  assert state.country_cache.countries[guard.address] == "de"
+  assert len(state.country_cache.countries) < len(routers)/10
+
+  # Replace a guard from a cached country, without asking tor again
+  removed2 = state.layer2[0].idhex
+  controller.get_info_vals["ip-to-country/"+dict_r[removed2].address] = "US"
+  state.country_cache.countries[dict_r[removed2].address] = "us"
+  calls = controller.get_info_calls
+  state.consensus_update(routers, weights,
+                         ExcludeNodes(controller, state.country_cache))
+  sanity_check(state)
+  assert not removed2 in map(lambda x: x.idhex, state.layer2)
+  assert controller.get_info_calls - calls <= 3
+
+  state.signal_event(controller,
+                     ControlMessage.from_str("650 SIGNAL RELOAD\r\n",
+                                             "EVENT"))
+  assert not state.country_cache.countries
+
+  # Guards already in a layer get checked in one batch
+  exclude = ExcludeNodes(controller, state.country_cache)
+  calls = controller.get_info_calls
+  layers = GuardLayers(state.layer2, state.layer3)
+  layers.remove_excluded_from_layer(layers.layer3, dict_r, exclude)
+  assert len(layers.layer3) == len(state.layer3)
+  assert controller.get_info_calls - calls <= 2
+  for g in state.layer3:
+    assert dict_r[g.idhex].address in state.country_cache.countries
+
+  ExcludeNodes(controller, state.country_cache).exclusion_mask(routers)
+  assert state.country_cache.countries
+  other = MockController()
+  other.exclude_nodes = "{us}"
+  other.get_info_vals["ip-to-country/ipv4-available"] = "1"
+  ExcludeNodes(other, state.country_cache).router_is_excluded(routers[0])
+  assert list(state.country_cache.countries) == [routers[0].address]
+
+  # Invalidating from the event thread, in the middle of a lookup, doesn't
+  # lose its answer
+  cache = state.country_cache
+  get_info = other.get_info
+  def invalidating_get_info(*args):
+    cache.invalidate()
+    return get_info(*args)
+  other.get_info = invalidating_get_info
+  assert cache.country(other, routers[1].address) == None
+
 def test_disable():
   controller = MockController()
   vanguards.vanguards.LAYER1_LIFETIME_DAYS = 30
@@ -269,3 +392,466 @@ def test_disable():
   assert controller.got_save_conf == False
   os.remove("tests/state.mock.test")
 
+
+# Test plan:
+#  - Prefix-sum selection picks exactly what the old linear scan picked
+#    for the same random draws, including after repair_exits()
+#  - Selection frequencies match node weights (chi-square test)
+def linear_scan_choice(ng, choice_val):
+  choose_total = 0
+  choice_idx = 0
+  while choose_total < choice_val:
+    choose_total += ng.node_weights[choice_idx]
+    choice_idx += 1
+  return ng.rstr_routers[choice_idx-1]
+
+def test_generator_distribution():
+  state = VanguardState("tests/state.mock2")
+  routers = list(stem.descriptor.parse_file("tests/cached-microdesc-consensus",
+                 document_handler =
+                    stem.descriptor.DocumentHandler.ENTRIES))
+  weights = get_consensus_weights("tests/cached-microdesc-consensus")
+  (sorted_r, dict_r) = state.sort_and_index_routers(routers)
+  ng = BwWeightedGenerator(sorted_r,
+                     NodeRestrictionList(
+                           [FlagsRestriction(["Fast", "Valid"],
+                                             ["Authority"])]),
+                           weights, BwWeightedGenerator.POSITION_MIDDLE)
+
+  rng = random.Random(42)
+  for repaired in (False, True):
+    if repaired:
+      ng.repair_exits()
+    gen = ng.generate()
+    for i in xrange(5000):
+      seed = rng.random()
+      random.seed(seed)
+      choice = next(gen)
+      random.seed(seed)
+      assert choice is linear_scan_choice(ng,
+                                          random.uniform(0, ng.weight_total))
+
+  # Group nodes into bins of roughly equal expected probability, and
+  # compare draw counts against the weights.
+  ng.rebuild()
+  draws = 200000
+  bins = 50
+  bin_of = []
+  expected = [0.0]*bins
+  running = 0.0
+  for w in ng.node_weights:
+    b = min(int(running/ng.weight_total*bins), bins-1)
+    bin_of.append(b)
+    expected[b] += w
+    running += w
+  expected = [draws*e/ng.weight_total for e in expected]
+
+  idx = dict((id(r), i) for (i, r) in enumerate(ng.rstr_routers))
+  counts = [0]*bins
+  random.seed(1)
+  gen = ng.generate()
+  for i in xrange(draws):
+    counts[bin_of[idx[id(next(gen))]]] += 1
+
+  chi2 = sum((counts[b] - expected[b])**2/expected[b]
+             for b in xrange(bins) if expected[b])
+  # 99.9th percentile of chi-square with 49 degrees of freedom
+  assert chi2 < 85.35
+
+# Test plan:
+#  - FlagsRestriction masks accept the same routers as flag name checks
+#  - The per-position weight tables give the same weights as looking up
+#    each router's flags in the bandwidth-weights
+#  - Guard position generators work without a Wge weight, which tor
+#    never includes, and give exits no weight
+def string_flag_weight(weights, position, r):
+  if "Guard" in r.flags and "Exit" in r.flags:
+    return weights[u'W'+position+'d']/10000.0
+  if "Exit" in r.flags:
+    return weights[u'W'+position+'e']/10000.0
+  if "Guard" in r.flags:
+    return weights[u'W'+position+'g']/10000.0
+  return weights[u'Wmm']/10000.0
+
+def test_flag_masks():
+  (routers, weights) = consensus.read_consensus(
+                            "tests/cached-microdesc-consensus")
+  rstr = FlagsRestriction(["Fast", "Stable", "Valid"], ["Authority"])
+  for r in routers:
+    assert rstr.r_is_ok(r) == \
+      (all(f in r.flags for f in ["Fast", "Stable", "Valid"]) and
+       "Authority" not in r.flags)
+
+  # A flag no router has yet never matches
+  assert not any(FlagsRestriction(["NotYetAFlag"]).r_is_ok(r)
+                 for r in routers)
+
+  state = VanguardState("tests/state.mock2")
+  (sorted_r, dict_r) = state.sort_and_index_routers(routers)
+  ng = BwWeightedGenerator(sorted_r,
+                     NodeRestrictionList(
+                           [FlagsRestriction(["Fast", "Valid"],
+                                             ["Authority"])]),
+                           weights, BwWeightedGenerator.POSITION_MIDDLE)
+  assert ng.node_weights == [r.measured*string_flag_weight(weights, 'm', r)
+                             for r in ng.rstr_routers]
+  ng.repair_exits()
+  for (w, r) in zip(ng.node_weights, ng.rstr_routers):
+    if "Exit" in r.flags:
+      assert w == r.measured*string_flag_weight(weights, 'e', r)
+
+  assert u'Wge' not in weights
+  ng = BwWeightedGenerator(sorted_r,
+                     NodeRestrictionList(
+                           [FlagsRestriction(["Fast", "Valid"],
+                                             ["Authority"])]),
+                           weights, BwWeightedGenerator.POSITION_GUARD)
+  for (w, r) in zip(ng.node_weights, ng.rstr_routers):
+    if "Exit" in r.flags and "Guard" not in r.flags:
+      assert w == 0
+    else:
+      assert w == r.measured*string_flag_weight(weights, 'g', r)
+  assert ng.weight_total > 0
+
+# Test plan:
+#  - choose_distinct() returns distinct routers, never excluded ones
+#  - It only checks the routers it draws for exclusion, in batches
+#  - Its first draw has the same distribution as rejecting excluded
+#    routers from generate()
+#  - It raises NoNodesRemain if exclusions leave too few routers
+def test_choose_distinct():
+  state = VanguardState("tests/state.mock2")
+  routers = list(stem.descriptor.parse_file("tests/cached-microdesc-consensus",
+                 document_handler =
+                    stem.descriptor.DocumentHandler.ENTRIES))
+  weights = get_consensus_weights("tests/cached-microdesc-consensus")
+  (sorted_r, dict_r) = state.sort_and_index_routers(routers)
+  ng = BwWeightedGenerator(sorted_r,
+                     NodeRestrictionList(
+                           [FlagsRestriction(["Fast", "Stable", "Valid"],
+                                             ["Authority"])]),
+                           weights, BwWeightedGenerator.POSITION_MIDDLE)
+
+  # Mask off the ten heaviest routers, and every other one after that
+  mask = [i < 10 or i % 2 == 1 for i in xrange(len(ng.rstr_routers))]
+  masked = set(r.fingerprint for (m, r) in zip(mask, ng.rstr_routers) if m)
+  checked = []
+  batches = []
+  def excluded(routers):
+    checked.extend(routers)
+    batches.append(len(routers))
+    return [r.fingerprint in masked for r in routers]
+
+  random.seed(3)
+  for i in xrange(200):
+    checked = []
+    batches = []
+    chosen = ng.choose_distinct(8, excluded)
+    assert len(set(r.fingerprint for r in chosen)) == 8
+    # The first batch draws all 8, and later ones only what's missing
+    assert batches[0] == 8 and sum(batches) == len(checked)
+    assert not masked & set(r.fingerprint for r in chosen)
+    assert len(checked) < len(ng.rstr_routers)/10
+    assert len(set(r.fingerprint for r in checked)) == len(checked)
+
+  draws = 20000
+  random.seed(4)
+  batch = {}
+  for i in xrange(draws):
+    fp = ng.choose_distinct(1, excluded)[0].fingerprint
+    batch[fp] = batch.get(fp, 0) + 1
+  rejected = {}
+  gen = ng.generate()
+  for i in xrange(draws):
+    r = next(gen)
+    while r.fingerprint in masked:
+      r = next(gen)
+    rejected[r.fingerprint] = rejected.get(r.fingerprint, 0) + 1
+
+  # Two-sample chi-square over the routers drawn often enough to test
+  fps = [fp for fp in set(batch) | set(rejected)
+         if batch.get(fp, 0) + rejected.get(fp, 0) >= 20]
+  chi2 = sum((batch.get(fp, 0) - rejected.get(fp, 0))**2.0/
+             (batch.get(fp, 0) + rejected.get(fp, 0)) for fp in fps)
+  # Well above the 99.9th percentile for this many degrees of freedom
+  assert chi2 < len(fps) + 4*(2*len(fps))**0.5
+
+  first = ng.rstr_routers[0]
+  try:
+    ng.choose_distinct(2, lambda routers: [r is not first for r in routers])
+    assert False
+  except NoNodesRemain:
+    pass
+
+# Test plan:
+#  - Applying consensus diffs gives exactly the routers, weights, totals
+#    and rend use counts that a full rebuild does
+#  - New bandwidth-weights cause a full rebuild
+#  - The index is not pickled
+def modified_consensus(step):
+  (routers, weights) = consensus.read_consensus(
+                            "tests/cached-microdesc-consensus")
+  rng = random.Random(step)
+  routers = [r for r in routers if rng.random() > 0.02]
+  for r in routers:
+    if rng.random() < 0.05:
+      r.measured = rng.randint(1, 100000)
+    if rng.random() < 0.02:
+      if "Stable" in r.flags:
+        r.flags = [f for f in r.flags if f != "Stable"]
+      else:
+        r.flags = list(r.flags) + ["Exit"]
+  return (routers, weights)
+
+def check_same_index(a, b):
+  assert [r.fingerprint for r in a.sorted_r] == \
+         [r.fingerprint for r in b.sorted_r]
+  assert set(a.dict_r) == set(b.dict_r)
+  for (ga, gb) in ((a.layer_gen, b.layer_gen), (a.rend_gen, b.rend_gen)):
+    assert [r.fingerprint for r in ga.rstr_routers] == \
+           [r.fingerprint for r in gb.rstr_routers]
+    assert ga.node_weights == gb.node_weights
+    assert ga.cumulative_weights == gb.cumulative_weights
+    assert ga.weight_total == gb.weight_total
+  assert a.rend_gen.exit_total == b.rend_gen.exit_total
+
+def test_incremental_consensus():
+  incremental = VanguardState("tests/state.mock2")
+  (routers, weights) = modified_consensus(0)
+  incremental.consensus_update(routers, weights,
+                               ExcludeNodes(MockController()))
+  index = incremental.consensus_index
+
+  for step in xrange(1, 4):
+    rg = incremental.rendguard
+    now = time.time()
+    for (i, r) in enumerate(index.sorted_r[:50]):
+      slot = rg.use_counts.index[r.fingerprint]
+      rg.use_counts.decay(slot, now)
+      rg.use_counts.used[slot] = i+step
+    rg.total_use_counts = rg.use_counts.total_at(now)
+    rg.total_updated_at = now
+    full = pickle.loads(pickle.dumps(incremental))
+    assert full.consensus_index is None
+
+    (routers, weights) = modified_consensus(step)
+    incremental.consensus_update(routers, weights,
+                                 ExcludeNodes(MockController()))
+    (routers, weights) = modified_consensus(step)
+    full.consensus_update(routers, weights, ExcludeNodes(MockController()))
+
+    # The diff was applied to the same index
+    assert incremental.consensus_index is index
+    check_same_index(incremental.consensus_index, full.consensus_index)
+    sanity_check(incremental)
+
+    inc_counts = incremental.rendguard.use_counts
+    full_counts = full.rendguard.use_counts
+    assert set(inc_counts) == set(full_counts)
+    for fp in full_counts:
+      assert inc_counts.weight_of(fp) == full_counts.weight_of(fp)
+      assert inc_counts.used[inc_counts.index[fp]] == \
+             full_counts.used[full_counts.index[fp]]
+    # The totals are summed differently, as of slightly different times
+    now = time.time()
+    assert abs(incremental.rendguard.total_at(now) -
+               full.rendguard.total_at(now)) < 1e-9*rg.total_use_counts
+
+  weights = dict(weights)
+  weights["Wmm"] = 9000
+  incremental.consensus_update(routers, weights,
+                               ExcludeNodes(MockController()))
+  assert incremental.consensus_index is not index
+
+# Test plan:
+#  - The updater processes consensuses on its own thread, and writes state
+#  - Consensuses that arrive while one is processed coalesce into one run,
+#    which gets the newest event
+#  - Rendguard's use counts only change once the snapshot is swapped in
+#  - Fatal errors drop the connection, so the main thread can handle them
+#  - Circuit events that lag while a consensus is processed are tracked,
+#    and ones before or after it aren't
+class CountingState:
+  def __init__(self, block=None, fail=None):
+    self.calls = 0
+    self.events = []
+    self.block = block
+    self.fail = fail
+
+  def new_consensus_event(self, controller, event):
+    self.calls += 1
+    self.events.append(event)
+    if self.block:
+      self.block.wait()
+    if self.fail:
+      raise self.fail
+
+class LaggedEvent:
+  def __init__(self, lag):
+    self.arrived_at = time.time() - lag
+
+class BlockingController(MockController):
+  def __init__(self):
+    MockController.__init__(self)
+    self.started = threading.Event()
+    self.unblock = threading.Event()
+
+  def get_conf(self, key):
+    if key == "DataDirectory" and not self.unblock.is_set():
+      self.started.set()
+      self.unblock.wait()
+    return MockController.get_conf(self, key)
+
+class ClosingController(MockController):
+  def __init__(self):
+    MockController.__init__(self)
+    self.closed = False
+
+  def close(self):
+    self.closed = True
+
+def test_consensus_updater():
+  controller = MockController()
+  state = VanguardState("tests/state.mock.bg")
+  try:
+    updater = vanguards.vanguards.ConsensusUpdater(state, controller)
+    updater.new_consensus_event(None)
+    updater.thread.join()
+    sanity_check(state)
+    assert state.rendguard.use_counts
+    assert os.path.exists("tests/state.mock.bg")
+  finally:
+    if os.path.exists("tests/state.mock.bg"):
+      os.remove("tests/state.mock.bg")
+
+  # Counting waits for the swap, but selection doesn't
+  state.enable_vanguards = False
+  (routers, weights) = consensus.read_consensus(
+                            "tests/cached-microdesc-consensus")
+  routers = routers[1:]
+  with state.rendguard.lock:
+    snapshot = state.build_consensus(routers, weights,
+                                     ExcludeNodes(controller))
+    swap = threading.Thread(target=state.apply_consensus, args=(snapshot,))
+    swap.start()
+    swap.join(0.2)
+    assert swap.is_alive()
+    assert len(state.rendguard.use_counts) == len(routers) + 2
+  swap.join()
+  assert len(state.rendguard.use_counts) == len(routers) + 1
+
+  block = threading.Event()
+  counting = CountingState(block)
+  updater = vanguards.vanguards.ConsensusUpdater(counting, controller)
+  updater.new_consensus_event("first")
+  first = updater.thread
+  for i in xrange(3):
+    updater.new_consensus_event(i)
+  block.set()
+  first.join()
+  assert counting.calls == 2
+  assert counting.events == ["first", 2]
+  assert not updater.running
+
+  controller = ClosingController()
+  updater = vanguards.vanguards.ConsensusUpdater(
+                  CountingState(fail=SystemExit(1)), controller)
+  updater.new_consensus_event(None)
+  updater.thread.join()
+  assert controller.closed
+
+  controller = BlockingController()
+  state = VanguardState("tests/state.mock.lag")
+  try:
+    state.event_lag.event(LaggedEvent(10))
+    updater = vanguards.vanguards.ConsensusUpdater(state, controller)
+    updater.new_consensus_event(None)
+    assert controller.started.wait(30)
+    assert updater.busy()
+    state.event_lag.event(LaggedEvent(2.5))
+    state.event_lag.event(LaggedEvent(0.5))
+    controller.unblock.set()
+    updater.thread.join()
+    state.event_lag.event(LaggedEvent(10))
+    assert 2.5 <= state.event_lag.max_lag < 10
+    assert not state.event_lag.tracking
+  finally:
+    if os.path.exists("tests/state.mock.lag"):
+      os.remove("tests/state.mock.lag")
+
+# Test plan:
+#  - Nothing happens until a guard expires
+#  - An expired layer3 guard is replaced from the last consensus, and only
+#    HSLayer3Nodes is sent to tor
+#  - Nothing is rotated while a consensus is being processed
+#  - New layers from a consensus get rescheduled
+class ConfController(MockController):
+  def __init__(self):
+    MockController.__init__(self)
+    self.confs = {}
+
+  def set_conf(self, key, val):
+    MockController.set_conf(self, key, val)
+    self.confs[key] = val
+
+class BusyUpdater:
+  def __init__(self):
+    self.running = True
+
+  def busy(self):
+    return self.running
+
+def test_guard_rotator():
+  controller = ConfController()
+  state = VanguardState("tests/state.mock.rotate")
+  try:
+    (routers, weights) = consensus.read_consensus(
+                              "tests/cached-microdesc-consensus")
+    state.consensus_update(routers, weights, ExcludeNodes(controller))
+    updater = BusyUpdater()
+    rotator = vanguards.vanguards.GuardRotator(state, controller, updater)
+
+    now = time.time()
+    rotator.check_expiry(now)
+    assert rotator.heap[0][0] == min(g.expires_at
+                                     for g in state.layer2 + state.layer3)
+    assert not controller.confs
+
+    layer2 = state.layer2_guardset()
+    expired = state.layer3[3]
+    expired.expires_at = now - 1
+    rotator.schedule()
+
+    rotator.check_expiry(now)
+    assert expired in state.layer3
+
+    # A failed rotation keeps the expired guard, and retries later
+    updater.running = False
+    get_conf = controller.get_conf
+    def broken_get_conf(*args):
+      raise stem.ControllerError("Coverage")
+    controller.get_conf = broken_get_conf
+    rotator.check_expiry(now)
+    assert expired in state.layer3
+    assert rotator.heap[0][0] == expired.expires_at
+    controller.get_conf = get_conf
+    rotator.check_expiry(now)
+    assert expired in state.layer3
+
+    rotator.check_expiry(now + vanguards.vanguards._ROTATE_RETRY_SECS)
+    assert expired not in state.layer3
+    assert len(state.layer3) == NUM_LAYER3_GUARDS
+    assert state.layer2_guardset() == layer2
+    assert controller.confs == {"HSLayer3Nodes": state.layer3_guardset()}
+    assert len(rotator.heap) == NUM_LAYER2_GUARDS + NUM_LAYER3_GUARDS
+    assert os.path.exists("tests/state.mock.rotate")
+    sanity_check(state)
+
+    state.layer2 = list(state.layer2)
+    state.layer2[0].expires_at = now - 1
+    rotator.check_expiry(now)
+    assert controller.confs["HSLayer2Nodes"] == state.layer2_guardset()
+    assert state.layer2_guardset() != layer2
+  finally:
+    if os.path.exists("tests/state.mock.rotate"):
+      os.remove("tests/state.mock.rotate")
@@ -0,0 +1,169 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import stem
+import stem.descriptor
+
+from stem.response import ControlMessage
+
+from vanguards import config
+from vanguards import vanguards
+from vanguards import workers
+
+CIRC_BW = "650 CIRC_BW ID=7 READ=509 WRITTEN=0 TIME=2018-05-04T06:08:55.751726 DELIVERED_READ=498 OVERHEAD_READ=0 DELIVERED_WRITTEN=0 OVERHEAD_WRITTEN=0\r\n"
+ORCONN = "650 ORCONN $3E53D3979DB07EFD736661C934A1DED14127B684~Unnamed CONNECTED ID=1\r\n"
+
+class MockController:
+  def __init__(self):
+    self.alive = True
+    self.events = []
+    self.stem_events = []
+    self.closed = []
+    self.got_close = threading.Event()
+
+  def _handle_event(self, event_message):
+    self.stem_events.append(event_message)
+
+  def add_event_listener(self, func, ev):
+    self.events.append(ev)
+
+  def get_info(self, key, default=None):
+    raise stem.InvalidArguments("552", "Unrecognized key \""+key+"\"")
+
+  def close_circuit(self, circ_id):
+    self.closed.append(circ_id)
+    self.got_close.set()
+
+  def is_alive(self):
+    return self.alive
+
+# Runs in the worker process
+def setup_listeners(controller, state):
+  def circbw_event(event):
+    # Errors from the real controller make it back to us
+    try:
+      controller.get_info("lol")
+    except stem.InvalidArguments:
+      controller.close_circuit(event.id)
+
+  controller.add_event_listener(circbw_event, "CIRC_BW")
+
+def wait_for(cond, timeout=30):
+  start = time.time()
+  while not cond():
+    assert time.time() - start < timeout
+    time.sleep(0.05)
+
+# Test plan:
+#  - Workers subscribe through the ingest process
+#  - Subscribed events get forwarded; everything else goes to stem
+#  - Commands and their exceptions round trip over the queues
+def test_round_trip():
+  saved = {}
+  for (name, options) in workers._WORKERS:
+    for opt in options:
+      saved[opt] = getattr(config, opt)
+      setattr(config, opt, opt == "ENABLE_LOGGUARD")
+
+  c = MockController()
+  ingest = workers.Ingest(c)
+  try:
+    ingest.start(setup_listeners, None)
+    assert list(ingest.workers.keys()) == ["logguard"]
+
+    wait_for(lambda: "CIRC_BW" in ingest.subscriptions)
+    assert c.events == ["CIRC_BW"]
+
+    c._handle_event(ControlMessage.from_str(ORCONN))
+    assert len(c.stem_events) == 1
+
+    c._handle_event(ControlMessage.from_str(CIRC_BW))
+    assert c.got_close.wait(30)
+    assert c.closed == ["7"]
+    assert len(c.stem_events) == 1
+    assert ingest.workers_alive()
+  finally:
+    ingest.stop()
+    for opt in saved:
+      setattr(config, opt, saved[opt])
+
+  assert not ingest.workers["logguard"].process.is_alive()
+  assert c._handle_event == ingest.stem_handler
+
+class FallbackController(MockController):
+  def __init__(self, data_dir):
+    MockController.__init__(self)
+    self.data_dir = data_dir
+
+  def get_network_statuses(self):
+    # Like stem, hand back a generator
+    return stem.descriptor.parse_file(
+               os.path.join("tests", "cached-microdesc-consensus"),
+               document_handler = stem.descriptor.DocumentHandler.ENTRIES)
+
+  def get_conf(self, key, default=None):
+    if key == "DataDirectory":
+      return self.data_dir
+    return default
+
+  def get_info(self, key, default=None):
+    return default
+
+  def get_version(self):
+    return lambda: None
+
+  def set_conf(self, key, val):
+    pass
+
+# Runs in the worker process
+def setup_fallback(controller, state):
+  def circbw_event(event):
+    try:
+      controller.get_version()
+      assert False
+    except stem.ControllerError:
+      pass
+    state.new_consensus_event(controller, None)
+    controller.close_circuit(str(len(state.layer2)))
+
+  controller.add_event_listener(circbw_event, "CIRC_BW")
+
+# Test plan:
+#  - When the consensus file can't be read, a worker gets the routers it
+#    asks tor for
+#  - Replies that can't be pickled come back as errors, rather than
+#    hanging the worker
+def test_consensus_fallback():
+  saved = {}
+  for (name, options) in workers._WORKERS:
+    for opt in options:
+      saved[opt] = getattr(config, opt)
+      setattr(config, opt, opt == "ENABLE_VANGUARDS")
+
+  tmpdir = tempfile.mkdtemp()
+  # Stem can still read the weights from this, but we can't
+  with open(os.path.join("tests", "cached-microdesc-consensus")) as f:
+    data = f.read()
+  with open(os.path.join(tmpdir, "cached-microdesc-consensus"), "w") as f:
+    f.write(data.replace(" microdesc\n", " ns\n", 1))
+
+  c = FallbackController(tmpdir)
+  state = vanguards.VanguardState(os.path.join(tmpdir, "vanguards.state"))
+  ingest = workers.Ingest(c)
+  try:
+    ingest.start(setup_fallback, state)
+    assert list(ingest.workers.keys()) == ["vanguards"]
+
+    wait_for(lambda: "CIRC_BW" in ingest.subscriptions)
+    c._handle_event(ControlMessage.from_str(CIRC_BW))
+    assert c.got_close.wait(60)
+    assert c.closed == [str(vanguards.NUM_LAYER2_GUARDS)]
+    assert ingest.workers_alive()
+  finally:
+    ingest.stop()
+    shutil.rmtree(tmpdir)
+    for opt in saved:
+      setattr(config, opt, saved[opt])